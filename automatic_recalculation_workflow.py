@@ -14,15 +14,25 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 
+import json
 import logging.config
 import os
 import sys
+from functools import partial
+
 import numpy as np
+import pydicom
 from dicom_rt_context_extractor.utils.dicom_folder_structurer import restructure_dicom_folder, destructure_folder
-from components.simulation_runners import SimulationRunners
+from components.simulation_runners import SimulationRunners, TOPAS_CHUNKS_SUMMARY
 from components.output_cleaners import OutputCleaners
 from components.input_file_generators import InputFileGenerators
 from components.extractors import DicomExtractors
+from components.study_schedulers import StudySchedulers, LOG_FORMAT, LOG_DATE_FORMAT
+from utils.dicom_loader import open_dicom_folder
+from utils.grid_extents import (DOSE_FALLOFF_MARGINS, crop_margin_from_extent, custom_grid_from_extent, minimal_extent,
+                                read_seed_positions, read_source_radionuclide, structures_extent)
+from utils.run_manifest import STAGES, resumable_stage
+from utils.structure_masks import get_structure_masks
 
 TOPAS_MATERIAL_CONVERTER = {"prostate": "TG186Prostate",
                             "vessie": "TG186MeanMaleSoftTissue",
@@ -44,17 +54,196 @@ EGS_BRACHY_MATERIAL_CONVERTER = {"prostate": "PROSTATE_WW86",
 #                                  "Bladder Neck": "WATER_1.000",
 #                                  "prostate_calcification": "WATER_1.000"}
 
+def list_study_contexts(patients_directory: str, output_path: str) -> list:
+    study_contexts = []
+    for patient in sorted(os.listdir(patients_directory)):
+        patient_folder_path = os.path.join(patients_directory, patient)
+        for studies in sorted(os.listdir(patient_folder_path)):
+            simulation_files_path = os.path.join(output_path, f"simulation_files_{patient}_{studies}".replace(" ", "_"))
+            study_contexts.append({"patient": patient,
+                                   "study": studies,
+                                   "study_path": os.path.join(patient_folder_path, studies),
+                                   "simulation_files_path": simulation_files_path,
+                                   "final_output_folder": os.path.join(output_path,
+                                                                       f"final_output_{patient}_{studies}".replace(
+                                                                           " ", "_")),
+                                   "log_file": os.path.join(simulation_files_path, "logs.logs")})
+
+    return study_contexts
+
+
+def extract_study(study_context: dict, pipeline: dict) -> dict:
+    # the folder is kept when a study is resumed
+    os.makedirs(study_context["final_output_folder"], exist_ok=True)
+    study_context["plan"] = pipeline["dicom_extractor"].extract_context_from_dicoms(pipeline["extractor_selected"],
+                                                                                   study_context["study_path"],
+                                                                                   study_context["final_output_folder"])
+    return study_context
+
+
+def reload_study(study_context: dict, pipeline: dict) -> dict:
+    """
+    Reloads the plan of a study resumed after its extraction from the extraction cache, the plan not being kept in the
+    run manifest. It is extracted again when the cache does not hold it.
+    """
+    study_context["plan"] = pipeline["dicom_extractor"].load_cached_context(pipeline["extractor_selected"],
+                                                                            study_context["study_path"])
+    if study_context["plan"] is None:
+        logging.info(f"The plan of {study_context['study_path']} is not in the extraction cache, extracting it again")
+        study_context = extract_study(study_context, pipeline)
+    return study_context
+
+
+def fit_grid_extents(study_context: dict, pipeline: dict, input_file_generator: InputFileGenerators):
+    """
+    Fits the phantom crop and the scoring grid of the study to its desired structures and seeds, extended by the
+    dose falloff margin of the radionuclide of the seeds.
+    """
+    plan = study_context["plan"]
+    dicom_folder = open_dicom_folder(study_context["study_path"])
+    ct_grid = dicom_folder.image_grid("CT")
+    rt_plan = pydicom.dcmread(dicom_folder.paths("RTPLAN")[0])
+    dose_falloff_margins = dict(DOSE_FALLOFF_MARGINS, **(pipeline["dose_falloff_margins"] or {}))
+    radionuclide = read_source_radionuclide(rt_plan)
+    if radionuclide not in dose_falloff_margins:
+        raise NotImplementedError(f"No dose falloff margin for {radionuclide}")
+
+    structures = structures_extent(get_structure_masks(plan, ct_grid),
+                                   input_file_generator.__getattribute__("list_of_desired_structures"), ct_grid)
+    extent = minimal_extent(structures, read_seed_positions(rt_plan), dose_falloff_margins[radionuclide], ct_grid)
+    pixel_spacing = plan.structures.z_y_x_spacing
+    if pipeline["custom_grid"] is not None:
+        pixel_spacing = pipeline["custom_grid"]["pixel_spacing"]
+    custom_grid = custom_grid_from_extent(extent, pixel_spacing)
+    crop_to_contour_margin = crop_margin_from_extent(structures, extent)
+    logging.info(f"Scoring grid of {custom_grid['shape'].tolist()} voxels and crop margin of "
+                 f"{crop_to_contour_margin:.1f} mm fitted to the implant")
+
+    return input_file_generator.with_grid_extents(custom_grid, crop_to_contour_margin)
+
+
+def generate_study_input_files(study_context: dict, pipeline: dict) -> dict:
+    plan = study_context["plan"]
+    input_file_generator = pipeline["input_file_generator"]
+    set_custom_grid_based_on_organ_location = pipeline["set_custom_grid_based_on_organ_location"]
+    custom_grid = pipeline["custom_grid"]
+    if set_custom_grid_based_on_organ_location[0]:
+        structure_masks = get_structure_masks(plan)
+        center_of_organ = structure_masks.center(set_custom_grid_based_on_organ_location[1])
+
+        if custom_grid is None:
+            ct_shape = structure_masks.shape(set_custom_grid_based_on_organ_location[1])
+            input_file_generator = input_file_generator.with_custom_grid({"pixel_spacing": plan.structures.z_y_x_spacing,
+                                                                         "shape": ct_shape,
+                                                                         "scorer_origin": center_of_organ})
+        else:
+            # copied so that the origin of one study never leaks in the grid of another one
+            custom_grid = dict(custom_grid)
+            custom_grid["scorer_origin"] = center_of_organ
+            input_file_generator = input_file_generator.with_custom_grid(custom_grid)
+    if pipeline["minimize_grid_extents"]:
+        input_file_generator = fit_grid_extents(study_context, pipeline, input_file_generator)
+
+    sim_files_folder, meta_data_dict, all_sr_sequence = input_file_generator.generate_input_files(
+        pipeline["input_file_generator_selected"],
+        plan, study_context["simulation_files_path"])
+    simulation_runner = pipeline["simulation_runner"]
+    if getattr(simulation_runner, "adaptive", False) and \
+            getattr(simulation_runner, "adaptive_target_structure", None) is not None:
+        input_file_generator.write_adaptive_target_mask(pipeline["input_file_generator_selected"], plan,
+                                                        sim_files_folder, meta_data_dict,
+                                                        simulation_runner.adaptive_target_structure)
+    study_context["sim_files_folder"] = sim_files_folder
+    study_context["meta_data_dict"] = meta_data_dict
+    study_context["all_sr_sequence"] = all_sr_sequence
+    return study_context
+
+
+def simulate_study(study_context: dict, pipeline: dict) -> dict:
+    study_context["output_folder"] = pipeline["simulation_runner"].launch_simulation(
+        pipeline["runner_selected"], study_context["sim_files_folder"], study_context["simulation_files_path"])
+    return study_context
+
+
+def clean_study_output(study_context: dict, pipeline: dict) -> dict:
+    plan = study_context["plan"]
+    meta_data_dict = study_context["meta_data_dict"]
+    reproduce_tg43_dose_grid = pipeline["reproduce_tg43_dose_grid"]
+    image_position = np.asarray([0, 0, 0], dtype=np.float64)
+    if plan.structures_are_built and not reproduce_tg43_dose_grid:
+        image_position = np.asarray(plan.structures.x_y_z_origin)
+    if "image_position_offset" in meta_data_dict.keys():
+        image_position += np.asarray(meta_data_dict["image_position_offset"])
+
+    image_orientation_patient = np.asarray([1, 0, 0, 0, 1, 0],
+                                           dtype=np.float64)
+    if plan.structures_are_built and not reproduce_tg43_dose_grid:
+        image_orientation_patient = np.asarray(plan.structures.x_y_z_rotation_vectors)
+    if "image_orientation_patient_offset" in meta_data_dict.keys():
+        image_orientation_patient += np.asarray(meta_data_dict["image_orientation_patient_offset"])
+
+    to_dose_factor = plan.dose_factor
+    if "tg43" == pipeline["runner_selected"]:
+        # the superposed dose is already in Gy
+        to_dose_factor = 1.0
+    elif "dose_factor_offset" in meta_data_dict.keys():
+        to_dose_factor = to_dose_factor * meta_data_dict["dose_factor_offset"]
+        if "topas" == pipeline["runner_selected"]:
+            to_dose_factor = to_dose_factor / (pipeline["number_of_particles"] * pipeline["nb_of_threads"])
+    topas_chunks_summary_path = os.path.join(study_context["output_folder"], TOPAS_CHUNKS_SUMMARY)
+    if os.path.exists(topas_chunks_summary_path):
+        with open(topas_chunks_summary_path) as file:
+            # the merged Sum only holds the histories of the chunks that completed
+            to_dose_factor = to_dose_factor / json.load(file)["histories_fraction"]
+    flipped = False
+    if "flipped" in meta_data_dict.keys():
+        flipped = "flipped"
+
+    study_context["final_output_path"] = pipeline["output_cleaner"].clean_output(
+        pipeline["output_file_format"], study_context["output_folder"], study_context["final_output_folder"],
+        study_context["study_path"], image_position=image_position,
+        image_orientation_patient=image_orientation_patient,
+        to_dose_factor=to_dose_factor, sr_item_list=study_context["all_sr_sequence"],
+        log_file=study_context["log_file"], flipped=flipped, plan=plan,
+        phantom_media=meta_data_dict.get("phantom_media"))
+    # shutil.rmtree(study_context["simulation_files_path"]) # Uncomment to delete simulation files after processing
+    return study_context
+
+
+def study_stages(pipeline: dict, resume: bool = True) -> list:
+    stages = [partial(stage, pipeline=pipeline) for stage in [extract_study, generate_study_input_files, simulate_study,
+                                                               clean_study_output]]
+    if not resume:
+        return stages
+
+    # small values each stage adds to the study context and the files or folders it produces, the plan being
+    # reloaded from the extraction cache
+    stage_outputs = [([], ["final_output_folder"]),
+                     (["sim_files_folder", "meta_data_dict", "all_sr_sequence"], ["sim_files_folder"]),
+                     (["output_folder"], ["output_folder"]),
+                     (["final_output_path"], ["final_output_folder"])]
+    reload_functions = [partial(reload_study, pipeline=pipeline), None, None, None]
+    return [resumable_stage(stage, stage_name, state_keys, artifact_keys, reload_function)
+            for stage, stage_name, (state_keys, artifact_keys), reload_function in zip(stages, STAGES, stage_outputs,
+                                                                                      reload_functions)]
+
+
 # ["prostate", "vessie", "rectum", "uretre", "prostate_calcification"]
 if __name__ == "__main__":
     ORGANS_TO_USE, RESTRUCTURING_FOLDERS, NUMBER_OF_PARTICLES = (["prostate", "vessie", "rectum", "uretre", "prostate_calcification"], False, 1e5)
     #-------------------- input, output --------------------
     PATIENTS_DIRECTORY = sys.argv[-2]
     OUTPUT_PATH = sys.argv[-1]
+    logging.basicConfig(handlers=[logging.StreamHandler()], level=logging.INFO, format=LOG_FORMAT,
+                        datefmt=LOG_DATE_FORMAT)
     #-------------------- Selecting component types --------------------
     extractor_selected = "permanent_implant_brachy"
-    input_file_generator_selected = "topas_permanent_implant_brachy"
+    input_file_generator_selected = "topas_permanent_implant_brachy" # "tg43_superposition" with the "tg43" runner and "a3ddose"
     runner_selected = "topas"
     output_file_format = "binary"
+    scheduler_selected = "process_pool" # "sequential", "process_pool" or "pipelined"
+    resume = True # Skips the completed studies and resumes the others at their first incomplete stage
+
     #-------------------- Additional DICOM files --------------------
     generate_sr = True
     recreate_struct_with_simulation_geometry = True
@@ -64,6 +253,8 @@ if __name__ == "__main__":
     custom_grid = {"scorer_origin": np.asarray([0, 0, 0]), "pixel_spacing": np.asarray([0.75, 0.5, 1]),
                    "shape": np.asarray([130, 160, 128])}  # only for TOPAS
     set_custom_grid_based_on_organ_location = True, "prostate" # only for TOPAS
+    minimize_grid_extents = False # Fits the crop and the scoring grid to the structures and the seeds, overriding the two above
+    dose_falloff_margins = None # In mm by radionuclide, to extend or replace utils.grid_extents.DOSE_FALLOFF_MARGINS
     ct_calibration_curve = np.asarray([[-3025, 0.001],
                                        [-1000, 0.001],
                                        [0, 1.008],
@@ -81,12 +272,16 @@ if __name__ == "__main__":
     #-------------------- Building components with their parameter--------------------
     # even if some parameters are not needed in some cases, they are left to serve as reference
     dicom_extractor = DicomExtractors(segmentation=["prostate_calcifications"], build_structures=True,
-                                      recreate_struct=recreate_struct_with_simulation_geometry, series_description=series_description)
+                                      recreate_struct=recreate_struct_with_simulation_geometry, series_description=series_description,
+                                      cache_folder=None, # Folder of the extraction cache, None to always extract from the DICOMs
+                                      cache_max_size=20e9, # In bytes, least recently used entries are evicted beyond it
+                                      dicom_loader_nb_of_threads=8) # DICOM files of a study read at the same time, mostly useful on network mounted folders
     input_file_generator = InputFileGenerators(total_particles=NUMBER_OF_PARTICLES,
                                                run_mode="normal", # EGS_BRACHY ONLY "normal" for TG186 and "superposition" for TG43
                                                list_of_desired_structures=ORGANS_TO_USE,
                                                crop_to_contour_margin=20, # Margin to add to the contour when cropping in mm
                                                material_attribution_dict=TOPAS_MATERIAL_CONVERTER, #Set Material to use here
+                                               phantom_default_medium=None, # Medium outside of the structures, needed by the dose to water conversion
                                                egs_brachy_home=r'/EGSnrc_CLRP/egs_home/egs_brachy',#EGS_BRACHY ONLY path to egs_brachy folder
                                                batches=1,
                                                chunk=1,
@@ -97,11 +292,27 @@ if __name__ == "__main__":
                                                code_version="3.9",
                                                topas_output_type="binary",
                                                ct_calibration_curve=ct_calibration_curve,
-                                               custom_dose_grid=custom_grid)
+                                               custom_dose_grid=custom_grid,
+                                               phase_space_library=None, # Folder of the seed phase spaces, None to transport in every seed capsule
+                                               phase_space_nb_of_histories=int(1e8), # Decays of each phase space generation
+                                               phase_space_code_version="egs_brachy 2021", # Part of the key of the phase spaces
+                                               phase_space_seed_model="Advantage_IAI_125A", # TOPAS ONLY seed model of the phase space
+                                               tg43_kernels={}, # TG-43 kernel by RTPLAN Source Model ID, consensus .json or (.3ddose, air kerma per history)
+                                               cache_folder=None, # Folder of the generated files cache (phantoms), None to always generate them
+                                               cache_max_size=50e9) # In bytes, least recently used entries are evicted beyond it
 
     nb_of_threads = 2
-    simulation_runner = SimulationRunners(nb_treads=nb_threads, waiting_time=30, #See egsNRC documentation for more details on parrallelization runs
-                                          egs_brachy_home=r'/EGSnrc_CLRP/egs_home/egs_brachy')
+    nb_of_concurrent_studies = max(1, (os.cpu_count() or 1) // nb_of_threads) # Studies recalculated at the same time
+    simulation_runner = SimulationRunners(nb_treads=nb_of_threads, waiting_time=30, #See egsNRC documentation for more details on parrallelization runs
+                                          egs_brachy_home=r'/EGSnrc_CLRP/egs_home/egs_brachy',
+                                          egs_brachy_launcher="native", # "native" starts the jobs directly, "egs-parallel" uses waiting_time and the batch system
+                                          nb_of_topas_chunks=1, # TOPAS ONLY, > 1 splits the histories in independent runs merged afterward
+                                          adaptive=False, # Stops the simulation once the target uncertainty is reached, NUMBER_OF_PARTICLES being the budget
+                                          adaptive_nb_of_increments=10,
+                                          adaptive_uncertainty_threshold=0.02, # Mean relative uncertainty in the target
+                                          adaptive_target_structure="prostate", # Mask written with the input files, the 10% isodose without it
+                                          cache_folder=None, # Folder of the simulation results cache, None to always simulate
+                                          cache_max_size=100e9) # In bytes, least recently used results are evicted beyond it
 
     output_cleaner = OutputCleaners(
         software="Systematic MC recalculation Workflow V0.5: DL training commit: ***",
@@ -118,80 +329,58 @@ if __name__ == "__main__":
         dvh_interpolation_segments=2,
         dvh_dose_limit=60000,
         prescription_dose=144,
-        use_updated_rt_struct=True) # Whether to use updated RT struct or not
+        use_updated_rt_struct=True, # Whether to use updated RT struct or not
+        validate_3ddose_reader=False, # Compares the built-in .3ddose reader with py3ddose on each output
+        dvh_engine="masks", # "masks" reuses the masks of the extracted structures, "dicompyler" rasterizes the contours
+        dvh_nb_of_processes=1, # > 1 splits the DVH computation of very fine dose grids between processes
+        gamma_criteria=[(2, 2, "global"), (2, 2, "local")], # (dose %, distance mm, type) comparisons with the TPS dose, [] to skip
+        gamma_lower_dose_cutoff=0.1, # Fraction of the prescription dose below which voxels are not compared
+        resampling_target=None, # "CT", "TPS" or a grid, also writes the dose resampled onto it
+        resampling_interpolation="linear", # or "nearest"
+        training_dataset_folder=None, # Folder of the chunked CT, structures and doses of the cohort, None to skip
+        training_dataset_chunk_shape=(16, 64, 64),
+        training_dataset_nb_of_threads=4, # Chunks compressed and written in parallel
+        dvh_metrics={"prostate": ["D90", "V100", "V150"], "uretre": ["D10"], "rectum": ["D2cc"], "vessie": ["D2cc"]},
+        cohort_metrics_table=os.path.join(OUTPUT_PATH, "cohort_dvh_metrics.csv"), # MC and TPS metrics of all the studies, None to skip
+        dose_to_water=False, # Also writes the dose to water in medium (Dw,m) next to the dose to medium (Dm,m)
+        dose_to_water_compositions=None, # Mass fraction by atomic number of the phantom media missing from egs_brachy's material.dat
+        dose_to_water_source=None) # "I-125", "Pd-103" or (energy MeV, photons per decay) lines, None to read the isotope of the plan
 
 
+    study_scheduler = StudySchedulers(nb_of_concurrent_studies=nb_of_concurrent_studies, # process_pool only
+                                      stage_workers=[1, 1, 1, 2], # pipelined only, threads for extraction, generation, simulation and cleaning
+                                      queue_size=1) # pipelined only, studies waiting between two stages
+
+    pipeline = {"dicom_extractor": dicom_extractor,
+                "input_file_generator": input_file_generator,
+                "simulation_runner": simulation_runner,
+                "output_cleaner": output_cleaner,
+                "extractor_selected": extractor_selected,
+                "input_file_generator_selected": input_file_generator_selected,
+                "runner_selected": runner_selected,
+                "output_file_format": output_file_format,
+                "set_custom_grid_based_on_organ_location": set_custom_grid_based_on_organ_location,
+                "custom_grid": custom_grid,
+                "minimize_grid_extents": minimize_grid_extents,
+                "dose_falloff_margins": dose_falloff_margins,
+                "reproduce_tg43_dose_grid": reproduce_tg43_dose_grid,
+                "number_of_particles": NUMBER_OF_PARTICLES,
+                "nb_of_threads": nb_of_threads}
+
     #-------------------- Running the pipeline--------------------
-    for patient in os.listdir(PATIENTS_DIRECTORY):
-        patient_folder_path = os.path.join(PATIENTS_DIRECTORY, patient)
-        if RESTRUCTURING_FOLDERS:
+    if RESTRUCTURING_FOLDERS:
+        for patient in os.listdir(PATIENTS_DIRECTORY):
+            patient_folder_path = os.path.join(PATIENTS_DIRECTORY, patient)
             restructure_dicom_folder(patient_folder_path, patient_folder_path)
 
-        for studies in os.listdir(patient_folder_path):
-            study_path = os.path.join(patient_folder_path, studies)
-            simulation_files_path = os.path.join(OUTPUT_PATH, f"simulation_files_{patient}_{studies}".replace(" ", "_"))
-            os.mkdir(simulation_files_path)
-            final_output_folder = os.path.join(OUTPUT_PATH, f"final_output_{patient}_{studies}".replace(" ", "_"))
-            os.mkdir(final_output_folder)
-            log_file = os.path.join(simulation_files_path, "logs.logs")
-            logging.basicConfig(handlers=[logging.FileHandler(log_file), logging.StreamHandler()], level=logging.INFO,
-                                format='[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
-                                datefmt='%H:%M:%S')
-            plan = dicom_extractor.extract_context_from_dicoms(extractor_selected, study_path, final_output_folder)
-            if set_custom_grid_based_on_organ_location[0]:
-                center_of_organ = plan.structures.get_specific_mask(set_custom_grid_based_on_organ_location[1],
-                                                                    set_custom_grid_based_on_organ_location[
-                                                                        1]).get_mask_center()
-
-                if custom_grid is None:
-                    ct_shape = plan.structures.get_specific_mask(set_custom_grid_based_on_organ_location[1],
-                                                                 set_custom_grid_based_on_organ_location[
-                                                                     1]).get_3d_mask().shape
-                    input_file_generator.reset_custom_grid({"pixel_spacing": plan.structures.z_y_x_spacing,
-                                                            "shape": ct_shape,
-                                                            "scorer_origin": center_of_organ})
-                else:
-                    custom_grid["scorer_origin"] = center_of_organ
-                    input_file_generator.reset_custom_grid(custom_grid)
-
-            try:
-                sim_files_folder, meta_data_dict, all_sr_sequence = input_file_generator.generate_input_files(
-                    input_file_generator_selected,
-                    plan, simulation_files_path)
-            except NotImplementedError:
-                logging.warning("This study has been ignored because seed model is not implemented")
-                break
-
-            output_folder = simulation_runner.launch_simulation(runner_selected, sim_files_folder,
-                                                                simulation_files_path)
-            image_position = np.asarray([0, 0, 0], dtype=np.float64)
-            if plan.structures_are_built and not reproduce_tg43_dose_grid:
-                image_position = np.asarray(plan.structures.x_y_z_origin)
-            if "image_position_offset" in meta_data_dict.keys():
-                image_position += np.asarray(meta_data_dict["image_position_offset"])
-
-            image_orientation_patient = np.asarray([1, 0, 0, 0, 1, 0],
-                                                   dtype=np.float64)
-            if plan.structures_are_built and not reproduce_tg43_dose_grid:
-                image_orientation_patient = np.asarray(plan.structures.x_y_z_rotation_vectors)
-            if "image_orientation_patient_offset" in meta_data_dict.keys():
-                image_orientation_patient += np.asarray(meta_data_dict["image_orientation_patient_offset"])
-
-            to_dose_factor = plan.dose_factor
-            if "dose_factor_offset" in meta_data_dict.keys():
-                to_dose_factor = to_dose_factor * meta_data_dict["dose_factor_offset"]
-                if "topas" == runner_selected:
-                    to_dose_factor = to_dose_factor / (NUMBER_OF_PARTICLES * nb_of_threads)
-            flipped = False
-            if "flipped" in meta_data_dict.keys():
-                flipped = "flipped"
-
-            final_output_path = output_cleaner.clean_output(output_file_format, output_folder, final_output_folder,
-                                                            study_path, image_position=image_position,
-                                                            image_orientation_patient=image_orientation_patient,
-                                                            to_dose_factor=to_dose_factor, sr_item_list=all_sr_sequence,
-                                                            log_file=log_file, flipped=flipped)
-            # shutil.rmtree(simulation_files_path) # Uncomment to delete simulation files after processing
-
-        if RESTRUCTURING_FOLDERS:
-            destructure_folder(patient_folder_path)
+    study_results = study_scheduler.run_studies(scheduler_selected, list_study_contexts(PATIENTS_DIRECTORY, OUTPUT_PATH),
+                                                study_stages(pipeline, resume))
+    for study_result in study_results:
+        if study_result["status"] != "completed":
+            logging.warning(f"{study_result['study_path']} was not recalculated ({study_result['status']})")
+    logging.info(f"{sum(result['status'] == 'completed' for result in study_results)}/{len(study_results)} "
+                 f"studies recalculated")
+
+    if RESTRUCTURING_FOLDERS:
+        for patient in os.listdir(PATIENTS_DIRECTORY):
+            destructure_folder(os.path.join(PATIENTS_DIRECTORY, patient))
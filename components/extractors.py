@@ -14,12 +14,21 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 
+import logging
 import os
+import pickle
+from shutil import copy
 
 from dicom_rt_context_extractor.sources_information_extraction import extract_all_sources_informations
 from dicom_rt_context_extractor.utils.search_instance_and_convert_coord_in_pixel import find_modality_in_folder
 from prostate_calcification_segmentation.calcification_segmentation import segmenting_calcification
 
+from utils.dicom_loader import DicomFolder, open_dicom_folder
+from utils.disk_cache import DiskCache, library_version, make_cache_key
+
+EXTRACTION_CACHE_VERSION = 1
+EXTRACTION_NON_RESULT_PARAMETERS = ["dicom_loader_nb_of_threads"]
+
 
 class DicomExtractors:
     def __init__(self, **kwargs):
@@ -28,6 +37,8 @@ class DicomExtractors:
         :param input_file_folder:
         :param kwargs: for egs_brachy, kwargs must have nb_treads (int), waiting_time (float) and
                        egs_brachy_home (str)
+                       cache_folder (str) enables the extraction cache, bounded to cache_max_size (float, in bytes)
+                       dicom_loader_nb_of_threads (int), number of DICOM files of a study read at the same time
         """
         for key in kwargs.keys():
             self.__setattr__(key, kwargs[key])
@@ -36,7 +47,8 @@ class DicomExtractors:
         self.hdr_brachy = self._extract_hdr_brachy_context
         self.ldr_brachy = self._extract_ldr_brachy_context
 
-    def _extract_permanent_implant_brachy_context(self, input_folder: str, output_folder: str) -> str:
+    def _extract_permanent_implant_brachy_context(self, input_folder: str, output_folder: str,
+                                                  rt_plan_path: str) -> str:
         build_structures = True
         if hasattr(self, "build_structures"):
             build_structures = self.__getattribute__("build_structures")
@@ -44,7 +56,6 @@ class DicomExtractors:
         if hasattr(self, "series_description"):
             series_description = self.__getattribute__("series_description")
 
-        rt_plan_path = find_modality_in_folder("RTPLAN", input_folder)
         plan = extract_all_sources_informations(rt_plan_path)
         if build_structures:
             plan.extract_structures(input_folder)
@@ -59,15 +70,127 @@ class DicomExtractors:
         plan.extract_dosimetry(input_folder)
         return plan
 
-    def _extract_hdr_brachy_context(self, input_folder: str, output_folder: str) -> str:
+    def _extract_hdr_brachy_context(self, input_folder: str, output_folder: str, rt_plan_path: str) -> str:
         pass
 
-    def _extract_ldr_brachy_context(self, input_folder: str, output_folder: str):
+    def _extract_ldr_brachy_context(self, input_folder: str, output_folder: str, rt_plan_path: str):
         pass
 
     def extract_context_from_dicoms(self, treatment_modality: str, input_folder: str, output_folder: str):
         assert treatment_modality in ["permanent_implant_brachy", "hdr_brachy", "ldr_brachy"]
-        return self.__getattribute__(treatment_modality)(input_folder, output_folder)
+        # the headers are read once, in parallel, for the cache key and the RTPLAN, and kept for the other stages.
+        # The library reads the pixels itself.
+        dicom_folder = self._open_dicom_folder(input_folder)
+        rt_plan_path = self._find_rt_plan_path(dicom_folder, input_folder)
+        context_fingerprint = self._get_extraction_cache_key(treatment_modality, dicom_folder)
+        if hasattr(self, "cache_folder") and self.__getattribute__("cache_folder") is not None:
+            plan = self._extract_context_with_cache(treatment_modality, input_folder, output_folder, rt_plan_path,
+                                                    context_fingerprint)
+        else:
+            plan = self.__getattribute__(treatment_modality)(input_folder, output_folder, rt_plan_path)
+        if plan is not None:
+            self._set_plan_origin(plan, context_fingerprint, input_folder, rt_plan_path)
+        return plan
+
+    def load_cached_context(self, treatment_modality: str, input_folder: str):
+        """
+        Loads the plan of a study already extracted from the extraction cache, without copying the files of the
+        extraction again, ex. for a study resumed after its extraction.
+
+        :return: the plan, None when the extraction cache is disabled or does not hold the study
+        """
+        if not hasattr(self, "cache_folder") or self.__getattribute__("cache_folder") is None:
+            return None
+        dicom_folder = self._open_dicom_folder(input_folder)
+        context_fingerprint = self._get_extraction_cache_key(treatment_modality, dicom_folder)
+        entry_folder = self._get_cache().get(context_fingerprint)
+        if entry_folder is None:
+            return None
+        try:
+            with open(os.path.join(entry_folder, "plan.pkl"), "rb") as file:
+                plan = pickle.load(file)
+        except Exception as e:
+            logging.warning(f"Extraction cache entry {entry_folder} could not be used: {e}")
+            return None
+        self._set_plan_origin(plan, context_fingerprint, input_folder,
+                              self._find_rt_plan_path(dicom_folder, input_folder))
+        return plan
+
+    def _open_dicom_folder(self, input_folder: str) -> DicomFolder:
+        dicom_loader_nb_of_threads = 8
+        if hasattr(self, "dicom_loader_nb_of_threads"):
+            dicom_loader_nb_of_threads = self.__getattribute__("dicom_loader_nb_of_threads")
+        return open_dicom_folder(input_folder, dicom_loader_nb_of_threads)
+
+    @staticmethod
+    def _find_rt_plan_path(dicom_folder: DicomFolder, input_folder: str) -> str:
+        rt_plan_paths = dicom_folder.paths("RTPLAN")
+        return rt_plan_paths[0] if len(rt_plan_paths) > 0 else find_modality_in_folder("RTPLAN", input_folder)
+
+    @staticmethod
+    def _set_plan_origin(plan, context_fingerprint: str, input_folder: str, rt_plan_path: str):
+        # identifies the DICOMs and the extraction parameters the plan comes from, for the downstream caches
+        plan.context_fingerprint = context_fingerprint
+        # set after the cache, the same DICOMs can be found in another folder
+        plan.study_path = input_folder
+        # read again by the generators that need more than the library extracts (ex. the TG-43 superposition)
+        plan.rt_plan_path = rt_plan_path
+
+    def _get_cache(self) -> DiskCache:
+        cache_max_size = None
+        if hasattr(self, "cache_max_size"):
+            cache_max_size = self.__getattribute__("cache_max_size")
+        return DiskCache(self.__getattribute__("cache_folder"), cache_max_size)
+
+    def _get_extraction_cache_key(self, treatment_modality: str, dicom_folder: DicomFolder) -> str:
+        parameters = {key: value for key, value in vars(self).items()
+                      if not callable(value) and not key.startswith("cache_")
+                      and key not in EXTRACTION_NON_RESULT_PARAMETERS}
+        library_versions = [library_version(library) for library in ["dicom_rt_context_extractor",
+                                                                          "prostate_calcification_segmentation"]]
+
+        return make_cache_key("extraction", EXTRACTION_CACHE_VERSION, treatment_modality, library_versions,
+                              parameters, dicom_folder.sop_instance_uids())
+
+    def _extract_context_with_cache(self, treatment_modality: str, input_folder: str, output_folder: str,
+                                    rt_plan_path: str, key: str):
+        """
+        Extracts the context through a cache keyed by the SOP Instance UIDs of the study and the parameters of the
+        extractor. An entry holds the pickled plan (with its structures and calcification masks) and the files the
+        extraction wrote in the output folder, which are copied back on a hit.
+        """
+        cache = self._get_cache()
+        entry_folder = cache.get(key)
+        if entry_folder is not None:
+            try:
+                with open(os.path.join(entry_folder, "plan.pkl"), "rb") as file:
+                    plan = pickle.load(file)
+                for file_name in os.listdir(os.path.join(entry_folder, "outputs")):
+                    copy(os.path.join(entry_folder, "outputs", file_name), os.path.join(output_folder, file_name))
+                logging.info(f"Context of {input_folder} loaded from the extraction cache")
+                return plan
+            except Exception as e:
+                logging.warning(f"Extraction cache entry {entry_folder} could not be used, extracting again: {e}")
+
+        files_before_extraction = set(os.listdir(output_folder))
+        plan = self.__getattribute__(treatment_modality)(input_folder, output_folder, rt_plan_path)
+        created_files = [file_name for file_name in os.listdir(output_folder)
+                         if file_name not in files_before_extraction
+                         and os.path.isfile(os.path.join(output_folder, file_name))]
+
+        def populate(folder: str):
+            with open(os.path.join(folder, "plan.pkl"), "wb") as file:
+                pickle.dump(plan, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.mkdir(os.path.join(folder, "outputs"))
+            for created_file in created_files:
+                copy(os.path.join(output_folder, created_file), os.path.join(folder, "outputs", created_file))
+
+        try:
+            cache.put(key, populate)
+        except Exception as e:
+            logging.warning(f"The context of {input_folder} could not be cached: {e}")
+
+        return plan
 
     def _segment_prostate_calcification(self, plan, input_folder: str, output_folder):
         prostate_calcification_mask = segmenting_calcification(plan, 2.0, input_folder)
@@ -14,8 +14,15 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 
+import json
+import logging
 import os
-from typing import Tuple
+import pickle
+from shutil import copy
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pydicom
 
 from egs_brachy_file_generator.generate_permanent_implant_brachy_input import generate_whole_egs_brachy_input_file
 from egs_brachy_file_generator.generate_permanent_implant_tg43_brachy_input import \
@@ -23,7 +30,34 @@ from egs_brachy_file_generator.generate_permanent_implant_tg43_brachy_input impo
 from topas_file_generator.generate_topas_input_from_dicom_extractor import generate_whole_topas_input_file, \
     generate_whole_tg43_permanent_implant_topas_input_file
 
+from components.simulation_runners import ADAPTIVE_TARGET_MASK
 from root import ROOT
+from utils.dicom_loader import read_image_series_grid
+from utils.disk_cache import DiskCache, library_version, link_or_copy, make_cache_key
+from utils.grids import VoxelGrid
+from utils.phase_space_sources import SourceModelLibrary, use_phase_space_in_egsinp, use_phase_space_in_topas
+from utils.run_parameters import RUN_PARAMETERS, update_run_metadata, update_run_parameters
+from utils.structure_masks import get_structure_masks
+from utils.tg43 import read_seeds
+
+INPUT_FILES_CACHE_VERSION = 2
+# generated files that are only linked from the cache, the others are copied with their paths updated
+LINKED_EXTENSIONS = [".egsphant", ".bin"]
+# parameters the phantom depends on, the only ones of the key of the input files cache
+PHANTOM_PARAMETERS = ["list_of_desired_structures", "material_attribution_dict", "ct_calibration_curve", "crop",
+                      "crop_to_contour_margin", "custom_dose_grid", "expand_tg45_phantom"]
+
+
+def _replace_folder(value, old_folder: str, new_folder: str):
+    if isinstance(value, str):
+        return value.replace(old_folder, new_folder)
+    if isinstance(value, list):
+        return [_replace_folder(item, old_folder, new_folder) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_replace_folder(item, old_folder, new_folder) for item in value)
+    if isinstance(value, dict):
+        return {key: _replace_folder(item, old_folder, new_folder) for key, item in value.items()}
+    return value
 
 
 class InputFileGenerators:
@@ -33,6 +67,17 @@ class InputFileGenerators:
         :param input_file_folder:
         :param kwargs: for egs_brachy, kwargs must have nb_treads (int), waiting_time (float) and
                        egs_brachy_home (str)
+                       cache_folder (str) enables the generated files cache, keyed by the phantom parameters and
+                       bounded to cache_max_size (float, in bytes)
+                       phantom_default_medium (str), medium of the phantom outside of the structures. It goes with
+                       the media of material_attribution_dict in the phantom_media of meta_data_dict, from which the
+                       dose to water is converted.
+                       phase_space_library (str) replaces the seeds sources by phase spaces of their model, generated
+                       once with egs_brachy (phase_space_nb_of_histories (int), phase_space_code_version (str)). TOPAS
+                       reuses them through phase_space_seed_model (str), the name of the egs_brachy seed model.
+                       tg43_kernels (dict) gives the TG-43 kernel of each Source Model ID of the RTPLAN ("default" for
+                       the others) for tg43_superposition: a consensus data .json, or a (.3ddose of a single seed in
+                       water, its air kerma strength per history in Gy cm2) pair.
         """
         for key in kwargs.keys():
             self.__setattr__(key, kwargs[key])
@@ -41,6 +86,7 @@ class InputFileGenerators:
         self.topas_permanent_tg43_implant_brachy = self._genrerate_topas_permanent_tg43_implant_brachy_input_files
         self.egs_brachy_permanent_implant_brachy = self._genrerate_egs_brachy_permanent_implant_brachy_input_files
         self.egs_brachy_permanent_tg43_implant_brachy = self._genrerate_egs_brachy_permanent_implant_tg43_brachy_input_files
+        self.tg43_superposition = self._generate_tg43_superposition_input_files
         self.topas_hdr_brachy = self._genrerate_topas_hdr_brachy_input_files
         self.topas_ldr_brachy = self._genrerate_topas_ldr_brachy_input_files
         self.egs_brachy_ldr_brachy = self._genrerate_egs_brachy_ldr_brachy_input_files
@@ -48,6 +94,23 @@ class InputFileGenerators:
     def reset_custom_grid(self, custom_grid):
         self.__setattr__("custom_dose_grid", custom_grid)
 
+    def with_custom_grid(self, custom_grid) -> "InputFileGenerators":
+        """
+        :return: a copy with the scoring grid of one study, so that it never leaks in the input files of another study
+                 generated at the same time
+        """
+        parameters = {key: value for key, value in vars(self).items() if not callable(value)}
+        parameters["custom_dose_grid"] = custom_grid
+        return InputFileGenerators(**parameters)
+
+    def with_grid_extents(self, custom_grid, crop_to_contour_margin: float) -> "InputFileGenerators":
+        """
+        :return: a copy with the scoring grid and crop margin of one study
+        """
+        input_file_generator = self.with_custom_grid(custom_grid)
+        input_file_generator.crop_to_contour_margin = crop_to_contour_margin
+        return input_file_generator
+
     def _genrerate_topas_permanent_tg43_implant_brachy_input_files(self, plan, output_folder: str):
         total_particles = self.__getattribute__("total_particles")
         frequence_of_print = f"i:Ts/ShowHistoryCountAtInterval = {int(total_particles // 100)}"
@@ -245,6 +308,116 @@ class InputFileGenerators:
 
         return output_folder, meta_data_dict, all_sr_sequence
 
+    def _generate_tg43_superposition_input_files(self, plan, output_folder: str) -> Tuple:
+        """
+        Writes the input of the TG-43 superposition run by SimulationRunners: the seeds of the RTPLAN, the kernel of
+        their model and the dose grid, custom_dose_grid or the CT grid. The grid being axial, its origin relative to
+        the CT goes in the image_position_offset of meta_data_dict.
+        """
+        tg43_kernels = self.__getattribute__("tg43_kernels")
+        rt_plan_path = getattr(plan, "rt_plan_path", None)
+        if rt_plan_path is None:
+            raise ValueError("The plan does not know its RTPLAN, extract it again for the TG-43 superposition")
+        rt_plan = pydicom.dcmread(rt_plan_path)
+        source_model_id = str(rt_plan.SourceSequence[0].get("SourceModelID", ""))
+        kernel = tg43_kernels.get(source_model_id, tg43_kernels.get("default"))
+        if kernel is None:
+            raise NotImplementedError(f"No TG-43 kernel for the seed model {source_model_id}")
+        kernel_path, air_kerma_strength_per_history = (kernel, None) if isinstance(kernel, str) else kernel
+
+        custom_dose_grid = None
+        if hasattr(self, "custom_dose_grid"):
+            custom_dose_grid = self.__getattribute__("custom_dose_grid")
+        ct_origin = np.zeros(3)
+        # the orientation the output cleaners give to the RT Dose, the CT one
+        image_orientation_patient = np.asarray([1, 0, 0, 0, 1, 0], dtype=np.float64)
+        if plan.structures_are_built:
+            ct_origin = np.asarray(plan.structures.x_y_z_origin, dtype=np.float64)
+            image_orientation_patient = np.asarray(plan.structures.x_y_z_rotation_vectors, dtype=np.float64)
+        if custom_dose_grid is not None:
+            # z, y, x spacing and shape, around the scorer origin, along the slices, columns and rows
+            pixel_spacing = np.asarray(custom_dose_grid["pixel_spacing"], dtype=np.float64)
+            shape = np.asarray(custom_dose_grid["shape"], dtype=int)
+            row_direction, column_direction = image_orientation_patient[:3], image_orientation_patient[3:]
+            half_extents = (shape - 1) * pixel_spacing / 2
+            origin = np.asarray(custom_dose_grid["scorer_origin"], dtype=np.float64) - \
+                half_extents[0] * np.cross(row_direction, column_direction) - half_extents[1] * column_direction - \
+                half_extents[2] * row_direction
+        elif plan.structures_are_built:
+            pixel_spacing = np.asarray(plan.structures.z_y_x_spacing, dtype=np.float64)
+            shape = np.asarray(get_structure_masks(plan).shape(self.__getattribute__("list_of_desired_structures")[0]))
+            origin = ct_origin
+        else:
+            raise ValueError("The TG-43 superposition needs a custom_dose_grid when the structures are not built")
+
+        seeds = read_seeds(rt_plan)
+        tg43_input = {"kernel_path": kernel_path, "air_kerma_strength_per_history": air_kerma_strength_per_history,
+                      "grid": {"origin": origin.tolist(), "pixel_spacing": [pixel_spacing[1], pixel_spacing[2]],
+                               "slice_thickness": pixel_spacing[0], "shape": shape.tolist(),
+                               "image_orientation_patient": image_orientation_patient.tolist()},
+                      "seeds": {key: values.tolist() for key, values in seeds.items()}}
+        with open(os.path.join(output_folder, f"tg43_{plan.patient}_{plan.study}.json"), "w") as file:
+            json.dump(tg43_input, file, indent=2)
+        logging.info(f"TG-43 superposition of {len(seeds['positions'])} seeds on a grid of {shape.tolist()} voxels")
+
+        return output_folder, {"image_position_offset": (origin - ct_origin).tolist()}, []
+
+    def _get_scoring_grid(self, plan, ct_grid: VoxelGrid, meta_data_dict) -> Optional[VoxelGrid]:
+        """
+        :return: the grid of the scored dose, placed on the CT as the output cleaners place it, None when the phantom
+                 is cropped without a custom_dose_grid since the crop is only known by the external generators
+        """
+        custom_dose_grid = None
+        if hasattr(self, "custom_dose_grid"):
+            custom_dose_grid = self.__getattribute__("custom_dose_grid")
+        crop = False
+        if hasattr(self, "crop"):
+            crop = self.__getattribute__("crop")
+        origin = ct_grid.origin + np.asarray(meta_data_dict.get("image_position_offset", np.zeros(3)), dtype=np.float64)
+        if custom_dose_grid is not None:
+            # z, y, x spacing and shape
+            pixel_spacing = np.asarray(custom_dose_grid["pixel_spacing"], dtype=np.float64)
+            return VoxelGrid(origin, ct_grid.row_direction, ct_grid.column_direction, pixel_spacing[1:],
+                             np.arange(int(custom_dose_grid["shape"][0])) * pixel_spacing[0],
+                             custom_dose_grid["shape"][1], custom_dose_grid["shape"][2])
+        if not crop:
+            return VoxelGrid(origin, ct_grid.row_direction, ct_grid.column_direction, ct_grid.pixel_spacing,
+                             ct_grid.slice_offsets, ct_grid.shape[1], ct_grid.shape[2])
+        return None
+
+    def write_adaptive_target_mask(self, generator: str, plan, sim_files_folder: str, meta_data_dict,
+                                   roi_name: str) -> bool:
+        """
+        Writes the mask of the target of the adaptive runs in the input folder, resampled on the scoring grid from the
+        structure masks shared by the other stages, and ordered as the scored dose (z, y, x, before the flip the
+        output cleaners apply to it).
+
+        :param roi_name: target structure, adaptive_target_structure of SimulationRunners
+        :return: whether the mask was written
+        """
+        study_path = getattr(plan, "study_path", None)
+        if study_path is None:
+            logging.warning(f"The structures of {plan.patient} {plan.study} are not available, no adaptive target "
+                            f"mask is written")
+            return False
+        ct_grid = read_image_series_grid(study_path, "CT")
+        scoring_grid = self._get_scoring_grid(plan, ct_grid, meta_data_dict)
+        if scoring_grid is None:
+            logging.warning("The scoring grid of a cropped phantom is only known with a custom_dose_grid, no adaptive "
+                            "target mask is written")
+            return False
+        mask = get_structure_masks(plan, ct_grid).on_grid(roi_name, scoring_grid)
+        if mask is None or not np.any(mask):
+            logging.warning(f"{roi_name} is not in the scoring grid of {plan.patient} {plan.study}, no adaptive "
+                            f"target mask is written")
+            return False
+        if "flipped" in meta_data_dict.keys():
+            # the cleaners flip the z axis of the 3ddose and the x axis of the TOPAS (x, y, z) arrays
+            mask = np.flip(mask, axis=0 if generator.startswith("egs_brachy") else 2)
+        np.save(os.path.join(sim_files_folder, ADAPTIVE_TARGET_MASK), np.ascontiguousarray(mask))
+        logging.info(f"Adaptive target mask of {roi_name}, {int(np.count_nonzero(mask))} voxels of the scoring grid")
+        return True
+
     def _genrerate_topas_hdr_brachy_input_files(self, plan, output_folder: str) -> str:
         pass
 
@@ -260,5 +433,188 @@ class InputFileGenerators:
     def generate_input_files(self, generator: str, plan, output_path):
         assert generator in ["topas_permanent_implant_brachy", "egs_brachy_permanent_implant_brachy",
                              "topas_hdr_brachy", "topas_ldr_brachy", "egs_brachy_ldr_brachy",
-                             "egs_brachy_permanent_tg43_implant_brachy", "topas_permanent_tg43_implant_brachy"]
-        return self.__getattribute__(generator)(plan, output_path)
+                             "egs_brachy_permanent_tg43_implant_brachy", "topas_permanent_tg43_implant_brachy",
+                             "tg43_superposition"]
+        if hasattr(self, "cache_folder") and self.__getattribute__("cache_folder") is not None:
+            generated = self._generate_input_files_with_cache(generator, plan, output_path)
+        else:
+            generated = self.__getattribute__(generator)(plan, output_path)
+        sim_files_folder, meta_data_dict, all_sr_sequence = generated
+        meta_data_dict["phantom_media"] = self._get_phantom_media(generator)
+        return self._use_phase_space_sources(generator, sim_files_folder, meta_data_dict, all_sr_sequence)
+
+    def _get_phantom_media(self, generator: str) -> Tuple[Dict[str, str], Optional[str]]:
+        """
+        :return: the medium given to each structure of the phantom, in the order of list_of_desired_structures (the
+                 later ones winning where they overlap), and the medium outside of them, None when unknown. The TG-43
+                 phantoms are water.
+        """
+        if "tg43" in generator:
+            return {}, "WATER_1.000"
+        list_of_desired_structures = self.__getattribute__("list_of_desired_structures")
+        material_attribution_dict = self.__getattribute__("material_attribution_dict")
+        phantom_default_medium = None
+        if hasattr(self, "phantom_default_medium"):
+            phantom_default_medium = self.__getattribute__("phantom_default_medium")
+        return ({name: material_attribution_dict[name] for name in list_of_desired_structures
+                 if name in material_attribution_dict}, phantom_default_medium)
+
+    def _use_phase_space_sources(self, generator: str, sim_files_folder: str, meta_data_dict, all_sr_sequence):
+        """
+        Replaces the sources of the input files by the phase spaces of the seed model, so that the transport inside
+        the capsule of the emitting seed is done once per model instead of once per study. Done after the input files
+        cache, which keeps the files as generated. The dose normalization of the phase spaces goes in the
+        dose_factor_offset of meta_data_dict.
+        """
+        phase_space_library = None
+        if hasattr(self, "phase_space_library"):
+            phase_space_library = self.__getattribute__("phase_space_library")
+        if phase_space_library is None or generator == "tg43_superposition":
+            return sim_files_folder, meta_data_dict, all_sr_sequence
+        code_version = None
+        if hasattr(self, "phase_space_code_version"):
+            code_version = self.__getattribute__("phase_space_code_version")
+        nb_of_histories = int(1e8)
+        if hasattr(self, "phase_space_nb_of_histories"):
+            nb_of_histories = self.__getattribute__("phase_space_nb_of_histories")
+        library = SourceModelLibrary(phase_space_library, code_version, nb_of_histories)
+
+        is_egs_brachy = generator.startswith("egs_brachy")
+        dose_factor = 1.0
+        for file_name in sorted(os.listdir(sim_files_folder)):
+            input_file_path = os.path.join(sim_files_folder, file_name)
+            if is_egs_brachy and file_name.endswith(".egsinp"):
+                with open(input_file_path, "r") as file:
+                    egsinp = file.read()
+                source_model = library.get_or_generate(egsinp, self.__getattribute__("egs_brachy_home"))
+                content, dose_factor = use_phase_space_in_egsinp(egsinp, source_model)
+            elif not is_egs_brachy and file_name.startswith("input_") and file_name.endswith(".txt"):
+                seed_model = self.__getattribute__("phase_space_seed_model")
+                source_model = library.get(seed_model)
+                if source_model is None:
+                    raise FileNotFoundError(f"No phase space of {seed_model} in {phase_space_library}, generate it "
+                                            f"once with an egs_brachy study")
+                with open(input_file_path, "r") as file:
+                    content, dose_factor = use_phase_space_in_topas(file.read(), source_model)
+            else:
+                continue
+            with open(input_file_path, "w") as file:
+                file.write(content)
+            logging.info(f"The sources of {file_name} are the phase space of {source_model['seed_model']}")
+        meta_data_dict["dose_factor_offset"] = meta_data_dict.get("dose_factor_offset", 1) * dose_factor
+
+        return sim_files_folder, meta_data_dict, all_sr_sequence
+
+    def _get_run_parameters(self) -> Dict:
+        return {name: getattr(self, name, default) for name, default in RUN_PARAMETERS.items()}
+
+    def _get_generation_parameters(self) -> Dict:
+        """
+        :return: the parameters of the generator that are neither in the key of the cache nor rewritten in the restored
+                 input files
+        """
+        return {key: value for key, value in vars(self).items()
+                if not callable(value) and not key.startswith("cache_") and key not in PHANTOM_PARAMETERS
+                and key not in RUN_PARAMETERS}
+
+    def _get_phantom_cache_key(self, generator: str, plan) -> str:
+        phantom_parameters = {name: getattr(self, name, None) for name in PHANTOM_PARAMETERS}
+        library_versions = [library_version(library) for library in ["egs_brachy_file_generator",
+                                                                     "topas_file_generator"]]
+
+        return make_cache_key("input_files", INPUT_FILES_CACHE_VERSION, generator, library_versions,
+                              plan.context_fingerprint, phantom_parameters)
+
+    def _generate_input_files_with_cache(self, generator: str, plan, output_path: str) -> Tuple:
+        """
+        Generates the input files through a cache keyed by what the phantom depends on: the fingerprint of the plan (the
+        DICOMs and extraction parameters it comes from), the structures and their media, the CT calibration, the crop
+        and the custom grid. The generators write the phantom (.egsphant or index_3d .bin) together with the input
+        file, so an entry holds every file written in the output folder. On a hit, the phantoms are hard linked from
+        the cache instead of being regenerated, and the input files are copied with the cached folder replaced by the
+        new one and the run parameters (total_particles, batches, chunk) rewritten, as in the meta data and the SR
+        content items of the generation. An entry generated with other
+        parameters is generated again and replaced.
+        """
+        if generator == "tg43_superposition" or getattr(plan, "context_fingerprint", None) is None:
+            return self.__getattribute__(generator)(plan, output_path)
+        cache_max_size = None
+        if hasattr(self, "cache_max_size"):
+            cache_max_size = self.__getattribute__("cache_max_size")
+        cache = DiskCache(self.__getattribute__("cache_folder"), cache_max_size)
+        key = self._get_phantom_cache_key(generator, plan)
+        entry_folder = cache.get(key)
+        if entry_folder is not None:
+            try:
+                restored = self._restore_input_files(entry_folder, output_path)
+                if restored is not None:
+                    return restored
+            except Exception as e:
+                logging.warning(f"Input files cache entry {entry_folder} could not be used, generating again: {e}")
+            cache.remove(key)
+
+        files_before_generation = set(os.listdir(output_path))
+        sim_files_folder, meta_data_dict, all_sr_sequence = self.__getattribute__(generator)(plan, output_path)
+        generated_files = [file_name for file_name in os.listdir(output_path)
+                           if file_name not in files_before_generation
+                           and os.path.isfile(os.path.join(output_path, file_name))]
+
+        def populate(folder: str):
+            with open(os.path.join(folder, "generation.pkl"), "wb") as file:
+                pickle.dump({"output_path": output_path, "sim_files_folder": sim_files_folder,
+                             "meta_data_dict": meta_data_dict, "all_sr_sequence": all_sr_sequence,
+                             "run_parameters": self._get_run_parameters(),
+                             "generation_parameters": self._get_generation_parameters()}, file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.mkdir(os.path.join(folder, "files"))
+            for generated_file in generated_files:
+                # the other files are copied since they can be modified afterward (ex. the number of threads added to
+                # the TOPAS input file)
+                if os.path.splitext(generated_file)[1] in LINKED_EXTENSIONS:
+                    link_or_copy(os.path.join(output_path, generated_file),
+                                 os.path.join(folder, "files", generated_file))
+                else:
+                    copy(os.path.join(output_path, generated_file), os.path.join(folder, "files", generated_file))
+
+        try:
+            cache.put(key, populate)
+        except Exception as e:
+            logging.warning(f"The input files of {plan.patient} {plan.study} could not be cached: {e}")
+
+        return sim_files_folder, meta_data_dict, all_sr_sequence
+
+    def _restore_input_files(self, entry_folder: str, output_path: str) -> Optional[Tuple]:
+        """
+        :return: the generation of the entry, None when it was generated with other parameters than the phantom and run
+                 ones
+        """
+        with open(os.path.join(entry_folder, "generation.pkl"), "rb") as file:
+            generation = pickle.load(file)
+        if make_cache_key(generation["generation_parameters"]) != make_cache_key(self._get_generation_parameters()):
+            logging.info(f"Input files cache entry {entry_folder} was generated with other parameters, generating "
+                         f"again")
+            return None
+        cached_output_path = generation["output_path"]
+        run_parameters = self._get_run_parameters()
+        for file_name in os.listdir(os.path.join(entry_folder, "files")):
+            cached_file_path = os.path.join(entry_folder, "files", file_name)
+            if os.path.splitext(file_name)[1] in LINKED_EXTENSIONS:
+                link_or_copy(cached_file_path, os.path.join(output_path, file_name))
+                continue
+            try:
+                with open(cached_file_path, "r") as file:
+                    content = file.read()
+            except UnicodeDecodeError:
+                link_or_copy(cached_file_path, os.path.join(output_path, file_name))
+                continue
+            content = content.replace(cached_output_path, output_path)
+            if file_name.startswith("input_"):
+                content = update_run_parameters(content, generation["run_parameters"], run_parameters)
+            with open(os.path.join(output_path, file_name), "w") as file:
+                file.write(content)
+        logging.info(f"Input files restored from the cache entry {entry_folder}")
+
+        return (_replace_folder(generation["sim_files_folder"], cached_output_path, output_path),
+                update_run_metadata(_replace_folder(generation["meta_data_dict"], cached_output_path, output_path),
+                                    generation["run_parameters"], run_parameters),
+                update_run_metadata(generation["all_sr_sequence"], generation["run_parameters"], run_parameters))
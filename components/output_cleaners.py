@@ -17,17 +17,28 @@
 import logging
 import os
 from datetime import datetime
+from typing import Optional, Tuple
 import pydicom
 import numpy as np
 from dicom_rt_context_extractor.utils.search_instance_and_convert_coord_in_pixel import find_modality_in_folder
+from dicompylercore import dvhcalc
 from dicom_sr_builder.content_sequence_generator import TEXT_generator, CodeSequence_generator
 from dicom_sr_builder.sr_builder import SRBuilder
 from mcdose2dicom import create_rt_dose_from_scratch, adapt_rt_dose_to_existing_dicoms
 from mcdose2dicom.adding_dvh import generate_and_add_all_dvh_to_dicom
 from mcdose2dicom.create_rt_dose_from_scratch import RTDoseBuilder
 from py3ddose.py3ddose import DoseFile
-from topas2numpy import BinnedResult
-
+from utils.cohort_table import append_cohort_rows
+from utils.dataset_export import write_study_store
+from utils.dicom_loader import read_image_series, read_image_series_grid
+from utils.dose_to_water import SOURCE_SPECTRA, convert_to_dose_to_water, medium_composition, normalize_radionuclide
+from utils.dose_files import TopasBinaryResult, contains_nan, read_3ddose, Dose3D
+from utils.dvh import compute_cumulative_dvhs, evaluate_dvh_metric
+from utils.gamma import gamma_index, pass_rate
+from utils.grids import VoxelGrid, resample_linear, resample_nearest
+from utils.structure_masks import get_structure_masks
+from utils.rt_dicom import add_dvh_sequence, add_rt_dose_reference_to_rt_plan, adapt_rt_dose_to_rt_plan, \
+    dose_frames, get_dose_array, get_roi_names, resampled_rt_dose, set_dose_grid_pixels
 
 class OutputCleaners:
     def __init__(self, **kwargs):
@@ -40,6 +51,27 @@ class OutputCleaners:
                        grid_orientation (str)
                        to_dose_factor (float)
                        "series_description" (str)
+                       validate_3ddose_reader (bool), compares each .3ddose read with py3ddose.DoseFile
+                       single_write_dicom (bool), builds the RT Doses, the updated plan and the DVHs in memory and
+                       writes each of them once (default). Otherwise, mcdose2dicom adapts the files on disk.
+                       dvh_engine (str), "masks" (default) computes the DVHs from the bit-packed masks rasterized once
+                       for the study, "dicompyler" rasterizes the contours again. dvh_nb_of_processes (int) splits the
+                       "masks" DVHs of very fine grids between processes.
+                       gamma_criteria (list of (float, float, str)), gamma comparisons of the MC dose with the TPS dose
+                       (ex. [(2, 2, "global")] for 2%/2 mm), with gamma_lower_dose_cutoff (float, fraction of
+                       gamma_normalization_dose, defaults to the prescription_dose)
+                       resampling_target ("CT", "TPS", a VoxelGrid or the arguments of VoxelGrid.regular), also writes
+                       the dose and its uncertainty resampled onto that grid, with resampling_interpolation ("linear"
+                       or "nearest")
+                       training_dataset_folder (str), also writes the CT, the structures, the MC dose, its uncertainty
+                       and the TPS dose of each study, on the CT grid, in a chunked store of that cohort folder (see
+                       utils.dataset_export), with training_dataset_chunk_shape and training_dataset_nb_of_threads
+                       dvh_metrics (dict), metrics of utils.dvh.evaluate_dvh_metric by structure name (ex.
+                       {"prostate": ["D90", "V100"]}), appended for the MC and TPS doses to cohort_metrics_table (str)
+                       dose_to_water (bool), also writes the dose to water in medium, in the media of the simulated
+                       phantom given to clean_output, with dose_to_water_compositions (dict, mass fraction by atomic
+                       number of the media missing from material.dat) and dose_to_water_source (radionuclide or photon
+                       lines, defaults to the isotope of the RT Plan)
         """
         for key in kwargs.keys():
             self.__setattr__(key, kwargs[key])
@@ -69,7 +101,8 @@ class OutputCleaners:
 
     def _3ddose_to_dicom(self, input_folder, output_path,
                          dicom_folder, image_position=None, image_orientation_patient=None,
-                         to_dose_factor=1.0, sr_item_list=None, log_file=None, flipped=False):
+                         to_dose_factor=1.0, sr_item_list=None, log_file=None, flipped=False, plan=None,
+                         phantom_media=None):
         if image_position is None:
             image_position = [0, 0, 0]
         if image_orientation_patient is None:
@@ -84,7 +117,9 @@ class OutputCleaners:
 
         completed = False
         try:
-            open_3ddose = DoseFile(output_3ddose_path, load_uncertainty=True)
+            open_3ddose = read_3ddose(output_3ddose_path, use_sidecar=True)
+            if hasattr(self, "validate_3ddose_reader") and self.__getattribute__("validate_3ddose_reader"):
+                self._validate_3ddose_reader(output_3ddose_path, open_3ddose)
             if flipped:
                 dose_data = np.flip(open_3ddose.dose, axis=0)
                 std_data = np.flip(open_3ddose.uncertainty, axis=0)
@@ -96,54 +131,18 @@ class OutputCleaners:
                           factor_from_cm_to_mm * open_3ddose.spacing[1][0],
                           factor_from_cm_to_mm * open_3ddose.spacing[0][0])
 
-            dose_comment = ""
-            if hasattr(self, "dose_comment"):
-                dose_comment = self.__getattribute__("dose_comment")
-            software = ""
-            if hasattr(self, "software"):
-                software = self.__getattribute__("software")
-            bits_allocated = 16
-            if hasattr(self, "bits_allocated"):
-                bits_allocated = self.__getattribute__("bits_allocated")
-            patient_orientation = ""
-            if hasattr(self, "patient_orientation"):
-                patient_orientation = self.__getattribute__("patient_orientation")
-            dose_summation_type = "PLAN"
-            if hasattr(self, "dose_summation_type"):
-                dose_summation_type = self.__getattribute__("dose_summation_type")
-
-            image_position = fr"{image_position[0]}\{image_position[1]}\{image_position[2]}"
-            image_orientation_patient = fr"{image_orientation_patient[0]}\{image_orientation_patient[1]}\
-                                       {image_orientation_patient[2]}\{image_orientation_patient[3]}\
-                                       {image_orientation_patient[4]}\{image_orientation_patient[5]}"
-            dose_comment += f" Factor from dose/histories to total dose = {to_dose_factor}"
-            rt_dose = create_rt_dose_from_scratch.RTDoseBuilder(dose_grid_scaling=to_dose_factor,
-                                                                dose_type="PHYSICAL", dose_comment=dose_comment,
-                                                                software=software, dose_units="GY",
-                                                                bits_allocated=bits_allocated,
-                                                                dose_summation_type=dose_summation_type,
-                                                                image_orientation_patient=image_orientation_patient,
-                                                                image_position_patient=image_position,
-                                                                patient_orientation=patient_orientation)
-            rt_dose.add_dose_grid(dose_data, voxel_size, True, True)
-            rt_dose.build()
-            if not np.isnan(std_data).sum() > 0:
-                rt_dose_error = create_rt_dose_from_scratch.RTDoseBuilder(dose_grid_scaling=to_dose_factor,
-                                                                          dose_type="ERROR", dose_comment=dose_comment,
-                                                                          software=software, dose_units="GY",
-                                                                          bits_allocated=bits_allocated,
-                                                                          dose_summation_type=dose_summation_type,
-                                                                          image_orientation_patient=image_orientation_patient,
-                                                                          image_position_patient=image_position,
-                                                                          patient_orientation=patient_orientation)
-                rt_dose_error.add_dose_grid(std_data * dose_data, voxel_size, True, True)
-                rt_dose_error.build()
-            else:
-                rt_dose_error = None
+            rt_dose, rt_dose_error = self._build_rt_doses(dose_data, std_data, True, voxel_size, True, image_position,
+                                                          image_orientation_patient, to_dose_factor)
 
             storing = self._store_in_dicom(output_path, dicom_folder, rt_dose, rt_dose_error,
-                                           output_3ddose_file_name, to_dose_factor)
-            complete = True
+                                           output_3ddose_file_name, to_dose_factor, plan)
+            self._compare_with_tps_dose(rt_dose.rt_dose, dicom_folder, output_path, plan, sr_item_list)
+            self._append_dvh_metrics(rt_dose.rt_dose, dicom_folder, output_path, plan)
+            self._store_resampled_rt_doses(output_path, dicom_folder, rt_dose, rt_dose_error, output_3ddose_file_name)
+            self._store_dose_to_water(output_path, dicom_folder, rt_dose, rt_dose_error, output_3ddose_file_name, plan,
+                                      phantom_media)
+            self._export_training_dataset(output_path, dicom_folder, rt_dose, rt_dose_error, plan)
+            completed = True
         except Exception as e:
             logging.error(e)
 
@@ -178,9 +177,30 @@ class OutputCleaners:
 
         return storing
 
+    @staticmethod
+    def _validate_3ddose_reader(output_3ddose_path: str, dose_3d: Dose3D):
+        """
+        Compares the built-in reader with py3ddose on a real output, the result being logged.
+        """
+        reference = DoseFile(output_3ddose_path, load_uncertainty=True)
+        differences = []
+        for name, array, reference_array in [("dose", dose_3d.dose, reference.dose),
+                                             ("uncertainty", dose_3d.uncertainty, reference.uncertainty)]:
+            if np.shape(array) != np.shape(reference_array) or not np.allclose(array, reference_array,
+                                                                               equal_nan=True):
+                differences.append(name)
+        for axis in range(3):
+            if not np.allclose(dose_3d.spacing[axis], reference.spacing[axis]):
+                differences.append(f"spacing of axis {axis}")
+        if len(differences) > 0:
+            logging.error(f"The 3ddose reader differs from py3ddose on {output_3ddose_path}: {differences}")
+        else:
+            logging.info(f"The 3ddose reader matches py3ddose on {output_3ddose_path}")
+
     def _binary_to_dicom(self, input_folder, output_path,
                          dicom_folder, image_position=None, image_orientation_patient=None,
-                         to_dose_factor=1.0, sr_item_list=None, log_file=None, flipped=False):
+                         to_dose_factor=1.0, sr_item_list=None, log_file=None, flipped=False, plan=None,
+                         phantom_media=None):
         output_bin_path = ""
         output_bin_file_name = ""
         for file_name in os.listdir(input_folder):
@@ -190,67 +210,27 @@ class OutputCleaners:
 
         completed = False
         try:
-            open_bin = BinnedResult(output_bin_path)
-            if flipped:
-                dose_data = np.flip(open_bin.data["Sum"], axis=0)
-                std_data = np.flip(open_bin.data['Standard_Deviation'], axis=0)
-            else:
-                dose_data = open_bin.data["Sum"]
-                std_data = open_bin.data['Standard_Deviation']
+            # views of the memory mapped file, only read when the RT Doses are built
+            open_bin = TopasBinaryResult(output_bin_path)
+            dose_data = open_bin.statistic("Sum", flipped=bool(flipped))
+            std_data = open_bin.statistic("Standard_Deviation", flipped=bool(flipped))
 
             factor_from_cm_to_mm = 10
             voxel_size = (open_bin.dimensions[0].bin_width * factor_from_cm_to_mm,
                           open_bin.dimensions[1].bin_width * factor_from_cm_to_mm,
                           open_bin.dimensions[2].bin_width * factor_from_cm_to_mm)
-            dose_comment = ""
-            if hasattr(self, "dose_comment"):
-                dose_comment = self.__getattribute__("dose_comment")
-            software = ""
-            if hasattr(self, "software"):
-                software = self.__getattribute__("software")
-            bits_allocated = 16
-            if hasattr(self, "bits_allocated"):
-                bits_allocated = self.__getattribute__("bits_allocated")
-            patient_orientation = ""
-            if hasattr(self, "patient_orientation"):
-                patient_orientation = self.__getattribute__("patient_orientation")
-            dose_summation_type = "PLAN"
-            if hasattr(self, "dose_summation_type"):
-                dose_summation_type = self.__getattribute__("dose_summation_type")
-
-            image_position = fr"{image_position[0]}\{image_position[1]}\{image_position[2]}"
-            image_orientation_patient = fr"{image_orientation_patient[0]}\{image_orientation_patient[1]}\
-                                       {image_orientation_patient[2]}\{image_orientation_patient[3]}\
-                                       {image_orientation_patient[4]}\{image_orientation_patient[5]}"
-            dose_comment += f" Factor from dose/histories to total dose = {to_dose_factor}"
-            rt_dose = create_rt_dose_from_scratch.RTDoseBuilder(dose_grid_scaling=to_dose_factor,
-                                                                dose_type="PHYSICAL", dose_comment=dose_comment,
-                                                                software=software, dose_units="GY",
-                                                                bits_allocated=bits_allocated,
-                                                                dose_summation_type=dose_summation_type,
-                                                                image_orientation_patient=image_orientation_patient,
-                                                                image_position_patient=image_position,
-                                                                patient_orientation=patient_orientation)
-            rt_dose.add_dose_grid(dose_data, voxel_size, False, True)
-            rt_dose.build()
-
-            if not np.isnan(std_data).sum() > 0:
-                rt_dose_error = create_rt_dose_from_scratch.RTDoseBuilder(dose_grid_scaling=to_dose_factor,
-                                                                          dose_type="ERROR", dose_comment=dose_comment,
-                                                                          software=software, dose_units="GY",
-                                                                          bits_allocated=bits_allocated,
-                                                                          dose_summation_type=dose_summation_type,
-                                                                          image_orientation_patient=image_orientation_patient,
-                                                                          image_position_patient=image_position,
-                                                                          patient_orientation=patient_orientation)
-                rt_dose_error.add_dose_grid(std_data, voxel_size, False, True)
-                rt_dose_error.build()
-            else:
-                rt_dose_error = None
+            rt_dose, rt_dose_error = self._build_rt_doses(dose_data, std_data, False, voxel_size, False,
+                                                          image_position, image_orientation_patient, to_dose_factor)
 
             storing = self._store_in_dicom(output_path, dicom_folder, rt_dose, rt_dose_error,
-                                           output_bin_file_name, to_dose_factor)
-            complete = True
+                                           output_bin_file_name, to_dose_factor, plan)
+            self._compare_with_tps_dose(rt_dose.rt_dose, dicom_folder, output_path, plan, sr_item_list)
+            self._append_dvh_metrics(rt_dose.rt_dose, dicom_folder, output_path, plan)
+            self._store_resampled_rt_doses(output_path, dicom_folder, rt_dose, rt_dose_error, output_bin_file_name)
+            self._store_dose_to_water(output_path, dicom_folder, rt_dose, rt_dose_error, output_bin_file_name, plan,
+                                      phantom_media)
+            self._export_training_dataset(output_path, dicom_folder, rt_dose, rt_dose_error, plan)
+            completed = True
         except Exception as e:
             logging.error(e)
 
@@ -285,8 +265,100 @@ class OutputCleaners:
 
         return storing
 
+    def _build_rt_dose(self, dose_type: str, dose_data: np.ndarray, voxel_size, zyx_ordered: bool, image_position,
+                       image_orientation_patient, to_dose_factor, weights: Optional[np.ndarray] = None) -> RTDoseBuilder:
+        """
+        The builder gets the first two frames only, from which it sets the attributes of the RT Dose. The frame
+        offsets are then extended to the whole grid, and the pixels of all the frames are converted slab by slab,
+        the dose (a memory mapped view for TOPAS) never being converted to floats as a whole.
+
+        :param weights: multiplies dose_data voxel by voxel, the dose of a relative uncertainty
+        """
+        dose_comment = ""
+        if hasattr(self, "dose_comment"):
+            dose_comment = self.__getattribute__("dose_comment")
+        software = ""
+        if hasattr(self, "software"):
+            software = self.__getattribute__("software")
+        bits_allocated = 16
+        if hasattr(self, "bits_allocated"):
+            bits_allocated = self.__getattribute__("bits_allocated")
+        patient_orientation = ""
+        if hasattr(self, "patient_orientation"):
+            patient_orientation = self.__getattribute__("patient_orientation")
+        dose_summation_type = "PLAN"
+        if hasattr(self, "dose_summation_type"):
+            dose_summation_type = self.__getattribute__("dose_summation_type")
+
+        image_position = fr"{image_position[0]}\{image_position[1]}\{image_position[2]}"
+        image_orientation_patient = fr"{image_orientation_patient[0]}\{image_orientation_patient[1]}\
+                                   {image_orientation_patient[2]}\{image_orientation_patient[3]}\
+                                   {image_orientation_patient[4]}\{image_orientation_patient[5]}"
+        dose_comment += f" Factor from dose/histories to total dose = {to_dose_factor}"
+
+        def build(data: np.ndarray) -> RTDoseBuilder:
+            builder = create_rt_dose_from_scratch.RTDoseBuilder(dose_grid_scaling=to_dose_factor,
+                                                                dose_type=dose_type, dose_comment=dose_comment,
+                                                                software=software, dose_units="GY",
+                                                                bits_allocated=bits_allocated,
+                                                                dose_summation_type=dose_summation_type,
+                                                                image_orientation_patient=image_orientation_patient,
+                                                                image_position_patient=image_position,
+                                                                patient_orientation=patient_orientation)
+            builder.add_dose_grid(data, voxel_size, zyx_ordered, True)
+            builder.build()
+            return builder
+
+        nb_of_frames = dose_data.shape[0] if zyx_ordered else dose_data.shape[2]
+        nb_of_template_frames = min(2, nb_of_frames)
+        template_data = np.array(dose_data[:nb_of_template_frames] if zyx_ordered
+                                 else dose_data[:, :, :nb_of_template_frames], dtype=np.float64)
+        if weights is not None:
+            template_data *= weights[:nb_of_template_frames] if zyx_ordered else weights[:, :, :nb_of_template_frames]
+        rt_dose = build(template_data)
+        if nb_of_frames == nb_of_template_frames:
+            return rt_dose
+
+        expected = dose_frames(template_data, 0, nb_of_template_frames, zyx_ordered) * to_dose_factor
+        built = get_dose_array(rt_dose.rt_dose)
+        if built.shape != expected.shape or not np.allclose(built, expected, rtol=1e-3,
+                                                            atol=float(rt_dose.rt_dose.DoseGridScaling)):
+            logging.warning("The RT Dose builder does not order or scale the frames as expected, the whole dose grid is "
+                            "converted by it")
+            return build(dose_data if weights is None else dose_data * weights)
+        offsets = [float(offset) for offset in rt_dose.rt_dose.GridFrameOffsetVector]
+        rt_dose.rt_dose.GridFrameOffsetVector = [offsets[0] + index * (offsets[1] - offsets[0])
+                                                 for index in range(nb_of_frames)]
+        set_dose_grid_pixels(rt_dose.rt_dose, dose_data, to_dose_factor, zyx_ordered, weights)
+        return rt_dose
+
+    def _build_rt_doses(self, dose_data: np.ndarray, std_data: np.ndarray, relative_std: bool, voxel_size,
+                        zyx_ordered: bool, image_position, image_orientation_patient,
+                        to_dose_factor) -> Tuple[RTDoseBuilder, Optional[RTDoseBuilder]]:
+        """
+        Builds the PHYSICAL RT Dose, then the ERROR one when std_data holds no NaN, so that the arrays of only one of
+        them are converted at a time. The absolute uncertainty of a 3ddose is computed slab by slab.
+
+        :param relative_std: whether std_data is relative to the dose (3ddose) instead of absolute (TOPAS)
+        """
+        rt_dose = self._build_rt_dose("PHYSICAL", dose_data, voxel_size, zyx_ordered, image_position,
+                                      image_orientation_patient, to_dose_factor)
+        rt_dose_error = None
+        if not contains_nan(std_data):
+            rt_dose_error = self._build_rt_dose("ERROR", std_data, voxel_size, zyx_ordered, image_position,
+                                                image_orientation_patient, to_dose_factor,
+                                                dose_data if relative_std else None)
+
+        return rt_dose, rt_dose_error
+
     def _store_in_dicom(self, output_path, dicom_folder, dose: RTDoseBuilder, std: RTDoseBuilder, file_naming,
-                        to_dose):
+                        to_dose, plan=None):
+        single_write_dicom = True
+        if hasattr(self, "single_write_dicom"):
+            single_write_dicom = self.__getattribute__("single_write_dicom")
+        if single_write_dicom:
+            return self._store_in_dicom_in_memory(output_path, dicom_folder, dose, std, file_naming, plan)
+
         path_to_rt_plan = find_modality_in_folder("RTPLAN", dicom_folder)
         if hasattr(self, "series_description"):
             dose.rt_dose.SeriesDescription = self.__getattribute__("series_description")
@@ -318,24 +390,36 @@ class OutputCleaners:
 
         return output_path
 
-    def clean_output(self, initial_file_type: str, input_folder, output_path,
-                     dicom_folder, image_position=None, image_orientation_patient=None,
-                     to_dose_factor=1.0, sr_item_list=None, log_file=None, flipped=False):
-        assert initial_file_type in ["a3ddose", "binary"]
-        if image_position is None:
-            image_position = [0, 0, 0]
-        if image_orientation_patient is None:
-            image_orientation_patient = [1, 0, 0, 0, 1, 0]
+    def _store_in_dicom_in_memory(self, output_path, dicom_folder, dose: RTDoseBuilder, std: RTDoseBuilder,
+                                  file_naming, plan=None):
+        """
+        Adapts the RT Doses to the plan, references them in the updated plan and adds the DVHs to the dose in memory,
+        so that each DICOM object is written exactly once.
+        """
+        rt_plan = pydicom.dcmread(find_modality_in_folder("RTPLAN", dicom_folder))
+        if hasattr(self, "series_description"):
+            dose.rt_dose.SeriesDescription = self.__getattribute__("series_description")
+        if std is not None:
+            std.rt_dose.SeriesDescription = dose.rt_dose.SeriesDescription
+            std.rt_dose.SeriesInstanceUID = dose.rt_dose.SeriesInstanceUID
+            std.rt_dose.SeriesNumber = dose.rt_dose.SeriesNumber
+            std.rt_dose.InstanceNumber = dose.rt_dose.InstanceNumber + 1
 
-        return self.__getattribute__(initial_file_type)(input_folder, output_path, dicom_folder, image_position,
-                                                        image_orientation_patient, to_dose_factor, sr_item_list,
-                                                        log_file, flipped)
+        for rt_dose in [dose, std]:
+            if rt_dose is not None:
+                adapt_rt_dose_to_rt_plan(rt_dose.rt_dose, rt_plan)
+                add_rt_dose_reference_to_rt_plan(rt_plan, rt_dose.rt_dose)
+        if hasattr(self, "generate_dvh"):
+            if self.__getattribute__("generate_dvh"):
+                self._add_dvh_in_memory(dose.rt_dose, dicom_folder, output_path, plan)
 
-    def _generate_dvh(self, dose_saving_path, dicom_folder, to_dose_factor):
-        rt_struct_path = find_modality_in_folder("RTSTRUCT", dicom_folder)
-        if hasattr(self, "use_updated_rt_struct"):
-            if self.__getattribute__("use_updated_rt_struct"):
-                rt_struct_path = find_modality_in_folder("RTSTRUCT", os.path.dirname(dose_saving_path))
+        dose.save_rt_dose_to(os.path.join(output_path, "dose_" + file_naming + ".dcm"))
+        if std is not None:
+            std.save_rt_dose_to(os.path.join(output_path, "error_" + file_naming + ".dcm"))
+        rt_plan.save_as(os.path.join(output_path, "updated_plan_" + file_naming + ".dcm"))
+        return output_path
+
+    def _get_dvh_parameters(self) -> dict:
         dvh_comment = "Generated from dycompyler-core "
         if hasattr(self, "dvh_comment"):
             dvh_comment += self.__getattribute__("dvh_comment")
@@ -361,22 +445,439 @@ class OutputCleaners:
         if hasattr(self, "dvh_dose_limit"):
             dvh_dose_limit = self.__getattribute__("dvh_dose_limit")
 
+        return {"dvh_comment": dvh_comment, "prescription_dose": prescription_dose,
+                "dvh_normalization_point": dvh_normalization_point,
+                "dvh_interpolation_segments": dvh_interpolation_segments, "dvh_callback": dvh_callback,
+                "dvh_calculate_full_volume": dvh_calculate_full_volume,
+                "dvh_use_structure_extents": dvh_use_structure_extents, "dvh_dose_limit": dvh_dose_limit}
+
+    def _get_rt_struct_path(self, dicom_folder, output_path):
+        rt_struct_path = find_modality_in_folder("RTSTRUCT", dicom_folder)
+        if hasattr(self, "use_updated_rt_struct"):
+            if self.__getattribute__("use_updated_rt_struct"):
+                rt_struct_path = find_modality_in_folder("RTSTRUCT", output_path)
+
+        return rt_struct_path
+
+    @staticmethod
+    def _get_masks_on_grid(dicom_folder, plan, roi_names: dict, grid: VoxelGrid,
+                           rt_struct: Optional[pydicom.Dataset] = None) -> dict:
+        """
+        :param rt_struct: RT Struct whose contours are rasterized instead of the one of the study
+        :return: the masks of the study, on the CT grid, resampled to grid, for the ROIs of roi_names having one. They
+                 are shared by all the outputs of the study through plan.structure_masks.
+        """
+        structure_masks = get_structure_masks(plan, read_image_series_grid(dicom_folder, "CT"))
+        masks = {}
+        for roi_number, roi_name in roi_names.items():
+            mask = structure_masks.on_grid(roi_name, grid, rt_struct)
+            if mask is not None:
+                masks[roi_number] = mask
+
+        return masks
+
+    def _compare_with_tps_dose(self, rt_dose: pydicom.Dataset, dicom_folder, output_path, plan=None,
+                               sr_item_list=None):
+        """
+        Gamma comparison of the MC dose with the clinical dose of the study, for each of gamma_criteria, (dose
+        difference in %, distance to agreement in mm, "global" or "local") tuples. The TPS dose is the reference. The
+        pass rates of all the evaluated voxels and of each structure are logged and added to the SR.
+        """
+        gamma_criteria = None
+        if hasattr(self, "gamma_criteria"):
+            gamma_criteria = self.__getattribute__("gamma_criteria")
+        if not gamma_criteria:
+            return
+        tps_dose_path = find_modality_in_folder("RTDOSE", dicom_folder)
+        if tps_dose_path is None:
+            logging.warning(f"No TPS RT Dose in {dicom_folder}, the gamma comparison is skipped")
+            return
+        gamma_lower_dose_cutoff = 0.1
+        if hasattr(self, "gamma_lower_dose_cutoff"):
+            gamma_lower_dose_cutoff = self.__getattribute__("gamma_lower_dose_cutoff")
+        # the global criterion is relative to the prescription when given, the maximum TPS dose otherwise
+        gamma_normalization_dose = None
+        if hasattr(self, "prescription_dose") and self.__getattribute__("prescription_dose"):
+            gamma_normalization_dose = self.__getattribute__("prescription_dose")
+        if hasattr(self, "gamma_normalization_dose"):
+            gamma_normalization_dose = self.__getattribute__("gamma_normalization_dose")
+
+        try:
+            tps_rt_dose = pydicom.dcmread(tps_dose_path)
+            tps_grid = VoxelGrid.from_rt_dose(tps_rt_dose)
+            tps_dose = get_dose_array(tps_rt_dose)
+            mc_grid = VoxelGrid.from_rt_dose(rt_dose)
+            mc_dose = get_dose_array(rt_dose)
+            roi_names = {}
+            masks = {}
+            if plan is not None:
+                roi_names = get_roi_names(pydicom.dcmread(self._get_rt_struct_path(dicom_folder, output_path)))
+                masks = self._get_masks_on_grid(dicom_folder, plan, roi_names, tps_grid)
+            for dose_difference, distance_to_agreement, gamma_type in gamma_criteria:
+                assert gamma_type in ["global", "local"]
+                gamma = gamma_index(tps_dose, tps_grid, mc_dose, mc_grid, dose_difference / 100,
+                                    distance_to_agreement, local=gamma_type == "local",
+                                    normalization_dose=gamma_normalization_dose,
+                                    lower_dose_cutoff=gamma_lower_dose_cutoff)
+                lines = [f"{gamma_type} gamma {dose_difference}%/{distance_to_agreement} mm (TPS dose as reference)",
+                         f"All evaluated voxels: {self._format_pass_rate(pass_rate(gamma))}"]
+                for roi_number, mask in masks.items():
+                    lines.append(f"{roi_names[roi_number]}: {self._format_pass_rate(pass_rate(gamma, mask))}")
+                text = "\n".join(lines)
+                logging.info(text)
+                if sr_item_list is not None:
+                    sr_item_list.append(TEXT_generator("CONTAINS", text,
+                                                       CodeSequence_generator("2000", "CUSTOM", "Gamma pass rates")))
+        except Exception as e:
+            logging.error(f"The gamma comparison with the TPS dose failed: {e}")
+
+    def _append_dvh_metrics(self, rt_dose: pydicom.Dataset, dicom_folder, output_path, plan=None):
+        """
+        Evaluates dvh_metrics, the metrics of utils.dvh.evaluate_dvh_metric by structure name, on the MC dose and on
+        the TPS dose of the study, and appends them to the cohort_metrics_table CSV.
+        """
+        dvh_metrics = None
+        if hasattr(self, "dvh_metrics"):
+            dvh_metrics = self.__getattribute__("dvh_metrics")
+        cohort_metrics_table = None
+        if hasattr(self, "cohort_metrics_table"):
+            cohort_metrics_table = self.__getattribute__("cohort_metrics_table")
+        if not dvh_metrics or cohort_metrics_table is None or plan is None:
+            return
+
+        try:
+            dvh_parameters = self._get_dvh_parameters()
+            rt_struct = pydicom.dcmread(self._get_rt_struct_path(dicom_folder, output_path))
+            # the structures are named as in dvh_metrics, whatever the case of their ROI names
+            metrics_by_name = {name.lower(): metrics for name, metrics in dvh_metrics.items()}
+            roi_names = {roi_number: roi_name for roi_number, roi_name in get_roi_names(rt_struct).items()
+                         if roi_name.lower() in metrics_by_name}
+            rt_doses = [("MC", rt_dose)]
+            tps_dose_path = find_modality_in_folder("RTDOSE", dicom_folder)
+            if tps_dose_path is not None:
+                rt_doses.append(("TPS", pydicom.dcmread(tps_dose_path)))
+            computed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            rows = []
+            for dose_source, dose_dataset in rt_doses:
+                dvhs, _ = self._compute_dvhs_from_masks(dose_dataset, dicom_folder, plan, roi_names, dvh_parameters)
+                for roi_number, dvh in sorted(dvhs.items()):
+                    for metric in metrics_by_name[roi_names[roi_number].lower()]:
+                        rows.append({"study": os.path.basename(os.path.normpath(output_path)),
+                                     "computed_at": computed_at, "dose_source": dose_source,
+                                     "structure": roi_names[roi_number], "metric": metric,
+                                     "value": evaluate_dvh_metric(dvh, metric, dvh_parameters["prescription_dose"]),
+                                     "unit": "%" if metric.startswith("V") else "GY"})
+            append_cohort_rows(cohort_metrics_table, rows)
+        except Exception as e:
+            logging.error(f"The DVH metrics of the study could not be added to the cohort table: {e}")
+
+    def _get_source_spectrum(self, dicom_folder) -> tuple:
+        dose_to_water_source = None
+        if hasattr(self, "dose_to_water_source"):
+            dose_to_water_source = self.__getattribute__("dose_to_water_source")
+        if dose_to_water_source is None:
+            rt_plan = pydicom.dcmread(find_modality_in_folder("RTPLAN", dicom_folder), stop_before_pixels=True)
+            dose_to_water_source = str(rt_plan.SourceSequence[0].SourceIsotopeName)
+        if isinstance(dose_to_water_source, str):
+            radionuclide = normalize_radionuclide(dose_to_water_source)
+            if radionuclide not in SOURCE_SPECTRA:
+                raise NotImplementedError(f"No spectrum for {dose_to_water_source}, dose_to_water_source can be "
+                                          f"given as (energy in MeV, photons per decay) lines")
+            return SOURCE_SPECTRA[radionuclide]
+
+        return tuple(tuple(line) for line in dose_to_water_source)
+
+    def _store_dose_to_water(self, output_path, dicom_folder, dose: RTDoseBuilder, std: Optional[RTDoseBuilder],
+                             file_naming, plan=None, phantom_media=None):
+        """
+        Writes the dose to water in medium, and its uncertainty, as dose_water_<file_naming>.dcm and
+        error_water_<file_naming>.dcm. The medium of each voxel is the one it was simulated in, from the masks of
+        plan.structures and phantom_media, the (medium by structure name, medium outside of the structures) of the
+        phantom. The media are looked up in egs_brachy's material.dat, or in dose_to_water_compositions (dict, mass
+        fraction by atomic number of the other media, ex. the TOPAS ones).
+        """
+        dose_to_water = False
+        if hasattr(self, "dose_to_water"):
+            dose_to_water = self.__getattribute__("dose_to_water")
+        if not dose_to_water:
+            return
+        dose_to_water_compositions = None
+        if hasattr(self, "dose_to_water_compositions"):
+            dose_to_water_compositions = self.__getattribute__("dose_to_water_compositions")
+
+        if phantom_media is None:
+            logging.warning("The media of the simulated phantom are not known, the dose to water in medium is not "
+                            "written")
+            return
+        structure_media, default_medium = phantom_media
+        unknown_media = set()
+        for medium in list(structure_media.values()) + ([] if default_medium is None else [default_medium]):
+            try:
+                medium_composition(medium, compositions=dose_to_water_compositions)
+            except KeyError:
+                unknown_media.add(medium)
+        if len(unknown_media) > 0:
+            logging.warning(f"No elemental composition of {sorted(unknown_media)} in material.dat, they can be given "
+                            f"through dose_to_water_compositions. The dose to water in medium is not written")
+            return
+
+        try:
+            spectrum = self._get_source_spectrum(dicom_folder)
+            dose_grid = VoxelGrid.from_rt_dose(dose.rt_dose)
+            media = [default_medium]
+            material_map = np.zeros(dose_grid.shape, dtype=np.uint8)
+            if len(structure_media) > 0:
+                if plan is None:
+                    raise ValueError("The structures of the phantom are needed to convert the dose to water")
+                media_by_name = {name.lower(): medium for name, medium in structure_media.items()}
+                roi_names = {roi_number: roi_name for roi_number, roi_name in
+                             get_roi_names(pydicom.dcmread(self._get_rt_struct_path(dicom_folder,
+                                                                                    output_path))).items()
+                             if roi_name.lower() in media_by_name}
+                masks = self._get_masks_on_grid(dicom_folder, plan, roi_names, dose_grid)
+                # the structures are assigned in the order of the phantom, the last one winning where they overlap
+                # (ex. the calcifications inside the prostate)
+                order = list(media_by_name.keys())
+                for roi_number in sorted(masks.keys(), key=lambda number: order.index(roi_names[number].lower())):
+                    medium = media_by_name[roi_names[roi_number].lower()]
+                    if medium not in media:
+                        media.append(medium)
+                    material_map[masks[roi_number]] = media.index(medium)
+            if default_medium is None:
+                if np.any(material_map == 0):
+                    logging.warning("The medium of the phantom outside of the structures is not known, it is set "
+                                    "through the phantom_default_medium of InputFileGenerators. The dose to water in "
+                                    "medium is not written")
+                    return
+                # no voxel is left in it
+                media[0] = media[-1]
+
+            for rt_dose, prefix in [(dose, "dose_water_"), (std, "error_water_")]:
+                if rt_dose is None:
+                    continue
+                dose_to_water_dataset = resampled_rt_dose(
+                    rt_dose.rt_dose, convert_to_dose_to_water(get_dose_array(rt_dose.rt_dose), material_map, media,
+                                                              spectrum, compositions=dose_to_water_compositions),
+                    dose_grid)
+                dose_to_water_dataset.SeriesDescription = f"{rt_dose.rt_dose.get('SeriesDescription', '')} Dw,m"
+                dose_to_water_dataset.save_as(os.path.join(output_path, prefix + file_naming + ".dcm"))
+        except Exception as e:
+            logging.error(f"The conversion of the dose to water in medium failed: {e}")
+
+    def _get_resampling_grid(self, dicom_folder) -> Optional[VoxelGrid]:
+        resampling_target = None
+        if hasattr(self, "resampling_target"):
+            resampling_target = self.__getattribute__("resampling_target")
+        if resampling_target is None:
+            return None
+        if isinstance(resampling_target, VoxelGrid):
+            return resampling_target
+        if isinstance(resampling_target, dict):
+            return VoxelGrid.regular(**resampling_target)
+        if resampling_target == "CT":
+            return read_image_series_grid(dicom_folder, "CT")
+        if resampling_target == "TPS":
+            tps_dose_path = find_modality_in_folder("RTDOSE", dicom_folder)
+            if tps_dose_path is None:
+                raise FileNotFoundError(f"No TPS RT Dose in {dicom_folder} to resample the dose on")
+            return VoxelGrid.from_rt_dose(pydicom.dcmread(tps_dose_path, stop_before_pixels=True))
+
+        raise ValueError(f"Unknown resampling target {resampling_target}")
+
+    def resample_dose(self, rt_dose: pydicom.Dataset, target_grid: VoxelGrid) -> np.ndarray:
+        """
+        Resamples the dose of an RT Dose onto target_grid, with resampling_interpolation ("linear", default, or
+        "nearest"). The dose is located through the geometry of the RT Dose, so image_position,
+        image_orientation_patient and the flip of the simulated grid are already accounted for. The voxels of
+        target_grid outside of the RT Dose get 0.
+        """
+        resampling_interpolation = "linear"
+        if hasattr(self, "resampling_interpolation"):
+            resampling_interpolation = self.__getattribute__("resampling_interpolation")
+        nb_of_slices_per_chunk = 8
+        if hasattr(self, "resampling_nb_of_slices_per_chunk"):
+            nb_of_slices_per_chunk = self.__getattribute__("resampling_nb_of_slices_per_chunk")
+
+        source_grid = VoxelGrid.from_rt_dose(rt_dose)
+        dose = get_dose_array(rt_dose)
+        if resampling_interpolation == "linear":
+            return resample_linear(dose, source_grid, target_grid, 0, nb_of_slices_per_chunk)
+        if resampling_interpolation == "nearest":
+            return resample_nearest(dose, source_grid, target_grid, 0)
+
+        raise ValueError(f"Unknown resampling interpolation {resampling_interpolation}")
+
+    def _store_resampled_rt_doses(self, output_path, dicom_folder, dose: RTDoseBuilder, std: Optional[RTDoseBuilder],
+                                  file_naming):
+        """
+        Writes the dose, and its uncertainty, resampled onto the grid of resampling_target as
+        resampled_dose_<file_naming>.dcm and resampled_error_<file_naming>.dcm.
+        """
+        try:
+            target_grid = self._get_resampling_grid(dicom_folder)
+            if target_grid is None:
+                return
+            for rt_dose, prefix in [(dose, "resampled_dose_"), (std, "resampled_error_")]:
+                if rt_dose is None:
+                    continue
+                resampled = resampled_rt_dose(rt_dose.rt_dose, self.resample_dose(rt_dose.rt_dose, target_grid),
+                                              target_grid)
+                resampled.save_as(os.path.join(output_path, prefix + file_naming + ".dcm"))
+        except Exception as e:
+            logging.error(f"The resampling of the dose failed: {e}")
+
+    def _export_training_dataset(self, output_path, dicom_folder, dose: RTDoseBuilder, std: Optional[RTDoseBuilder],
+                                 plan=None):
+        """
+        Writes the CT, the masks of the structures, the MC dose, its uncertainty and the TPS dose, all on the CT
+        grid, in the store of the study in training_dataset_folder, so that a training dataset is read without
+        decoding any DICOM.
+        """
+        training_dataset_folder = None
+        if hasattr(self, "training_dataset_folder"):
+            training_dataset_folder = self.__getattribute__("training_dataset_folder")
+        if training_dataset_folder is None:
+            return
+        training_dataset_chunk_shape = (16, 64, 64)
+        if hasattr(self, "training_dataset_chunk_shape"):
+            training_dataset_chunk_shape = self.__getattribute__("training_dataset_chunk_shape")
+        training_dataset_nb_of_threads = 4
+        if hasattr(self, "training_dataset_nb_of_threads"):
+            training_dataset_nb_of_threads = self.__getattribute__("training_dataset_nb_of_threads")
+
+        try:
+            ct, ct_grid = read_image_series(dicom_folder, "CT")
+            structures = None
+            structure_names = []
+            if plan is not None:
+                roi_names = get_roi_names(pydicom.dcmread(self._get_rt_struct_path(dicom_folder, output_path)))
+                masks = self._get_masks_on_grid(dicom_folder, plan, roi_names, ct_grid)
+                if len(masks) > 0:
+                    structures = np.stack([masks[roi_number] for roi_number in sorted(masks.keys())]).astype(np.uint8)
+                    structure_names = [roi_names[roi_number] for roi_number in sorted(masks.keys())]
+            tps_dose = None
+            tps_dose_path = find_modality_in_folder("RTDOSE", dicom_folder)
+            if tps_dose_path is not None:
+                tps_dose = self.resample_dose(pydicom.dcmread(tps_dose_path), ct_grid).astype(np.float32)
+            uncertainty = None
+            if std is not None:
+                uncertainty = self.resample_dose(std.rt_dose, ct_grid).astype(np.float32)
+
+            os.makedirs(training_dataset_folder, exist_ok=True)
+            write_study_store(training_dataset_folder, os.path.basename(os.path.normpath(output_path)),
+                              {"ct": np.rint(ct).astype(np.int16), "structures": structures,
+                               "dose": self.resample_dose(dose.rt_dose, ct_grid).astype(np.float32),
+                               "uncertainty": uncertainty, "tps_dose": tps_dose},
+                              ct_grid, {"structure_names": structure_names, "dose_units": "GY",
+                                        "study_folder": str(dicom_folder)},
+                              training_dataset_chunk_shape, training_dataset_nb_of_threads)
+        except Exception as e:
+            logging.error(f"The export of the study to the training dataset failed: {e}")
+
+    @staticmethod
+    def _format_pass_rate(rate) -> str:
+        if rate is None:
+            return "no voxel above the dose cutoff"
+        return f"{100 * rate:.2f}%"
+
+    def _compute_dvhs_from_masks(self, rt_dose: pydicom.Dataset, dicom_folder, plan, roi_names: dict,
+                                 dvh_parameters: dict,
+                                 rt_struct: Optional[pydicom.Dataset] = None) -> Tuple[dict, list]:
+        """
+        Computes the DVHs of the ROIs rasterized from the contours of the RT Struct of the study, or of rt_struct
+        when given. The masks, on the CT grid, are resampled once to the dose grid and all the DVHs are
+        computed in a single pass over the dose.
+
+        :return: the DVHs of the ROIs inside the dose grid, and the ROI numbers whose mask has been used
+        """
+        dose_grid = VoxelGrid.from_rt_dose(rt_dose)
+        masks = self._get_masks_on_grid(dicom_folder, plan, roi_names, dose_grid, rt_struct)
+        if len(masks) == 0:
+            return {}, []
+
+        dose = rt_dose.pixel_array.reshape(dose_grid.shape) * float(rt_dose.DoseGridScaling)
+        dvh_dose_limit = dvh_parameters["dvh_dose_limit"]
+        dvh_nb_of_processes = 1
+        if hasattr(self, "dvh_nb_of_processes"):
+            dvh_nb_of_processes = self.__getattribute__("dvh_nb_of_processes")
+        # dvh_dose_limit is in cGy, as for dicompyler-core
+        dvhs = compute_cumulative_dvhs(dose, masks, dose_grid.voxel_volume / 1000,
+                                       limit=None if dvh_dose_limit is None else dvh_dose_limit / 100,
+                                       nb_of_processes=dvh_nb_of_processes)
+        return dvhs, list(masks.keys())
+
+    def _add_dvh_in_memory(self, rt_dose: pydicom.Dataset, dicom_folder, output_path, plan=None):
+        """
+        Computes the DVH of every ROI directly on the RT Dose dataset, without reading it back from the disk. With
+        the "masks" dvh_engine (default), the masks shared by the stages of the study are used, and dicompyler-core only handles the ROIs that could not be rasterized.
+        """
+        rt_struct = pydicom.dcmread(self._get_rt_struct_path(dicom_folder, output_path))
+        dvh_parameters = self._get_dvh_parameters()
+        pixel_spacing = rt_dose.PixelSpacing
+        interpolation_segments = dvh_parameters["dvh_interpolation_segments"]
+        roi_names = get_roi_names(rt_struct)
+        dvh_engine = "masks"
+        if hasattr(self, "dvh_engine"):
+            dvh_engine = self.__getattribute__("dvh_engine")
+        assert dvh_engine in ["masks", "dicompyler"]
+        dvhs = {}
+        masked_roi_numbers = []
+        if dvh_engine == "masks" and plan is not None:
+            dvhs, masked_roi_numbers = self._compute_dvhs_from_masks(rt_dose, dicom_folder, plan, roi_names,
+                                                                     dvh_parameters, rt_struct)
+        for roi_number in roi_names.keys():
+            if roi_number in masked_roi_numbers:
+                continue
+            dvh = dvhcalc.get_dvh(rt_struct, rt_dose, roi_number, limit=dvh_parameters["dvh_dose_limit"],
+                                  calculate_full_volume=dvh_parameters["dvh_calculate_full_volume"],
+                                  use_structure_extents=dvh_parameters["dvh_use_structure_extents"],
+                                  interpolation_resolution=(pixel_spacing[0] / interpolation_segments,
+                                                            pixel_spacing[1] / interpolation_segments),
+                                  interpolation_segments_between_planes=interpolation_segments,
+                                  thickness=None, callback=dvh_parameters["dvh_callback"])
+            if dvh.volume > 0:
+                dvhs[roi_number] = dvh
+        add_dvh_sequence(rt_dose, rt_struct, dvhs, prescription_dose=dvh_parameters["prescription_dose"],
+                         normalization_point=dvh_parameters["dvh_normalization_point"])
+
+    def clean_output(self, initial_file_type: str, input_folder, output_path,
+                     dicom_folder, image_position=None, image_orientation_patient=None,
+                     to_dose_factor=1.0, sr_item_list=None, log_file=None, flipped=False, plan=None,
+                     phantom_media=None):
+        """
+        :param phantom_media: media of the simulated phantom, phantom_media of the meta_data_dict of
+                              InputFileGenerators, needed by the dose to water conversion
+        """
+        assert initial_file_type in ["a3ddose", "binary"]
+        if image_position is None:
+            image_position = [0, 0, 0]
+        if image_orientation_patient is None:
+            image_orientation_patient = [1, 0, 0, 0, 1, 0]
+
+        return self.__getattribute__(initial_file_type)(input_folder, output_path, dicom_folder, image_position,
+                                                        image_orientation_patient, to_dose_factor, sr_item_list,
+                                                        log_file, flipped, plan, phantom_media)
+
+    def _generate_dvh(self, dose_saving_path, dicom_folder, to_dose_factor):
+        rt_struct_path = self._get_rt_struct_path(dicom_folder, os.path.dirname(dose_saving_path))
+        dvh_parameters = self._get_dvh_parameters()
+        dvh_interpolation_segments = dvh_parameters["dvh_interpolation_segments"]
 
         open_rt_dose = pydicom.dcmread(dose_saving_path)
         pixel_spacing = open_rt_dose.PixelSpacing
         generate_and_add_all_dvh_to_dicom(dose_saving_path,
-                                          rt_struct_path, dvh_comment=dvh_comment,
+                                          rt_struct_path, dvh_comment=dvh_parameters["dvh_comment"],
                                           dose_scaling_factor=1.0,
                                           dose_type="PHYSICAL",
                                           contribution_type="INCLUDE",
-                                          prescription_dose=prescription_dose,
-                                          dvh_normalization_point=dvh_normalization_point,
+                                          prescription_dose=dvh_parameters["prescription_dose"],
+                                          dvh_normalization_point=dvh_parameters["dvh_normalization_point"],
                                           saving_path=None,
-                                          limit=dvh_dose_limit,
-                                          calculate_full_volume=dvh_calculate_full_volume,
-                                          use_structure_extents=dvh_use_structure_extents,
+                                          limit=dvh_parameters["dvh_dose_limit"],
+                                          calculate_full_volume=dvh_parameters["dvh_calculate_full_volume"],
+                                          use_structure_extents=dvh_parameters["dvh_use_structure_extents"],
                                           interpolation_resolution=(pixel_spacing[0] / dvh_interpolation_segments,
                                                                     pixel_spacing[1] / dvh_interpolation_segments),
                                           interpolation_segments_between_planes=dvh_interpolation_segments,
                                           thickness=None,
-                                          callback=dvh_callback)
+                                          callback=dvh_parameters["dvh_callback"])
@@ -14,10 +14,31 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 
+import json
 import logging
 import os
+import re
+import shutil
 import subprocess
+import time
 from shutil import copy
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from components.study_schedulers import StudyThreadPoolExecutor
+from utils.disk_cache import DiskCache, file_checksum, make_cache_key
+from utils.dose_files import Dose3D, combine_3ddose_files, merge_topas_binary_files, write_3ddose
+from utils.grids import VoxelGrid
+from utils.tg43 import TG43_ENGINE_VERSION, get_tg43_kernel, superpose_tg43_dose
+
+TOPAS_EXECUTABLE = "/topas/topas/bin/topas"
+TOPAS_CHUNKS_SUMMARY = "topas_chunks_summary.json"
+ADAPTIVE_TARGET_MASK = "adaptive_target_mask.npy"
+SIMULATION_CACHE_VERSION = 1
+# parameters of the runner that do not change the simulated dose
+NON_RESULT_PARAMETERS = ["waiting_time", "egs_launch_delay", "egs_run_root", "keep_egs_run_directory",
+                         "nb_of_concurrent_topas_chunks"]
 
 
 class SimulationRunners:
@@ -26,13 +47,28 @@ class SimulationRunners:
 
         :param input_file_folder:
         :param kwargs: for egs_brachy, kwargs must have nb_treads (int), waiting_time (float) and
-                       egs_brachy_home (str)
+                       egs_brachy_home (str). Each run is done in its own EGS_HOME created in egs_run_root (str,
+                       defaults to the output folder), which is deleted afterward unless keep_egs_run_directory (bool).
+                       egs_brachy_launcher (str) selects how parallel jobs are started, "native" (default) or
+                       "egs-parallel", egs_launch_delay (float) adds a delay between native job launches.
+                       for topas, nb_of_topas_chunks (int) splits the histories in independent runs, seeded from
+                       topas_seed (int), and at most nb_of_concurrent_topas_chunks (int) of them run at the same time.
+                       adaptive (bool) runs the histories in adaptive_nb_of_increments (int) increments and stops once
+                       the mean relative uncertainty in the target is below adaptive_uncertainty_threshold (float).
+                       The target is adaptive_target_structure (str), whose mask on the scoring grid is written in the
+                       input folder by InputFileGenerators, or the adaptive_isodose_fraction (float) isodose without it.
+                       cache_folder (str) memoizes the results of the simulations, keyed by the content of the input
+                       files and of the files they refer to, the runner parameters and the version of the MC code. The
+                       least recently used results are evicted beyond cache_max_size (float, in bytes).
+                       for tg43, the dose is superposed in process from the kernels, in seconds instead of a
+                       simulation, and written as a .3ddose in Gy.
         """
         for key in kwargs.keys():
             self.__setattr__(key, kwargs[key])
 
         self.topas = self._launch_topas
         self.egs_brachy = self._launch_egs_brachy
+        self.tg43 = self._launch_tg43
 
     def _launch_topas(self, input_folder: str, output_folder: str) -> str:
         input_file_path = ""
@@ -41,49 +77,562 @@ class SimulationRunners:
                 input_file_path = os.path.join(input_folder, file_name)
 
         if hasattr(self, "nb_treads"):
-            with open(input_file_path, 'a') as file:
-                file.write(f"\ni:Ts/NumberOfThreads = {self.__getattribute__('nb_treads')}")
-        simulation = subprocess.run(["/topas/topas/bin/topas", input_file_path], capture_output=True)
+            with open(input_file_path) as file:
+                lines = file.read().split("\n")
+            # a resumed study already has the line from its previous run
+            lines = [line for line in lines if re.match(r'^\s*i:Ts/NumberOfThreads\s*=', line) is None]
+            lines.append(f"i:Ts/NumberOfThreads = {self.__getattribute__('nb_treads')}")
+            with open(input_file_path, 'w') as file:
+                file.write("\n".join(lines))
+        nb_of_topas_chunks = 1
+        if hasattr(self, "nb_of_topas_chunks"):
+            nb_of_topas_chunks = self.__getattribute__("nb_of_topas_chunks")
+        if self._is_adaptive():
+            self._launch_topas_chunks(input_file_path, self._get_nb_of_adaptive_increments(), input_folder,
+                                      output_folder, adaptive=True)
+            return output_folder
+        if nb_of_topas_chunks > 1:
+            self._launch_topas_chunks(input_file_path, nb_of_topas_chunks, input_folder, output_folder)
+            return output_folder
+
+        simulation = subprocess.run([TOPAS_EXECUTABLE, input_file_path], capture_output=True)
         self._log_subprocess_output(simulation.stdout)
         self._log_subprocess_output(simulation.stderr)
         return output_folder
 
+    def _write_topas_chunk_input_files(self, input_file_path: str, nb_of_chunks: int,
+                                       chunks_folder: str) -> Tuple[List[Dict], Dict[str, List[str]]]:
+        """
+        Writes one TOPAS input file per chunk, each with its own seed, its share of the histories of every source and
+        its own output files.
+
+        :return: a description of each chunk (input file, number of histories, output files) and, for each original
+                 output file, the output files of the chunks
+        """
+        with open(input_file_path) as file:
+            lines = file.read().split("\n")
+        histories_pattern = re.compile(r'^(\s*i:So/[^=\s]+/NumberOfHistoriesInRun\s*=\s*)(\d+)(.*)$')
+        output_file_pattern = re.compile(r'^(\s*s:Sc/[^=\s]+/OutputFile\s*=\s*")([^"]*)(".*)$')
+        seed_pattern = re.compile(r'^\s*i:Ts/Seed\s*=')
+        if not any(histories_pattern.match(line) for line in lines):
+            raise ValueError(f"No NumberOfHistoriesInRun found in {input_file_path}, the histories can not be split")
+        if not any(output_file_pattern.match(line) for line in lines):
+            raise ValueError(f"No scorer OutputFile found in {input_file_path}, the chunks outputs can not be told apart")
+
+        base_seed = 1
+        if hasattr(self, "topas_seed"):
+            base_seed = self.__getattribute__("topas_seed")
+        input_name = os.path.basename(input_file_path).rsplit(".", 1)[0]
+        chunks = []
+        chunk_outputs = {}
+        for chunk_index in range(nb_of_chunks):
+            chunk_lines = []
+            nb_of_histories = 0
+            output_files = []
+            for line in lines:
+                histories = histories_pattern.match(line)
+                output_file = output_file_pattern.match(line)
+                if histories is not None:
+                    source_histories = int(histories.group(2))
+                    chunk_histories = source_histories // nb_of_chunks + int(
+                        chunk_index < source_histories % nb_of_chunks)
+                    nb_of_histories += chunk_histories
+                    line = f"{histories.group(1)}{chunk_histories}{histories.group(3)}"
+                elif output_file is not None:
+                    chunk_output_file = os.path.join(chunks_folder, f"{os.path.basename(output_file.group(2))}"
+                                                                    f"_chunk{chunk_index}")
+                    chunk_outputs.setdefault(output_file.group(2), []).append(chunk_output_file)
+                    output_files.append(chunk_output_file)
+                    line = f"{output_file.group(1)}{chunk_output_file}{output_file.group(3)}"
+                elif seed_pattern.match(line) is not None:
+                    continue
+                chunk_lines.append(line)
+            chunk_lines.append(f"i:Ts/Seed = {base_seed + chunk_index}")
+            chunk_input_file_path = os.path.join(chunks_folder, f"{input_name}_chunk{chunk_index}.txt")
+            with open(chunk_input_file_path, "w") as file:
+                file.write("\n".join(chunk_lines))
+            chunks.append({"chunk_index": chunk_index, "input_file_path": chunk_input_file_path,
+                           "nb_of_histories": nb_of_histories, "output_files": output_files})
+
+        return chunks, chunk_outputs
+
+    def _run_topas_chunk(self, chunk: Dict, input_folder: str) -> bool:
+        simulation = subprocess.run([TOPAS_EXECUTABLE, chunk["input_file_path"]], capture_output=True,
+                                    cwd=input_folder)
+        self._log_subprocess_output(simulation.stdout)
+        self._log_subprocess_output(simulation.stderr)
+        completed = simulation.returncode == 0 and all(os.path.exists(output_file + ".bin")
+                                                       for output_file in chunk["output_files"])
+        if not completed:
+            logging.error(f"TOPAS chunk {chunk['chunk_index']} did not complete (exit code {simulation.returncode})")
+        return completed
+
+    def _merge_topas_chunks(self, merged_chunks: List[Dict], chunk_outputs: Dict[str, List[str]]) -> Dict:
+        """
+        Merges the outputs of the given chunks where the single run would have written them.
+
+        :return: the merged statistics of each original output file
+        """
+        merged_outputs = {}
+        for output_file, chunk_output_files in chunk_outputs.items():
+            merged_outputs[output_file] = merge_topas_binary_files(
+                [chunk_output_files[chunk["chunk_index"]] + ".bin" for chunk in merged_chunks],
+                [chunk["nb_of_histories"] for chunk in merged_chunks],
+                output_file + ".bin")
+
+        return merged_outputs
+
+    def _run_topas_chunks_adaptively(self, chunks: List[Dict], chunk_outputs: Dict[str, List[str]],
+                                     input_folder: str) -> Tuple[List[Dict], float]:
+        """
+        Runs the chunks one after the other, merging the completed ones after each, until the mean relative
+        uncertainty in the target is below adaptive_uncertainty_threshold or every chunk has been run.
+        """
+        target_mask = self._load_adaptive_target_mask(input_folder)
+        merged_chunks = []
+        mean_relative_uncertainty = np.nan
+        for chunk in chunks:
+            if not self._run_topas_chunk(chunk, input_folder):
+                continue
+            merged_chunks.append(chunk)
+            merged_outputs = self._merge_topas_chunks(merged_chunks, chunk_outputs)
+            merged = merged_outputs[sorted(merged_outputs.keys())[0]]
+            if "Standard_Deviation" not in merged:
+                raise ValueError("The adaptive mode needs the Standard_Deviation to be scored")
+            nb_of_histories = sum(merged_chunk["nb_of_histories"] for merged_chunk in merged_chunks)
+            # relative uncertainty on the Sum from the per-history standard deviation
+            relative_uncertainty = np.divide(merged["Standard_Deviation"] * np.sqrt(nb_of_histories), merged["Sum"],
+                                             out=np.ones_like(merged["Sum"]), where=merged["Sum"] > 0)
+            mean_relative_uncertainty = self._mean_relative_uncertainty_in_target(merged["Sum"],
+                                                                                  relative_uncertainty, target_mask)
+            if self._adaptive_target_is_reached(mean_relative_uncertainty, f"{nb_of_histories} histories"):
+                break
+
+        return merged_chunks, mean_relative_uncertainty
+
+    def _launch_topas_chunks(self, input_file_path: str, nb_of_chunks: int, input_folder: str, output_folder: str,
+                             adaptive: bool = False):
+        """
+        Splits the histories of the study in nb_of_chunks independent TOPAS runs with distinct seeds, runs them
+        concurrently (at most nb_of_concurrent_topas_chunks at a time) and merges their binary outputs where the
+        single run would have written them. In adaptive mode, the chunks are instead the increments of
+        _run_topas_chunks_adaptively. The chunks that did not complete or were not needed are left out of the merge,
+        and the fraction of the histories actually merged is saved in TOPAS_CHUNKS_SUMMARY so that the dose can be
+        normalized accordingly.
+        """
+        chunks_folder = os.path.join(input_folder, "topas_chunks")
+        os.makedirs(chunks_folder, exist_ok=True)
+        chunks, chunk_outputs = self._write_topas_chunk_input_files(input_file_path, nb_of_chunks, chunks_folder)
+        mean_relative_uncertainty = None
+        if adaptive:
+            merged_chunks, mean_relative_uncertainty = self._run_topas_chunks_adaptively(chunks, chunk_outputs,
+                                                                                         input_folder)
+        else:
+            nb_of_concurrent_chunks = nb_of_chunks
+            if hasattr(self, "nb_of_concurrent_topas_chunks"):
+                nb_of_concurrent_chunks = self.__getattribute__("nb_of_concurrent_topas_chunks")
+            with StudyThreadPoolExecutor(max_workers=nb_of_concurrent_chunks) as executor:
+                completed = list(executor.map(lambda chunk: self._run_topas_chunk(chunk, input_folder), chunks))
+            merged_chunks = [chunk for chunk, chunk_completed in zip(chunks, completed) if chunk_completed]
+            if len(merged_chunks) > 0:
+                self._merge_topas_chunks(merged_chunks, chunk_outputs)
+        if len(merged_chunks) == 0:
+            raise RuntimeError(f"None of the {nb_of_chunks} TOPAS chunks of {input_file_path} completed")
+
+        histories_fraction = sum(chunk["nb_of_histories"] for chunk in merged_chunks) / sum(
+            chunk["nb_of_histories"] for chunk in chunks)
+        if histories_fraction < 1 and not adaptive:
+            logging.warning(f"Only {len(merged_chunks)}/{nb_of_chunks} TOPAS chunks were merged")
+        with open(os.path.join(output_folder, TOPAS_CHUNKS_SUMMARY), "w") as file:
+            json.dump({"nb_of_chunks": nb_of_chunks,
+                       "merged_chunks": [chunk["chunk_index"] for chunk in merged_chunks],
+                       "histories_fraction": histories_fraction,
+                       "mean_relative_uncertainty": mean_relative_uncertainty}, file)
+
+    def _is_adaptive(self) -> bool:
+        if hasattr(self, "adaptive"):
+            return bool(self.__getattribute__("adaptive"))
+        return False
+
+    def _get_nb_of_adaptive_increments(self) -> int:
+        if hasattr(self, "adaptive_nb_of_increments"):
+            return max(1, int(self.__getattribute__("adaptive_nb_of_increments")))
+        return 10
+
+    def _get_adaptive_isodose_fraction(self) -> float:
+        if hasattr(self, "adaptive_isodose_fraction"):
+            return self.__getattribute__("adaptive_isodose_fraction")
+        return 0.1
+
+    def _load_adaptive_target_mask(self, input_folder: str):
+        target_mask_path = os.path.join(input_folder, ADAPTIVE_TARGET_MASK)
+        if os.path.exists(target_mask_path):
+            target_mask = np.load(target_mask_path).astype(bool)
+            logging.info(f"Adaptive target of {int(np.count_nonzero(target_mask))} voxels read from {target_mask_path}")
+            return target_mask
+        target_structure = None
+        if hasattr(self, "adaptive_target_structure"):
+            target_structure = self.__getattribute__("adaptive_target_structure")
+        logging.warning(f"No mask of the adaptive target {target_structure} in {input_folder}, the target is the "
+                        f"{self._get_adaptive_isodose_fraction()} isodose instead")
+        return None
+
+    def _mean_relative_uncertainty_in_target(self, dose: np.ndarray, relative_uncertainty: np.ndarray,
+                                             target_mask) -> float:
+        """
+        Mean relative uncertainty in the target. The target is the mask saved as ADAPTIVE_TARGET_MASK in the input
+        folder when there is one, in the scoring grid with shape (nz, ny, nx). Otherwise, it is the region receiving
+        more than adaptive_isodose_fraction (defaults to 0.1) of the 99th percentile of the dose.
+        """
+        dose = dose.ravel()
+        relative_uncertainty = relative_uncertainty.ravel()
+        if target_mask is not None and target_mask.size != dose.size:
+            logging.warning(f"The adaptive target mask has {target_mask.size} voxels and the scored dose {dose.size}, "
+                            f"the target is the {self._get_adaptive_isodose_fraction()} isodose instead")
+            target_mask = None
+        if target_mask is not None:
+            in_target = target_mask.ravel()
+        else:
+            if not np.any(dose > 0):
+                return np.inf
+            in_target = dose >= self._get_adaptive_isodose_fraction() * np.percentile(dose[dose > 0], 99)
+        if not np.any(in_target):
+            return np.inf
+
+        return float(np.mean(relative_uncertainty[in_target]))
+
+    def _adaptive_target_is_reached(self, mean_relative_uncertainty: float, progress: str) -> bool:
+        uncertainty_threshold = 0.02
+        if hasattr(self, "adaptive_uncertainty_threshold"):
+            uncertainty_threshold = self.__getattribute__("adaptive_uncertainty_threshold")
+        logging.info(f"Mean relative uncertainty in the target after {progress}: "
+                     f"{mean_relative_uncertainty:.4f} (target {uncertainty_threshold})")
+        return mean_relative_uncertainty <= uncertainty_threshold
+
     def _log_subprocess_output(self, pipe):
         for line in pipe.decode("utf-8").split("\n"):
             logging.info('got line from subprocess: %r', line)
 
+    def _prepare_egs_brachy_run_directory(self, input_file_path: str, output_folder: str) -> Tuple[str, str]:
+        """
+        Builds an EGS_HOME private to this run, containing only the egs_brachy application folder with the input file
+        and links to the shared libraries of egs_brachy_home. Concurrent runs then never share their input, output or
+        temporary files.
+
+        :return: the run EGS_HOME and the egs_brachy application folder within it
+        """
+        egs_brachy_home = os.path.normpath(self.__getattribute__("egs_brachy_home"))
+        run_root = output_folder
+        if hasattr(self, "egs_run_root"):
+            run_root = self.__getattribute__("egs_run_root")
+        input_name = os.path.basename(input_file_path).replace(".egsinp", "")
+        run_egs_home = os.path.join(run_root, f"egs_run_{input_name}")
+        if os.path.exists(run_egs_home):
+            shutil.rmtree(run_egs_home)
+        run_directory = os.path.join(run_egs_home, os.path.basename(egs_brachy_home))
+        os.makedirs(run_directory)
+        for shared_folder in ["lib"]:
+            if os.path.exists(os.path.join(egs_brachy_home, shared_folder)):
+                os.symlink(os.path.join(egs_brachy_home, shared_folder), os.path.join(run_directory, shared_folder))
+        copy(input_file_path, os.path.join(run_directory, os.path.basename(input_file_path)))
+        return run_egs_home, run_directory
+
+    def _run_egs_brachy_jobs(self, file_name_no_ext: str, job_indices: List[int], nb_of_jobs: int,
+                             run_directory: str, run_environment: dict) -> List[int]:
+        """
+        Starts the given egs_brachy parallel jobs directly instead of going through egs-parallel and the batch
+        system. The jobs are run in simple-run mode (no job control file), so each simulates 1/nb_of_jobs of the
+        histories with its own seeds, and they are waited on as they exit.
+
+        :return: the indices of the jobs that completed
+        """
+        launch_delay = 0
+        if hasattr(self, "egs_launch_delay"):
+            launch_delay = self.__getattribute__("egs_launch_delay")
+        jobs = []
+        for job_index in job_indices:
+            job_output_path = os.path.join(run_directory, f"{file_name_no_ext}_job{job_index}.out")
+            with open(job_output_path, "wb") as job_output:
+                process = subprocess.Popen(["egs_brachy", "-i", file_name_no_ext, "-s", "-P", str(nb_of_jobs),
+                                            "-j", str(job_index)],
+                                           stdout=job_output, stderr=subprocess.STDOUT, cwd=run_directory,
+                                           env=run_environment)
+            jobs.append((job_index, process, job_output_path))
+            if launch_delay > 0 and job_index != job_indices[-1]:
+                time.sleep(launch_delay)
+
+        completed_jobs = []
+        for job_index, process, job_output_path in jobs:
+            return_code = process.wait()
+            with open(job_output_path, "rb") as job_output:
+                self._log_subprocess_output(job_output.read())
+            if return_code != 0:
+                logging.error(f"egs_brachy job {job_index}/{nb_of_jobs} exited with code {return_code}")
+            else:
+                completed_jobs.append(job_index)
+
+        return completed_jobs
+
+    def _combine_egs_brachy_jobs(self, file_name_no_ext: str, job_indices: List[int], nb_of_jobs: int,
+                                 run_directory: str) -> Dict[str, Dose3D]:
+        """
+        Combines the per-job .3ddose files of the given jobs in the .3ddose file a single run would have written.
+
+        :return: the combined dose of each output file
+        """
+        job_output_pattern = re.compile(rf"^{re.escape(file_name_no_ext)}_w(\d+)(\..*)?\.3ddose$")
+        job_3ddose_files = {}
+        for file_name in sorted(os.listdir(run_directory)):
+            match = job_output_pattern.match(file_name)
+            if match is not None and int(match.group(1)) in job_indices:
+                combined_file_name = f"{file_name_no_ext}{match.group(2) or ''}.3ddose"
+                job_3ddose_files.setdefault(combined_file_name, []).append(os.path.join(run_directory, file_name))
+        if len(job_3ddose_files) == 0:
+            raise RuntimeError(f"None of the {nb_of_jobs} egs_brachy jobs of {file_name_no_ext} produced a dose")
+
+        combined_doses = {}
+        for combined_file_name, file_paths in job_3ddose_files.items():
+            if len(file_paths) < nb_of_jobs:
+                logging.warning(f"Only {len(file_paths)}/{nb_of_jobs} egs_brachy jobs are combined in "
+                                f"{combined_file_name}")
+            combined_doses[combined_file_name] = combine_3ddose_files(file_paths,
+                                                                      os.path.join(run_directory, combined_file_name))
+
+        return combined_doses
+
+    def _run_egs_brachy_parallel_jobs(self, file_name_no_ext: str, nb_of_jobs: int, run_directory: str,
+                                      run_environment: dict):
+        job_indices = list(range(1, nb_of_jobs + 1))
+        completed_jobs = self._run_egs_brachy_jobs(file_name_no_ext, job_indices, nb_of_jobs, run_directory,
+                                                   run_environment)
+        self._combine_egs_brachy_jobs(file_name_no_ext, completed_jobs, nb_of_jobs, run_directory)
+
+    def _run_egs_brachy_adaptively(self, file_name_no_ext: str, nb_of_parallel_jobs: int, input_folder: str,
+                                   run_directory: str, run_environment: dict):
+        """
+        Splits the histories in adaptive_nb_of_increments jobs, run by groups of nb_of_parallel_jobs. After each
+        group, the completed jobs are combined and the run stops once the mean relative uncertainty in the target is
+        below adaptive_uncertainty_threshold. Since the 3ddose is a dose per history, no normalization is needed
+        when stopping early.
+        """
+        nb_of_increments = self._get_nb_of_adaptive_increments()
+        target_mask = self._load_adaptive_target_mask(input_folder)
+        nb_of_parallel_jobs = max(1, nb_of_parallel_jobs)
+        completed_jobs = []
+        for first_job in range(1, nb_of_increments + 1, nb_of_parallel_jobs):
+            job_indices = list(range(first_job, min(first_job + nb_of_parallel_jobs, nb_of_increments + 1)))
+            completed_jobs += self._run_egs_brachy_jobs(file_name_no_ext, job_indices, nb_of_increments,
+                                                        run_directory, run_environment)
+            if len(completed_jobs) == 0:
+                continue
+            combined_doses = self._combine_egs_brachy_jobs(file_name_no_ext, completed_jobs, len(completed_jobs),
+                                                           run_directory)
+            combined_dose = combined_doses[sorted(combined_doses.keys())[0]]
+            mean_relative_uncertainty = self._mean_relative_uncertainty_in_target(combined_dose.dose,
+                                                                                  combined_dose.uncertainty,
+                                                                                  target_mask)
+            if self._adaptive_target_is_reached(mean_relative_uncertainty,
+                                                f"{len(completed_jobs)}/{nb_of_increments} increments"):
+                break
+        if len(completed_jobs) == 0:
+            raise RuntimeError(f"None of the egs_brachy increments of {file_name_no_ext} completed")
+
+    def _find_egs_brachy_output(self, run_directory: str, file_name_no_ext: str) -> str:
+        job_output_pattern = re.compile(rf"^{re.escape(file_name_no_ext)}_w\d+")
+        output_3ddose_file_names = sorted(file_name for file_name in os.listdir(run_directory)
+                                          if file_name.startswith(file_name_no_ext) and file_name.endswith(".3ddose")
+                                          and job_output_pattern.match(file_name) is None)
+        if len(output_3ddose_file_names) == 0:
+            raise FileNotFoundError(f"egs_brachy did not produce any .3ddose file in {run_directory}")
+        if len(output_3ddose_file_names) > 1:
+            logging.warning(f"Many .3ddose files found for {file_name_no_ext}, using {output_3ddose_file_names[0]}")
+
+        return output_3ddose_file_names[0]
+
     def _launch_egs_brachy(self, input_folder: str, output_folder: str) -> str:
         nb_treads = self.__getattribute__("nb_treads")
         waiting_time = self.__getattribute__("waiting_time")
         bash_command = fr"""egs-parallel -v -n {nb_treads} -f -d {waiting_time} -c"""
         input_file_path = ""
         input_name = ""
-        for file_name in os.listdir(input_folder):
+        for file_name in sorted(os.listdir(input_folder)):
             if file_name.endswith(".egsinp"):
                 input_file_path = os.path.join(input_folder, file_name)
                 input_name = file_name
-        copy(input_file_path, os.path.join(self.__getattribute__("egs_brachy_home"), input_name))
+        run_egs_home, run_directory = self._prepare_egs_brachy_run_directory(input_file_path, output_folder)
+        run_environment = dict(os.environ, EGS_HOME=os.path.join(run_egs_home, ""))
         splited_bash = bash_command.split()
         file_name_no_ext = input_name.replace(".egsinp", "")
         splited_bash.append(fr"egs_brachy -i {file_name_no_ext}")
-        if nb_treads == 0:
+        egs_brachy_launcher = "native"
+        if hasattr(self, "egs_brachy_launcher"):
+            egs_brachy_launcher = self.__getattribute__("egs_brachy_launcher")
+        assert egs_brachy_launcher in ["native", "egs-parallel"]
+        if self._is_adaptive():
+            self._run_egs_brachy_adaptively(file_name_no_ext, nb_treads, input_folder, run_directory,
+                                            run_environment)
+            simulation = None
+        elif nb_treads == 0:
             bash_command = fr"egs_brachy -i {file_name_no_ext}"
             splited_bash = bash_command.split()
-            simulation = subprocess.run(splited_bash, capture_output=True)
+            simulation = subprocess.run(splited_bash, capture_output=True, cwd=run_directory, env=run_environment)
+        elif egs_brachy_launcher == "native":
+            self._run_egs_brachy_parallel_jobs(file_name_no_ext, nb_treads, run_directory, run_environment)
+            simulation = None
         else:
-            simulation = subprocess.run(splited_bash, capture_output=True)
-        self._log_subprocess_output(simulation.stdout)
-        self._log_subprocess_output(simulation.stderr)
-        output_3ddose_file_name = ""
-        for file_name in os.listdir(self.__getattribute__("egs_brachy_home")):
-            if file_name.endswith(".3ddose"):
-                output_3ddose_file_name = file_name
-
-        copy(os.path.join(self.__getattribute__("egs_brachy_home"), output_3ddose_file_name),
+            simulation = subprocess.run(splited_bash, capture_output=True, cwd=run_directory, env=run_environment)
+        if simulation is not None:
+            self._log_subprocess_output(simulation.stdout)
+            self._log_subprocess_output(simulation.stderr)
+        output_3ddose_file_name = self._find_egs_brachy_output(run_directory, file_name_no_ext)
+        copy(os.path.join(run_directory, output_3ddose_file_name),
              os.path.join(output_folder, output_3ddose_file_name))
+        for file_name in os.listdir(run_directory):
+            if file_name.startswith(file_name_no_ext) and file_name.endswith(".egslog"):
+                copy(os.path.join(run_directory, file_name), os.path.join(output_folder, file_name))
+
+        keep_egs_run_directory = False
+        if hasattr(self, "keep_egs_run_directory"):
+            keep_egs_run_directory = self.__getattribute__("keep_egs_run_directory")
+        if not keep_egs_run_directory:
+            shutil.rmtree(run_egs_home)
+
+        return output_folder
 
+    def _launch_tg43(self, input_folder: str, output_folder: str) -> str:
+        """
+        Superposes the TG-43 kernel of the seed model at every seed of the tg43_*.json written by InputFileGenerators
+        and writes the total dose, in Gy, as a .3ddose without uncertainty, for the a3ddose output cleaner.
+        """
+        input_file_names = [file_name for file_name in sorted(os.listdir(input_folder))
+                            if file_name.startswith("tg43_") and file_name.endswith(".json")]
+        if len(input_file_names) == 0:
+            raise FileNotFoundError(f"No TG-43 superposition input found in {input_folder}")
+        with open(os.path.join(input_folder, input_file_names[0])) as file:
+            tg43_input = json.load(file)
+        grid_parameters = tg43_input["grid"]
+        grid = VoxelGrid.regular(grid_parameters["origin"], grid_parameters["pixel_spacing"],
+                                 grid_parameters["slice_thickness"], grid_parameters["shape"],
+                                 grid_parameters.get("image_orientation_patient", [1, 0, 0, 0, 1, 0]))
+        kernel = get_tg43_kernel(tg43_input["kernel_path"], tg43_input["air_kerma_strength_per_history"])
+        seeds = tg43_input["seeds"]
+        start = time.time()
+        dose = superpose_tg43_dose(kernel, grid, np.asarray(seeds["positions"]).reshape((-1, 3)),
+                                   np.asarray(seeds["directions"]).reshape((-1, 3)), seeds["air_kerma_strengths"],
+                                   seeds["half_lives"])
+        logging.info(f"TG-43 superposition of {len(seeds['air_kerma_strengths'])} seeds done in "
+                     f"{time.time() - start:.1f} s")
+
+        # voxel boundaries in cm, z, y, x, the cleaners only using their spacing
+        spacings = [grid_parameters["slice_thickness"]] + list(grid_parameters["pixel_spacing"])
+        positions = [(np.arange(size + 1) - 0.5) * spacing / 10 for size, spacing in zip(grid.shape, spacings)]
+        output_name = input_file_names[0].replace(".json", ".3ddose")
+        write_3ddose(os.path.join(output_folder, output_name), Dose3D(positions, dose, np.full(dose.shape, np.nan)))
         return output_folder
 
+    @staticmethod
+    def _get_executable_identity(code: str) -> List:
+        if code == "tg43":
+            return [code, TG43_ENGINE_VERSION]
+        executable_path = TOPAS_EXECUTABLE if code == "topas" else shutil.which("egs_brachy")
+        if executable_path is None or not os.path.exists(executable_path):
+            return [code, None]
+        # a rebuilt or updated code changes the results even with the same inputs
+        stat = os.stat(os.path.realpath(executable_path))
+        return [code, os.path.realpath(executable_path), stat.st_size, stat.st_mtime_ns]
+
+    def _get_simulation_cache_key(self, code: str, input_folder: str, output_folder: str) -> str:
+        """
+        The input files are hashed with the study folders replaced by placeholders, so that the same inputs generated
+        for another output folder share the results. The files they refer to by absolute path (phantoms, seed
+        geometries, spectra, Muen.dat) are hashed by content. The seeds being part of the input files, a run with
+        another seed is another entry.
+        """
+        path_pattern = re.compile(r'/[^\s"\',;=]+')
+        threads_pattern = re.compile(r'^\s*i:Ts/NumberOfThreads\s*=.*$', re.MULTILINE)
+        input_files = {}
+        referenced_files = {}
+        for file_name in sorted(os.listdir(input_folder)):
+            file_path = os.path.join(input_folder, file_name)
+            if not os.path.isfile(file_path):
+                continue
+            try:
+                with open(file_path) as file:
+                    content = file.read()
+            except UnicodeDecodeError:
+                input_files[file_name] = file_checksum(file_path)
+                continue
+            for path in path_pattern.findall(content):
+                if os.path.isfile(path) and not path.startswith(input_folder) and path not in referenced_files:
+                    referenced_files[path] = file_checksum(path)
+            # added by the runner itself, nb_treads being part of the parameters
+            content = threads_pattern.sub("", content)
+            input_files[file_name] = content.replace(input_folder, "<input_folder>").replace(output_folder,
+                                                                                          "<output_folder>")
+        parameters = {key: value for key, value in self.__dict__.items()
+                      if not callable(value) and not key.startswith("cache_") and key not in NON_RESULT_PARAMETERS}
+        referenced_files = {path.replace(input_folder, "<input_folder>").replace(output_folder, "<output_folder>"):
+                            checksum for path, checksum in referenced_files.items()}
+        return make_cache_key("simulation", SIMULATION_CACHE_VERSION, self._get_executable_identity(code), parameters,
+                              input_files, referenced_files)
+
+    @staticmethod
+    def _list_result_files(output_folder: str, input_file_paths: List[str]) -> Dict[str, Tuple[int, int]]:
+        result_files = {}
+        for file_name in os.listdir(output_folder):
+            file_path = os.path.join(output_folder, file_name)
+            # neither the inputs, which the runners modify, nor the logs of the study are part of the results
+            if not os.path.isfile(file_path) or file_path in input_file_paths \
+                    or os.path.splitext(file_name)[1] in [".log", ".logs"]:
+                continue
+            stat = os.stat(file_path)
+            result_files[file_name] = (stat.st_size, stat.st_mtime_ns)
+
+        return result_files
+
+    def _launch_simulation_with_cache(self, code: str, input_folder: str, output_folder: str) -> str:
+        """
+        Returns the cached results when the same simulation has already been done, otherwise runs it and stores the
+        files it created or modified in the output folder. The results are copied rather than linked, since the
+        runners overwrite their outputs in place when a simulation is launched again in the same folder.
+        """
+        cache_max_size = None
+        if hasattr(self, "cache_max_size"):
+            cache_max_size = self.__getattribute__("cache_max_size")
+        cache = DiskCache(self.__getattribute__("cache_folder"), cache_max_size)
+        key = self._get_simulation_cache_key(code, input_folder, output_folder)
+        entry_folder = cache.get(key)
+        if entry_folder is not None:
+            copied_files = []
+            try:
+                for file_name in os.listdir(entry_folder):
+                    copy(os.path.join(entry_folder, file_name), os.path.join(output_folder, file_name))
+                    copied_files.append(file_name)
+                logging.info(f"Results of {input_folder} found in the simulation cache ({key[:12]}), {code} is not "
+                             f"launched")
+                return output_folder
+            except OSError as e:
+                # the entry was evicted by another process while being copied, the partial results are discarded
+                logging.warning(f"Simulation cache entry {key[:12]} could not be restored, {code} is launched: {e}")
+                for file_name in copied_files:
+                    os.remove(os.path.join(output_folder, file_name))
+
+        input_file_paths = [os.path.join(input_folder, file_name) for file_name in os.listdir(input_folder)]
+        files_before_simulation = self._list_result_files(output_folder, input_file_paths)
+        simulation_output_folder = self.__getattribute__(code)(input_folder, output_folder)
+        result_files = [file_name for file_name, stat in
+                        self._list_result_files(output_folder, input_file_paths).items()
+                        if files_before_simulation.get(file_name) != stat]
+
+        def populate(folder: str):
+            for file_name in result_files:
+                copy(os.path.join(output_folder, file_name), os.path.join(folder, file_name))
+
+        cache.put(key, populate)
+        return simulation_output_folder
+
     def launch_simulation(self, code: str, input_folder: str, output_folder: str):
-        assert code in ["topas", "egs_brachy"]
+        assert code in ["topas", "egs_brachy", "tg43"]
+        if hasattr(self, "cache_folder") and self.__getattribute__("cache_folder") is not None:
+            return self._launch_simulation_with_cache(code, input_folder, output_folder)
         return self.__getattribute__(code)(input_folder, output_folder)
@@ -0,0 +1,273 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, List
+
+LOG_FORMAT = '[%(asctime)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s'
+LOG_DATE_FORMAT = '%H:%M:%S'
+
+_current_study = threading.local()
+
+
+class _StudyLogFilter(logging.Filter):
+    def __init__(self, log_file: str):
+        super().__init__()
+        self.log_file = log_file
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return getattr(_current_study, "log_file", None) == self.log_file
+
+
+@contextmanager
+def current_study(log_file: str):
+    """
+    Marks the calling thread as working on the study associated to log_file, so that the records it emits are sent
+    to that study's log file only.
+
+    :param log_file: path to the log file of the study
+    """
+    previous_log_file = getattr(_current_study, "log_file", None)
+    _current_study.log_file = log_file
+    try:
+        yield
+    finally:
+        _current_study.log_file = previous_log_file
+
+
+class StudyThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor whose workers log in the study of the thread that submitted each task, since the study is
+    marked per thread and the records of helper threads would otherwise be dropped by the study log filters.
+    """
+
+    def submit(self, function, *args, **kwargs):
+        log_file = getattr(_current_study, "log_file", None)
+
+        def run_in_study():
+            with current_study(log_file):
+                return function(*args, **kwargs)
+
+        return super().submit(run_in_study)
+
+
+def _open_study_log(log_file: str) -> logging.Handler:
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    handler = logging.FileHandler(log_file)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+    handler.addFilter(_StudyLogFilter(log_file))
+    logging.getLogger().addHandler(handler)
+    return handler
+
+
+def _close_study_log(handler: logging.Handler):
+    logging.getLogger().removeHandler(handler)
+    handler.close()
+
+
+@contextmanager
+def study_logging(log_file: str):
+    """
+    Sends every log record emitted by the calling thread while the context is active to the log file of the study.
+    The handler is removed on exit so that a worker reused for another study does not keep writing in the previous
+    log file.
+
+    :param log_file: path to the log file of the study
+    """
+    handler = _open_study_log(log_file)
+    try:
+        with current_study(log_file):
+            yield handler
+    finally:
+        _close_study_log(handler)
+
+
+def _initialize_worker_logging():
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    if not root_logger.handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT))
+        root_logger.addHandler(stream_handler)
+
+
+def summarize_study(study_context: Dict, status: str) -> Dict:
+    return {"patient": study_context.get("patient"), "study": study_context.get("study"),
+            "study_path": study_context["study_path"], "final_output_folder": study_context.get("final_output_folder"),
+            "status": status}
+
+
+def _run_stage(stage: Callable, study_context: Dict):
+    """
+    Runs one stage on a study and converts its errors in a status, so that one study never stops the batch.
+
+    :return: None when the stage succeeded, the status of the study otherwise
+    """
+    try:
+        stage(study_context)
+    except NotImplementedError:
+        logging.warning("This study has been ignored because seed model is not implemented")
+        return "ignored"
+    except Exception:
+        logging.exception(f"The recalculation of {study_context['study_path']} failed")
+        return "failed"
+
+    return None
+
+
+def run_study_stages(study_context: Dict, stages: List[Callable]) -> Dict:
+    """
+    Runs every stage on one study, with its own log file and error boundary.
+
+    :param study_context: dictionary describing the study, must at least contain study_path and log_file
+    :param stages: callables receiving the study context, in the order they have to be run
+    :return: summary of the study with its status ("completed", "ignored" or "failed")
+    """
+    with study_logging(study_context["log_file"]):
+        for stage in stages:
+            status = _run_stage(stage, study_context)
+            if status is not None:
+                return summarize_study(study_context, status)
+
+    return summarize_study(study_context, "completed")
+
+
+class StudySchedulers:
+    def __init__(self, **kwargs):
+        """
+
+        :param kwargs: nb_of_concurrent_studies (int), number of studies processed at the same time by the
+                       process_pool scheduler. Defaults to the number of cores divided by nb_of_threads_per_study
+                       (int, defaults to 1).
+                       stage_workers (list of int), number of threads working on each stage for the pipelined
+                       scheduler. Defaults to one thread per stage.
+                       queue_size (int), number of studies that can wait between two stages of the pipelined
+                       scheduler. Defaults to 1.
+        """
+        for key in kwargs.keys():
+            self.__setattr__(key, kwargs[key])
+
+        self.sequential = self._run_sequentially
+        self.process_pool = self._run_in_process_pool
+        self.pipelined = self._run_pipelined
+
+    def _get_nb_of_concurrent_studies(self) -> int:
+        if hasattr(self, "nb_of_concurrent_studies"):
+            return max(1, int(self.__getattribute__("nb_of_concurrent_studies")))
+        nb_of_threads_per_study = 1
+        if hasattr(self, "nb_of_threads_per_study"):
+            nb_of_threads_per_study = max(1, int(self.__getattribute__("nb_of_threads_per_study")))
+
+        return max(1, (os.cpu_count() or 1) // nb_of_threads_per_study)
+
+    def _run_sequentially(self, study_contexts: List[Dict], stages: List[Callable]) -> List[Dict]:
+        return [run_study_stages(study_context, stages) for study_context in study_contexts]
+
+    def _run_in_process_pool(self, study_contexts: List[Dict], stages: List[Callable]) -> List[Dict]:
+        nb_of_concurrent_studies = self._get_nb_of_concurrent_studies()
+        logging.info(f"Processing {len(study_contexts)} studies with {nb_of_concurrent_studies} concurrent workers")
+        results = []
+        with ProcessPoolExecutor(max_workers=nb_of_concurrent_studies,
+                                 initializer=_initialize_worker_logging) as executor:
+            futures = {executor.submit(partial(run_study_stages, stages=stages), study_context): study_context
+                       for study_context in study_contexts}
+            for future in as_completed(futures):
+                study_context = futures[future]
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    # Only reached when the worker itself dies (ex. killed by the OS), since run_study_stages
+                    # catches the errors of its own study.
+                    logging.error(f"Worker crashed while processing {study_context['study_path']}: {e}")
+                    results.append(summarize_study(study_context, "crashed"))
+
+        return results
+
+    def _run_pipelined(self, study_contexts: List[Dict], stages: List[Callable]) -> List[Dict]:
+        """
+        Every stage has its own worker threads and a bounded queue in front of it, so that the studies flow from one
+        stage to the next. While a study is in the simulation stage (which only waits on the MC subprocess), the
+        following studies are extracted and have their input files generated, and the previous ones are converted to
+        DICOM.
+        """
+        stage_workers = [1] * len(stages)
+        if hasattr(self, "stage_workers"):
+            stage_workers = [max(1, int(nb_of_workers)) for nb_of_workers in self.__getattribute__("stage_workers")]
+        assert len(stage_workers) == len(stages)
+        queue_size = 1
+        if hasattr(self, "queue_size"):
+            queue_size = max(1, int(self.__getattribute__("queue_size")))
+
+        stage_queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        log_handlers = {}
+        results = []
+        results_lock = threading.Lock()
+
+        def finish_study(study_context: Dict, status: str):
+            with results_lock:
+                results.append(summarize_study(study_context, status))
+                handler = log_handlers.pop(study_context["log_file"])
+            _close_study_log(handler)
+
+        def stage_worker(stage_index: int):
+            is_last_stage = stage_index == len(stages) - 1
+            while True:
+                study_context = stage_queues[stage_index].get()
+                if study_context is None:
+                    return
+                if stage_index == 0:
+                    handler = _open_study_log(study_context["log_file"])
+                    with results_lock:
+                        log_handlers[study_context["log_file"]] = handler
+                with current_study(study_context["log_file"]):
+                    status = _run_stage(stages[stage_index], study_context)
+                if status is not None:
+                    finish_study(study_context, status)
+                elif is_last_stage:
+                    finish_study(study_context, "completed")
+                else:
+                    stage_queues[stage_index + 1].put(study_context)
+
+        logging.info(f"Processing {len(study_contexts)} studies in a pipeline of {len(stages)} stages "
+                     f"with {stage_workers} workers")
+        stage_threads = []
+        for stage_index, nb_of_workers in enumerate(stage_workers):
+            threads = [threading.Thread(target=stage_worker, args=(stage_index,), daemon=True,
+                                        name=f"stage_{stage_index}_worker_{worker_index}")
+                       for worker_index in range(nb_of_workers)]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+
+        for study_context in study_contexts:
+            stage_queues[0].put(study_context)
+        for stage_index, threads in enumerate(stage_threads):
+            for _ in threads:
+                stage_queues[stage_index].put(None)
+            for thread in threads:
+                thread.join()
+
+        return results
+
+    def run_studies(self, scheduler: str, study_contexts: List[Dict], stages: List[Callable]) -> List[Dict]:
+        assert scheduler in ["sequential", "process_pool", "pipelined"]
+        return self.__getattribute__(scheduler)(study_contexts, stages)
@@ -0,0 +1,34 @@
+import csv
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.cohort_table import COHORT_TABLE_COLUMNS, append_cohort_rows
+
+
+def _rows(study: str, computed_at: str) -> list:
+    return [{"study": study, "computed_at": computed_at, "dose_source": "MC", "structure": structure,
+             "metric": "D90", "value": 145.0, "unit": "Gy"} for structure in ["prostate", "rectum"]]
+
+
+def _read(table_path: str) -> list:
+    with open(table_path, newline="") as file:
+        return list(csv.reader(file))
+
+
+def test_rows_of_the_studies_are_appended_under_a_single_header(tmp_path):
+    table_path = str(tmp_path / "cohort" / "metrics.csv")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda index: append_cohort_rows(table_path, _rows(f"study_{index}", "2026-01-01")),
+                          range(16)))
+    append_cohort_rows(table_path, [])
+
+    lines = _read(table_path)
+    assert lines[0] == COHORT_TABLE_COLUMNS
+    assert lines.count(COHORT_TABLE_COLUMNS) == 1
+    assert len(lines) == 1 + 16 * 2
+    assert sorted({line[0] for line in lines[1:]}) == sorted(f"study_{index}" for index in range(16))
+    assert list(tmp_path.joinpath("cohort").iterdir()) == [tmp_path / "cohort" / "metrics.csv"]
+
+    # a study recalculated again has new rows, the previous ones being kept
+    append_cohort_rows(table_path, _rows("study_0", "2026-01-02"))
+    study_0_rows = [line for line in _read(table_path) if line[0] == "study_0"]
+    assert [line[1] for line in study_0_rows] == ["2026-01-01"] * 2 + ["2026-01-02"] * 2
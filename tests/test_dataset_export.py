@@ -0,0 +1,41 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+zarr = pytest.importorskip("zarr")
+
+from utils.dataset_export import DATASET_INDEX_FILE_NAME, open_study_store, write_study_store  # noqa: E402
+from utils.grids import VoxelGrid  # noqa: E402
+
+
+def test_study_store_round_trip(tmp_path):
+    grid = VoxelGrid.regular([-10.0, -20.0, 5.0], [0.5, 0.5], 1.0, (20, 70, 40))
+    rng = np.random.default_rng(0)
+    arrays = {"ct": rng.integers(-1000, 2000, grid.shape).astype(np.int16),
+              "masks": rng.random((2,) + grid.shape) > 0.5,
+              "dose": rng.random(grid.shape).astype(np.float32),
+              "tps_dose": None}
+
+    store_path = write_study_store(str(tmp_path), "patient_study", arrays, grid, {"structures": ["prostate", "rectum"]},
+                                   chunk_shape=(8, 32, 64))
+
+    store = open_study_store(str(tmp_path), "patient_study")
+    assert store_path == str(tmp_path / "patient_study.zarr")
+    assert sorted(store.array_keys()) == ["ct", "dose", "masks"]
+    for name in ["ct", "masks", "dose"]:
+        assert store[name].shape == arrays[name].shape
+        np.testing.assert_array_equal(store[name][:], arrays[name])
+    # the chunks are clipped to the arrays, and the stacked masks are chunked one at a time
+    assert store["ct"].chunks == (8, 32, 40)
+    assert store["masks"].chunks == (1, 8, 32, 40)
+    assert store.attrs["structures"] == ["prostate", "rectum"]
+    with open(os.path.join(tmp_path, DATASET_INDEX_FILE_NAME)) as file:
+        index = json.load(file)
+    assert index["studies"]["patient_study"]["arrays"]["masks"] == {"shape": [2, 20, 70, 40], "dtype": "bool"}
+    np.testing.assert_allclose(index["studies"]["patient_study"]["grid"]["origin"], grid.origin)
+
+    write_study_store(str(tmp_path), "other_study", {"ct": arrays["ct"]}, grid)
+    with open(os.path.join(tmp_path, DATASET_INDEX_FILE_NAME)) as file:
+        assert sorted(json.load(file)["studies"].keys()) == ["other_study", "patient_study"]
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pydicom
+
+from utils.dose_files import Dose3D, TopasBinaryResult, merge_topas_binary_files, read_3ddose, write_3ddose
+from utils.rt_dicom import set_dose_grid_pixels
+
+STATISTICS = ["Sum", "Mean", "Standard_Deviation", "Count_in_Bin", "Min", "Max"]
+
+
+def _write_topas_run(bin_path: str, per_history_values: np.ndarray):
+    # statistics of a run as TOPAS scores them, per_history_values having shape (nb_of_histories, nb_of_bins)
+    statistics = np.stack([per_history_values.sum(axis=0), per_history_values.mean(axis=0),
+                           per_history_values.std(axis=0, ddof=1), (per_history_values > 0).sum(axis=0),
+                           per_history_values.min(axis=0), per_history_values.max(axis=0)], axis=1)
+    statistics.astype(np.float64).tofile(bin_path)
+    with open(bin_path + "header", "w") as file:
+        file.write("# Binary file: DoseScorer\n"
+                   "# X in 2 bins of 0.1 cm\n"
+                   "# Y in 2 bins of 0.1 cm\n"
+                   "# Z in 1 bin  of 0.1 cm\n"
+                   f"# DoseToMedium ( Gy ) : {'   '.join(STATISTICS)}\n")
+    return dict(zip(STATISTICS, statistics.T))
+
+
+def test_merge_topas_chunks_equals_single_run(tmp_path):
+    per_history_values = np.random.default_rng(1).exponential(size=(300, 4)) * \
+        (np.random.default_rng(2).random((300, 4)) > 0.3)
+    reference = _write_topas_run(str(tmp_path / "single.bin"), per_history_values)
+    chunk_paths = [str(tmp_path / "chunk0.bin"), str(tmp_path / "chunk1.bin")]
+    _write_topas_run(chunk_paths[0], per_history_values[:120])
+    _write_topas_run(chunk_paths[1], per_history_values[120:])
+
+    merge_topas_binary_files(chunk_paths, [120, 180], str(tmp_path / "merged.bin"))
+
+    written = np.fromfile(str(tmp_path / "merged.bin")).reshape((-1, len(STATISTICS)))
+    np.testing.assert_allclose(written, np.stack([reference[statistic] for statistic in STATISTICS], axis=1),
+                               rtol=1e-10)
+    with open(str(tmp_path / "merged.binheader")) as merged_file, open(chunk_paths[0] + "header") as chunk_file:
+        assert merged_file.read() == chunk_file.read()
+
+
+def _dose_3d(scale: float = 1.0) -> Dose3D:
+    positions = [np.array([-1.0, 0.0, 1.5]), np.array([0.0, 0.5, 1.0, 1.5]), np.array([-2.0, -1.0, 0.0, 1.0, 2.0])]
+    dose = np.arange(1, 25, dtype=np.float64).reshape((2, 3, 4)) * 1e-12 * scale
+    uncertainty = np.linspace(0.01, 0.2, 24).reshape((2, 3, 4))
+    return Dose3D(positions, dose, uncertainty)
+
+
+def test_3ddose_round_trip(tmp_path):
+    file_path = str(tmp_path / "dose.3ddose")
+    dose_3d = _dose_3d()
+    write_3ddose(file_path, dose_3d)
+
+    for use_sidecar in [False, True, True]:
+        read = read_3ddose(file_path, use_sidecar=use_sidecar)
+        for position, expected_position in zip(read.positions, dose_3d.positions):
+            np.testing.assert_allclose(position, expected_position)
+        np.testing.assert_allclose(read.dose, dose_3d.dose, rtol=1e-6)
+        np.testing.assert_allclose(read.uncertainty, dose_3d.uncertainty, rtol=1e-6)
+    assert os.path.exists(file_path + ".npy")
+
+
+def test_3ddose_stale_sidecar_is_parsed_again(tmp_path):
+    file_path = str(tmp_path / "dose.3ddose")
+    write_3ddose(file_path, _dose_3d())
+    read_3ddose(file_path, use_sidecar=True)
+    # the 3ddose is written again by a new simulation after its sidecar
+    write_3ddose(file_path, _dose_3d(scale=2.0))
+    sidecar_time = os.path.getmtime(file_path + ".npy")
+    os.utime(file_path, (sidecar_time + 10, sidecar_time + 10))
+
+    np.testing.assert_allclose(read_3ddose(file_path, use_sidecar=True).dose, _dose_3d(scale=2.0).dose, rtol=1e-6)
+    np.testing.assert_allclose(read_3ddose(file_path, use_sidecar=True).dose, _dose_3d(scale=2.0).dose, rtol=1e-6)
+
+
+def test_topas_memory_map_converts_as_the_whole_file(tmp_path):
+    bin_path = str(tmp_path / "dose.bin")
+    shape = (3, 4, 5)
+    values = np.random.default_rng(4).random((int(np.prod(shape)), 2))
+    values.tofile(bin_path)
+    with open(bin_path + "header", "w") as file:
+        file.write("# Binary file: DoseScorer\n"
+                   "# X in 3 bins of 0.1 cm\n"
+                   "# Y in 4 bins of 0.2 cm\n"
+                   "# Z in 5 bins of 0.3 cm\n"
+                   "# DoseToMedium ( Gy ) : Sum   Standard_Deviation\n")
+    # as topas2numpy reads it, indexed x, y, z
+    whole_file = np.fromfile(bin_path).reshape((-1, 2))[:, 0].reshape(shape, order="F")[::-1]
+
+    memory_mapped = TopasBinaryResult(bin_path).statistic("Sum", flipped=True)
+    rt_doses = []
+    for dose, nb_of_slices_per_chunk in [(memory_mapped, 2), (np.array(whole_file), 5)]:
+        rt_dose = pydicom.Dataset()
+        rt_dose.BitsAllocated = 16
+        set_dose_grid_pixels(rt_dose, dose, 2.0, zyx_ordered=False, nb_of_slices_per_chunk=nb_of_slices_per_chunk)
+        rt_doses.append(rt_dose)
+
+    assert rt_doses[0].PixelData == rt_doses[1].PixelData
+    assert rt_doses[0].DoseGridScaling == rt_doses[1].DoseGridScaling
+    pixels = np.frombuffer(rt_doses[0].PixelData, dtype=np.uint16).reshape(shape[::-1])
+    np.testing.assert_allclose(pixels * rt_doses[0].DoseGridScaling, 2.0 * whole_file.transpose(2, 1, 0),
+                               atol=rt_doses[0].DoseGridScaling)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from utils.dose_to_water import SOURCE_SPECTRA, WATER_COMPOSITION, convert_to_dose_to_water, water_to_medium_ratio
+
+
+def test_water_is_not_converted():
+    assert water_to_medium_ratio(SOURCE_SPECTRA["I-125"], "water", compositions={"water": WATER_COMPOSITION}) == \
+        pytest.approx(1.0)
+
+
+def test_media_of_material_dat_and_of_compositions():
+    dose = np.ones((2, 2, 2))
+    material_map = np.zeros(dose.shape, dtype=np.uint8)
+    material_map[1] = 1
+    # a TOPAS medium given by its composition, the same as the one of material.dat
+    compositions = {"G4_WATER": WATER_COMPOSITION}
+
+    dose_to_water = convert_to_dose_to_water(dose, material_map, ["WATER_1.000", "G4_WATER"], SOURCE_SPECTRA["I-125"],
+                                             compositions=compositions)
+
+    np.testing.assert_allclose(dose_to_water, 1.0, rtol=1e-3)
+    assert water_to_medium_ratio(SOURCE_SPECTRA["I-125"], "CALCIFICATION_ICRU46") < 0.5
+
+
+def test_unknown_media_are_not_defaulted():
+    with pytest.raises(KeyError):
+        water_to_medium_ratio(SOURCE_SPECTRA["I-125"], "TG186Prostate")
+    with pytest.raises(KeyError):
+        # no mu_en/rho of Z=0
+        water_to_medium_ratio(SOURCE_SPECTRA["I-125"], "unobtainium", compositions={"unobtainium": {0: 1.0}})
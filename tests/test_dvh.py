@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from utils.dvh import compute_cumulative_dvhs, evaluate_dvh_metric
+
+
+def _known_dose():
+    dose = np.zeros((2, 3, 4))
+    target = np.zeros(dose.shape, dtype=bool)
+    # ten voxels receiving 1 to 10 Gy
+    target.ravel()[:10] = True
+    dose.ravel()[:10] = np.arange(1, 11)
+    dose.ravel()[10:] = 0.5
+    return dose, target
+
+
+def test_dvh_of_known_dose():
+    dose, target = _known_dose()
+    dvh = compute_cumulative_dvhs(dose, {1: target}, voxel_volume=0.1, bin_width=0.01)[1]
+
+    assert dvh.volume == pytest.approx(1.0)
+    assert dvh.mean == pytest.approx(5.5)
+    assert dvh.min == pytest.approx(1.0)
+    assert evaluate_dvh_metric(dvh, "D90") == pytest.approx(2.0)
+    assert evaluate_dvh_metric(dvh, "D0.3cc") == pytest.approx(8.0)
+    assert evaluate_dvh_metric(dvh, "V150", prescription_dose=4.0) == pytest.approx(50.0)
+    assert evaluate_dvh_metric(dvh, "V300", prescription_dose=4.0) == pytest.approx(0.0)
+    with pytest.raises(ValueError):
+        evaluate_dvh_metric(dvh, "V150")
+
+
+def test_overlapping_structures_match_their_own_histograms():
+    rng = np.random.default_rng(3)
+    dose = rng.random((5, 6, 7)) * 20
+    masks = {1: rng.random(dose.shape) > 0.5, 2: rng.random(dose.shape) > 0.3, 3: np.zeros(dose.shape, dtype=bool)}
+    bin_width = 0.05
+
+    dvhs = compute_cumulative_dvhs(dose, masks, voxel_volume=0.2, bin_width=bin_width, nb_of_slices_per_chunk=2)
+
+    assert 3 not in dvhs
+    for roi_number in [1, 2]:
+        bins = np.minimum((dose[masks[roi_number]] / bin_width).astype(np.int64), int(dose.max() / bin_width))
+        expected_counts = np.cumsum(np.bincount(bins)[::-1])[::-1] * 0.2
+        np.testing.assert_allclose(dvhs[roi_number].counts, expected_counts)
+        assert dvhs[roi_number].mean == pytest.approx(dose[masks[roi_number]].mean())
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from utils.gamma import gamma_index, pass_rate
+from utils.grids import VoxelGrid
+
+
+def _cubic_grid(origin: float, spacing: float, size: int) -> VoxelGrid:
+    return VoxelGrid([origin] * 3, [1, 0, 0], [0, 1, 0], [spacing, spacing], np.arange(size) * spacing, size, size)
+
+
+def _gaussian_dose(grid: VoxelGrid, center) -> np.ndarray:
+    positions = np.stack([grid.voxel_centers(slice_index) for slice_index in range(grid.shape[0])])
+    return 10 * np.exp(-np.sum((positions - np.asarray(center)) ** 2, axis=-1) / (2 * 8.0 ** 2))
+
+
+def test_gamma_of_identical_doses_is_zero():
+    grid = _cubic_grid(-15.0, 2.0, 16)
+    dose = _gaussian_dose(grid, [0.0, 0.0, 0.0])
+
+    gamma = gamma_index(dose, grid, dose, grid)
+
+    evaluated = ~np.isnan(gamma)
+    np.testing.assert_array_equal(evaluated, dose >= 0.1 * dose.max())
+    np.testing.assert_allclose(gamma[evaluated], 0.0, atol=1e-12)
+    assert pass_rate(gamma) == 1.0
+
+
+def test_gamma_of_shifted_dose():
+    grid = _cubic_grid(-15.0, 1.0, 31)
+    reference = _gaussian_dose(grid, [0.0, 0.0, 0.0])
+    shift = 1.0
+    evaluated = _gaussian_dose(grid, [shift, 0.0, 0.0])
+
+    # with a negligible dose criterion, the gamma is the distance to the evaluated dose, the shift being on the
+    # search lattice
+    gamma = gamma_index(reference, grid, evaluated, grid, dose_criterion=1e-6, distance_criterion=2.0,
+                        lower_dose_cutoff=0.5, resolution_factor=2)
+    inside = ~np.isnan(gamma)
+    assert np.nanmax(gamma) == pytest.approx(shift / 2.0)
+    assert np.median(gamma[inside]) == pytest.approx(shift / 2.0, abs=0.05)
+    # a distance criterion below the shift, with a tight dose criterion, fails the steep voxels
+    strict_gamma = gamma_index(reference, grid, evaluated, grid, dose_criterion=0.001, distance_criterion=0.5,
+                               lower_dose_cutoff=0.5)
+    assert pass_rate(strict_gamma, inside) < 0.5
+    assert np.all(strict_gamma[~np.isnan(strict_gamma)] <= 2.0)
@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from utils.grid_extents import crop_margin_from_extent, custom_grid_from_extent, minimal_extent, structures_extent
+from utils.grids import VoxelGrid
+
+# x and y from -50 to 50 mm, z from -30 to 30 mm
+CT_GRID = VoxelGrid.regular([-50.0, -50.0, -30.0], [1.0, 1.0], 2.0, (31, 101, 101))
+MARGIN = 20.0
+
+
+def test_extent_covers_the_seeds_and_the_margin_inside_the_ct():
+    # the prostate from -15 to 15 mm in x and y and from -10 to 10 mm in z
+    structure_masks = SimpleNamespace(bounding_box=lambda roi_name: {"prostate": (slice(10, 21), slice(35, 66),
+                                                                                  slice(35, 66))}.get(roi_name))
+    structures = structures_extent(structure_masks, ["prostate", "rectum"], CT_GRID)
+    np.testing.assert_allclose(structures[0], [-15.0, -15.0, -10.0])
+    np.testing.assert_allclose(structures[1], [15.0, 15.0, 10.0])
+    seed_positions = np.asarray([[0.0, 0.0, 0.0], [10.0, -5.0, -4.0], [40.0, 0.0, 25.0]])
+
+    lower, upper = minimal_extent(structures, seed_positions, MARGIN, CT_GRID)
+
+    np.testing.assert_allclose(lower, [-35.0, -35.0, -30.0])
+    # clipped to the centers of the last voxels of the CT
+    np.testing.assert_allclose(upper, [50.0, 35.0, 30.0])
+    custom_grid = custom_grid_from_extent((lower, upper), [2.0, 1.5, 1.5])
+    # z, y, x shape of voxels of the scoring grid, centered on the extent
+    half_extents = custom_grid["shape"] * custom_grid["pixel_spacing"] / 2
+    assert np.all(custom_grid["scorer_origin"] - half_extents[::-1] <= lower)
+    assert np.all(custom_grid["scorer_origin"] + half_extents[::-1] >= upper)
+    ct_lower, ct_upper = np.asarray([-50.0, -50.0, -30.0]), np.asarray([50.0, 50.0, 30.0])
+    for seed_position in seed_positions:
+        assert np.all(np.maximum(seed_position - MARGIN, ct_lower) >= lower)
+        assert np.all(np.minimum(seed_position + MARGIN, ct_upper) <= upper)
+    # the phantom cropped to the structures with this margin holds the extent
+    crop_margin = crop_margin_from_extent(structures, (lower, upper))
+    assert np.all(structures[0] - crop_margin <= lower) and np.all(structures[1] + crop_margin >= upper)
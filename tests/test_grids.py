@@ -0,0 +1,66 @@
+import numpy as np
+import pydicom
+import pytest
+
+from utils.grids import VoxelGrid, resample_linear, resample_nearest
+
+
+def _rt_dose(grid_frame_offset_vector) -> pydicom.Dataset:
+    rt_dose = pydicom.Dataset()
+    rt_dose.ImagePositionPatient = [-10.0, -20.0, 30.0]
+    rt_dose.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    rt_dose.PixelSpacing = [2.0, 1.0]
+    rt_dose.Rows = 4
+    rt_dose.Columns = 5
+    rt_dose.GridFrameOffsetVector = grid_frame_offset_vector
+    return rt_dose
+
+
+def test_resample_linear_onto_identical_grid_returns_input():
+    grid = VoxelGrid.regular([-5.0, 3.0, 12.0], [2.0, 1.5], 2.5, (6, 7, 8))
+    volume = np.random.default_rng(0).random(grid.shape)
+
+    np.testing.assert_allclose(resample_linear(volume, grid, grid, nb_of_slices_per_chunk=4), volume, rtol=1e-6)
+    np.testing.assert_array_equal(resample_nearest(volume, grid, grid), volume)
+
+
+def test_resample_linear_between_voxels():
+    grid = VoxelGrid.regular([0.0, 0.0, 0.0], [1.0, 1.0], 1.0, (4, 4, 4))
+    shifted_grid = VoxelGrid.regular([0.5, 0.0, 0.0], [1.0, 1.0], 1.0, (4, 4, 3))
+    # linear along x, so the interpolation is exact
+    volume = np.broadcast_to(np.arange(4, dtype=np.float64), grid.shape)
+
+    np.testing.assert_allclose(resample_linear(volume, grid, shifted_grid), np.broadcast_to([0.5, 1.5, 2.5],
+                                                                                            shifted_grid.shape))
+
+
+@pytest.mark.parametrize("grid_frame_offset_vector", [[0.0, 3.0, 6.0], [30.0, 33.0, 36.0]])
+def test_from_rt_dose_increasing_offsets(grid_frame_offset_vector):
+    grid = VoxelGrid.from_rt_dose(_rt_dose(grid_frame_offset_vector))
+
+    np.testing.assert_allclose(grid.slice_offsets, [0.0, 3.0, 6.0])
+    slices, rows, columns = grid.continuous_indices(np.array([[-9.0, -16.0, 34.5]]))
+    np.testing.assert_allclose([slices[0], rows[0], columns[0]], [1.5, 2.0, 1.0])
+
+
+def test_from_rt_dose_decreasing_offsets():
+    grid = VoxelGrid.from_rt_dose(_rt_dose([0.0, -3.0, -6.0]))
+    volume = np.stack([np.full((4, 5), value) for value in [1.0, 2.0, 3.0]])
+
+    slices, _, _ = grid.continuous_indices(np.array([[-10.0, -20.0, 28.5], [-10.0, -20.0, 21.0]]))
+    np.testing.assert_allclose(slices, [0.5, 3.0])
+    # the frames of the RT Dose keep their order, the first one being the highest
+    ascending_grid = VoxelGrid.regular([-10.0, -20.0, 24.0], [2.0, 1.0], 3.0, (3, 4, 5))
+    np.testing.assert_allclose(resample_linear(volume, grid, ascending_grid), volume[::-1])
+
+
+def test_from_rt_dose_decreasing_uneven_offsets():
+    grid = VoxelGrid.from_rt_dose(_rt_dose([0.0, -2.0, -6.0]))
+
+    slices, _, _ = grid.continuous_indices(np.array([[-10.0, -20.0, z] for z in [31.0, 29.0, 26.0, 22.0]]))
+    np.testing.assert_allclose(slices, [-0.5, 0.5, 1.5, 2.5])
+
+
+def test_from_rt_dose_unordered_offsets():
+    with pytest.raises(ValueError):
+        VoxelGrid.from_rt_dose(_rt_dose([0.0, 6.0, 3.0]))
@@ -0,0 +1,50 @@
+import os
+from types import SimpleNamespace
+
+import pydicom
+import pytest
+
+pytest.importorskip("egs_brachy_file_generator")
+pytest.importorskip("topas_file_generator")
+
+from components.input_file_generators import InputFileGenerators  # noqa: E402
+
+GENERATOR = "egs_brachy_permanent_implant_brachy"
+
+
+def _generator(total_particles: int, generations: list) -> InputFileGenerators:
+    input_file_generator = InputFileGenerators(cache_folder=generations[0], total_particles=total_particles, batches=1,
+                                               chunk=1, list_of_desired_structures=["prostate"])
+
+    def generate(plan, output_folder: str):
+        generations.append(output_folder)
+        with open(os.path.join(output_folder, "input_study.egsinp"), "w") as file:
+            file.write(f"    ncase = {total_particles}\n    nbatch = 1\n")
+        with open(os.path.join(output_folder, "phantom.egsphant"), "w") as file:
+            file.write("phantom")
+        sr_item = pydicom.Dataset()
+        sr_item.TextValue = f"{total_particles} histories"
+        return output_folder, {"total_particles": total_particles, "dose_factor_offset": 1.0}, [sr_item]
+
+    input_file_generator.__setattr__(GENERATOR, generate)
+    return input_file_generator
+
+
+def test_cache_hit_with_another_total_particles(tmp_path):
+    plan = SimpleNamespace(context_fingerprint="fingerprint", patient="patient", study="study")
+    generations = [str(tmp_path / "cache")]
+    for output_folder in ["first", "second"]:
+        os.mkdir(tmp_path / output_folder)
+
+    _generator(1000000, generations)._generate_input_files_with_cache(GENERATOR, plan, str(tmp_path / "first"))
+    restored = _generator(3000000, generations)._generate_input_files_with_cache(GENERATOR, plan,
+                                                                                 str(tmp_path / "second"))
+    sim_files_folder, meta_data_dict, all_sr_sequence = restored
+
+    # the phantom of the first generation is reused
+    assert generations[1:] == [str(tmp_path / "first")]
+    assert sim_files_folder == str(tmp_path / "second")
+    with open(tmp_path / "second" / "input_study.egsinp") as file:
+        assert "ncase = 3000000" in file.read()
+    assert meta_data_dict["total_particles"] == 3000000
+    assert all_sr_sequence[0].TextValue == "3000000 histories"
@@ -0,0 +1,79 @@
+import pytest
+
+from utils.phase_space_sources import use_phase_space_in_egsinp, use_phase_space_in_topas
+
+SOURCE_MODEL = {"seed_model": "Advantage_IAI_125A", "phase_space": "/library/Advantage_IAI_125A",
+                "orig_histories": 1000000, "particles": 1500000}
+EGSINP = """:start run control:
+    ncase = 20000
+:stop run control:
+:start source definition:
+    :start source:
+        name = seeds
+        library = egs_isotropic_source
+        charge = 0
+    :stop source:
+    :start transformations:
+        :start transformation:
+            translation = 1 2 3
+        :stop transformation:
+    :stop transformations:
+    simulation source = seeds
+:stop source definition:"""
+
+
+def _topas_input(decays: int) -> str:
+    return "\n".join(["s:Ge/Seed1/Parent = \"World\"",
+                      "d:Ge/Seed1/TransX = 1.2 cm",
+                      "s:So/Seed1/Type = \"Isotropic\"",
+                      "s:So/Seed1/Component = \"Seed1\"",
+                      "s:So/Seed1/BeamParticle = \"gamma\"",
+                      "d:So/Seed1/BeamPositionCutoffX = 0.4 mm",
+                      f"i:So/Seed1/NumberOfHistoriesInRun = {decays}",
+                      "s:So/Seed2/Type = \"Isotropic\"",
+                      "s:So/Seed2/Component = \"Seed2\"",
+                      f"i:So/Seed2/NumberOfHistoriesInRun = {decays}"])
+
+
+def _parameters(topas_input: str) -> dict:
+    return dict(line.split(" = ", 1) for line in topas_input.split("\n"))
+
+
+def test_egsinp_ncase_is_scaled_to_the_particles_per_decay():
+    egsinp, dose_factor = use_phase_space_in_egsinp(EGSINP, SOURCE_MODEL)
+
+    assert dose_factor == pytest.approx(1.5)
+    assert "ncase = 30000" in egsinp
+    assert "library = iaea_phsp_source" in egsinp
+    assert f"iaea phase space file = {SOURCE_MODEL['phase_space']}" in egsinp
+    assert "egs_isotropic_source" not in egsinp
+    # the phase space is placed at every seed by the transformations of the study
+    assert "translation = 1 2 3" in egsinp
+
+
+def test_topas_reads_only_the_requested_decays_of_the_phase_space():
+    topas_input, dose_factor = use_phase_space_in_topas(_topas_input(1000), SOURCE_MODEL)
+    parameters = _parameters(topas_input)
+
+    assert dose_factor == pytest.approx(1.0)
+    for seed in ["Seed1", "Seed2"]:
+        assert parameters[f"s:So/{seed}/Type"] == "\"PhaseSpace\""
+        assert parameters[f"i:So/{seed}/PhaseSpaceMultipleUse"] == "0"
+        assert parameters[f"i:So/{seed}/NumberOfHistoriesInRun"] == "1000"
+        assert parameters[f"b:So/{seed}/PhaseSpaceIncludeEmptyHistories"] == "\"True\""
+        assert parameters[f"s:So/{seed}/PhaseSpaceFileName"] == f"\"{SOURCE_MODEL['phase_space']}\""
+        # the phase space positions, in cm around the seed at the origin, are in the frame of the seed component
+        assert parameters[f"s:So/{seed}/Component"] == f"\"{seed}\""
+    assert "s:So/Seed1/BeamParticle" not in parameters
+    assert "d:So/Seed1/BeamPositionCutoffX" not in parameters
+    assert parameters["d:Ge/Seed1/TransX"] == "1.2 cm"
+
+
+def test_topas_reuses_the_phase_space_for_more_decays_than_it_holds():
+    topas_input, dose_factor = use_phase_space_in_topas(_topas_input(2600000), SOURCE_MODEL)
+    parameters = _parameters(topas_input)
+
+    assert parameters["i:So/Seed1/PhaseSpaceMultipleUse"] == "3"
+    assert "i:So/Seed1/NumberOfHistoriesInRun" not in parameters
+    # 3 uses of the 1e6 decays simulated for 2.6e6 requested ones
+    assert dose_factor == pytest.approx(2.6 / 3)
@@ -0,0 +1,57 @@
+import os
+import pickle
+from functools import partial
+
+from utils.run_manifest import RUN_STATE_FOLDER_NAME, STAGES, resumable_stage
+
+
+def _stage(study_context: dict, stage: str, calls: list) -> dict:
+    calls.append(stage)
+    stage_file = os.path.join(study_context["simulation_files_path"], stage, "output.txt")
+    os.makedirs(os.path.dirname(stage_file), exist_ok=True)
+    with open(stage_file, "w") as file:
+        file.write(stage)
+    study_context[f"{stage}_folder"] = os.path.dirname(stage_file)
+    if stage == "extracted":
+        study_context["plan"] = "large plan"
+    return study_context
+
+
+def _reload(study_context: dict, calls: list) -> dict:
+    calls.append("reloaded")
+    study_context["plan"] = "large plan"
+    return study_context
+
+
+def _run(study_context: dict, calls: list) -> dict:
+    stages = [resumable_stage(partial(_stage, stage=stage, calls=calls), stage, [f"{stage}_folder"],
+                              [f"{stage}_folder"], partial(_reload, calls=calls) if stage == "extracted" else None)
+              for stage in STAGES]
+    study_context = dict(study_context)
+    for stage in stages:
+        study_context = stage(study_context)
+    return study_context
+
+
+def test_stages_after_a_modified_artifact_are_run_again(tmp_path):
+    study_context = {"study_path": str(tmp_path / "study"), "simulation_files_path": str(tmp_path / "simulation"),
+                     "log_file": str(tmp_path / "simulation" / "logs.logs")}
+    calls = []
+    _run(study_context, calls)
+    assert calls == STAGES
+
+    calls.clear()
+    _run(study_context, calls)
+    assert calls == []
+
+    with open(tmp_path / "simulation" / "simulated" / "output.txt", "w") as file:
+        file.write("corrupted")
+    calls.clear()
+    resumed_context = _run(study_context, calls)
+
+    assert calls == ["reloaded", "simulated", "cleaned"]
+    assert resumed_context["plan"] == "large plan"
+    assert resumed_context["generated_folder"] == str(tmp_path / "simulation" / "generated")
+    # the plan is reloaded instead of being kept in the state of the extraction
+    with open(tmp_path / "simulation" / RUN_STATE_FOLDER_NAME / "extracted.pkl", "rb") as file:
+        assert "plan" not in pickle.load(file)
@@ -0,0 +1,42 @@
+import pydicom
+
+from utils.run_parameters import update_run_metadata, update_run_parameters
+
+CACHED_RUN_PARAMETERS = {"total_particles": 1000000, "batches": 1, "chunk": 1}
+RUN_PARAMETERS = {"total_particles": 4000000, "batches": 10, "chunk": 1}
+
+
+def test_histories_of_every_source_are_scaled_to_the_new_total():
+    topas_input = "\n".join(["i:Ts/ShowHistoryCountAtInterval = 10000",
+                             "i:So/Seed1/NumberOfHistoriesInRun = 600000",
+                             "i:So/Seed2/NumberOfHistoriesInRun = 400000"])
+
+    rewritten = update_run_parameters(topas_input, CACHED_RUN_PARAMETERS, RUN_PARAMETERS)
+
+    assert rewritten.split("\n") == ["i:Ts/ShowHistoryCountAtInterval = 40000",
+                                     "i:So/Seed1/NumberOfHistoriesInRun = 2400000",
+                                     "i:So/Seed2/NumberOfHistoriesInRun = 1600000"]
+    egsinp = update_run_parameters("    ncase = 1000000\n    nbatch = 1\n    nchunk = 1", CACHED_RUN_PARAMETERS,
+                                   RUN_PARAMETERS)
+    assert egsinp == "    ncase = 4000000\n    nbatch = 10\n    nchunk = 1"
+
+
+def test_meta_data_and_sr_of_a_cached_generation_get_the_new_run_parameters():
+    meta_data_dict = {"total_particles": 1000000, "batches": 1, "dose_factor_offset": 1.0,
+                      "image_position_offset": [0.0, 1.0, 0.0], "flipped": True}
+    sr_item = pydicom.Dataset()
+    sr_item.TextValue = "egs_brachy run of 1000000 histories in 1 batch, seed 10000001"
+    measured_value = pydicom.Dataset()
+    measured_value.NumericValue = "1000000"
+    sr_item.MeasuredValueSequence = pydicom.Sequence([measured_value])
+
+    updated_meta_data = update_run_metadata(meta_data_dict, CACHED_RUN_PARAMETERS, RUN_PARAMETERS)
+    updated_sr = update_run_metadata([sr_item], CACHED_RUN_PARAMETERS, RUN_PARAMETERS)
+
+    assert updated_meta_data == {"total_particles": 4000000, "batches": 10, "dose_factor_offset": 1.0,
+                                 "image_position_offset": [0.0, 1.0, 0.0], "flipped": True}
+    assert updated_sr[0].TextValue == "egs_brachy run of 4000000 histories in 1 batch, seed 10000001"
+    assert float(updated_sr[0].MeasuredValueSequence[0].NumericValue) == 4000000
+    # the cached items are left as they are
+    assert sr_item.TextValue == "egs_brachy run of 1000000 histories in 1 batch, seed 10000001"
+    assert update_run_metadata(meta_data_dict, CACHED_RUN_PARAMETERS, CACHED_RUN_PARAMETERS) == meta_data_dict
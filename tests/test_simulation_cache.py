@@ -0,0 +1,46 @@
+import os
+
+from components import simulation_runners
+from components.simulation_runners import SimulationRunners
+
+
+def _study_folders(tmp_path, study: str, seed_geometry: str, nb_of_threads: int):
+    input_folder = str(tmp_path / study / "input")
+    output_folder = str(tmp_path / study / "output")
+    os.makedirs(input_folder)
+    os.makedirs(output_folder)
+    with open(os.path.join(input_folder, "phantom.bin"), "wb") as file:
+        file.write(bytes(range(16)))
+    with open(os.path.join(input_folder, "input_study.txt"), "w") as file:
+        file.write(f'includeFile = {seed_geometry}\n'
+                   f's:Ge/Phantom/InputFile = "{input_folder}/phantom.bin"\n'
+                   f's:Sc/Dose/OutputFile = "{output_folder}/dose"\n'
+                   f'i:Ts/NumberOfThreads = {nb_of_threads}\n')
+    return input_folder, output_folder
+
+
+def test_simulation_cache_key(tmp_path, monkeypatch):
+    seed_geometry = str(tmp_path / "lib" / "seed.txt")
+    executable = str(tmp_path / "bin" / "topas")
+    for path, content in [(seed_geometry, "s:Ge/Seed/Material = \"G4_Ti\""), (executable, "topas 3.9")]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(content)
+    monkeypatch.setattr(simulation_runners, "TOPAS_EXECUTABLE", executable)
+    simulation_runner = SimulationRunners(nb_treads=8, waiting_time=5)
+    first_folders = _study_folders(tmp_path, "first", seed_geometry, 8)
+    key = simulation_runner._get_simulation_cache_key("topas", *first_folders)
+
+    # the same inputs generated in other folders, the number of threads being added by the runner
+    assert simulation_runner._get_simulation_cache_key("topas", *_study_folders(tmp_path, "second", seed_geometry,
+                                                                                4)) == key
+    assert SimulationRunners(nb_treads=8, waiting_time=10)._get_simulation_cache_key("topas", *first_folders) == key
+
+    with open(seed_geometry, "a") as file:
+        file.write("\nd:Ge/Seed/HL = 0.4 cm")
+    modified_reference_key = simulation_runner._get_simulation_cache_key("topas", *first_folders)
+    assert modified_reference_key != key
+
+    with open(executable, "a") as file:
+        file.write(".1")
+    assert simulation_runner._get_simulation_cache_key("topas", *first_folders) not in [key, modified_reference_key]
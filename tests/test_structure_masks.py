@@ -0,0 +1,67 @@
+import numpy as np
+import pydicom
+from pydicom.dataset import FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, RTStructureSetStorage, generate_uid
+
+from utils.grids import VoxelGrid
+from utils.structure_masks import StructureMasks, rasterize_contours, rasterize_contours_packed
+
+
+def _square(z: float, low: float, high: float) -> np.ndarray:
+    return np.asarray([[low, low, z], [high, low, z], [high, high, z], [low, high, z]])
+
+
+def _rt_struct_file(path: str, contours) -> str:
+    rt_struct = pydicom.Dataset()
+    rt_struct.file_meta = FileMetaDataset()
+    rt_struct.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    rt_struct.file_meta.MediaStorageSOPClassUID = RTStructureSetStorage
+    rt_struct.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    roi = pydicom.Dataset()
+    roi.ROINumber = 1
+    roi.ROIName = "prostate"
+    rt_struct.StructureSetROISequence = Sequence([roi])
+    roi_contour = pydicom.Dataset()
+    roi_contour.ReferencedROINumber = 1
+    roi_contour.ContourSequence = Sequence()
+    for points in contours:
+        contour = pydicom.Dataset()
+        contour.ContourGeometricType = "CLOSED_PLANAR"
+        contour.ContourData = points.ravel().tolist()
+        roi_contour.ContourSequence.append(contour)
+    rt_struct.ROIContourSequence = Sequence([roi_contour])
+    rt_struct.save_as(path, enforce_file_format=True)
+    return path
+
+
+def test_contours_are_rasterized_in_their_bounding_box():
+    grid = VoxelGrid.regular([0.0, 0.0, 0.0], [1.0, 1.0], 1.0, (10, 40, 50))
+    # a square with a square hole, on slices 3 and 4
+    contours = [_square(z, 9.5, 20.5) for z in [3.0, 4.0]] + [_square(z, 12.5, 14.5) for z in [3.0, 4.0]]
+
+    packed_mask = rasterize_contours_packed(contours, grid)
+
+    expected = np.zeros(grid.shape, dtype=bool)
+    expected[3:5, 10:21, 10:21] = True
+    expected[3:5, 13:15, 13:15] = False
+    np.testing.assert_array_equal(packed_mask.unpack(), expected)
+    np.testing.assert_array_equal(rasterize_contours(contours, grid), expected)
+    assert packed_mask.bounding_box == (slice(3, 5), slice(10, 21), slice(10, 21))
+    assert packed_mask.crop_shape == (2, 11, 11)
+
+
+def test_structure_masks_rasterize_the_rt_struct_once(tmp_path):
+    grid = VoxelGrid.regular([-10.0, -20.0, 5.0], [2.0, 2.0], 2.0, (6, 20, 20))
+    contours = [_square(z, -0.5, 7.5) for z in [7.0, 9.0]]
+    structure_masks = StructureMasks(_rt_struct_file(str(tmp_path / "rt_struct.dcm"), contours), grid)
+
+    mask = structure_masks.mask("prostate")
+
+    assert mask.shape == grid.shape
+    assert int(np.count_nonzero(mask)) == 2 * 4 * 4
+    assert structure_masks.bounding_box("prostate") == (slice(1, 3), slice(10, 14), slice(5, 9))
+    np.testing.assert_allclose(structure_masks.center("prostate"), [3.0, 3.0, 8.0])
+    # only the bits of the bounding box are kept
+    assert structure_masks.nbytes == 4
+    assert structure_masks.mask("bladder") is None
@@ -0,0 +1,72 @@
+import logging
+from functools import partial
+
+import pytest
+
+from components.study_schedulers import StudySchedulers, StudyThreadPoolExecutor
+
+
+def _stage(study_context: dict, stage_index: int) -> dict:
+    logging.info(f"stage {stage_index} of {study_context['study']}")
+    if study_context["study"] == "ignored" and stage_index == 1:
+        raise NotImplementedError
+    if study_context["study"] == "failed" and stage_index == 1:
+        raise RuntimeError("stage failure")
+    study_context.setdefault("stages", []).append(stage_index)
+    return study_context
+
+
+def _stage_with_helper_threads(study_context: dict, stage_index: int) -> dict:
+    with StudyThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda index: logging.info(f"helper {index} of {study_context['study']}"), range(2)))
+    return _stage(study_context, stage_index)
+
+
+def _study_contexts(tmp_path, studies) -> list:
+    return [{"patient": "patient", "study": study, "study_path": str(tmp_path / study),
+             "final_output_folder": str(tmp_path / f"final_output_{study}"),
+             "log_file": str(tmp_path / f"simulation_files_{study}" / "logs.logs")} for study in studies]
+
+
+@pytest.fixture
+def info_logging():
+    root_logger = logging.getLogger()
+    level = root_logger.level
+    root_logger.setLevel(logging.INFO)
+    yield
+    root_logger.setLevel(level)
+
+
+def test_process_pool_returns_a_summary_per_study(tmp_path, info_logging):
+    study_contexts = _study_contexts(tmp_path, ["completed", "ignored", "failed"])
+    stages = [partial(_stage, stage_index=stage_index) for stage_index in range(3)]
+
+    summaries = StudySchedulers(nb_of_concurrent_studies=2).run_studies("process_pool", study_contexts, stages)
+
+    assert sorted((summary["study"], summary["status"]) for summary in summaries) == \
+        [("completed", "completed"), ("failed", "failed"), ("ignored", "ignored")]
+
+
+@pytest.mark.parametrize("scheduler", ["sequential", "pipelined"])
+def test_stages_run_in_order_and_each_study_logs_in_its_own_file(tmp_path, info_logging, scheduler):
+    studies = [f"study_{index}" for index in range(5)] + ["failed"]
+    study_contexts = _study_contexts(tmp_path, studies)
+    stages = [partial(_stage_with_helper_threads, stage_index=stage_index) for stage_index in range(3)]
+    handlers = list(logging.getLogger().handlers)
+
+    summaries = StudySchedulers(stage_workers=[2, 3, 2], queue_size=2).run_studies(scheduler, study_contexts, stages)
+
+    assert logging.getLogger().handlers == handlers
+    assert sorted(summary["study"] for summary in summaries) == sorted(studies)
+    for study_context in study_contexts:
+        study = study_context["study"]
+        if study == "failed":
+            assert study_context["stages"] == [0]
+        else:
+            assert study_context["stages"] == [0, 1, 2]
+        with open(study_context["log_file"]) as file:
+            lines = file.read().splitlines()
+        messages = [line.split(" - ", 1)[1] for line in lines if " - " in line]
+        assert all(message.endswith(f"of {study}") for message in messages if message.startswith(("stage", "helper")))
+        assert f"stage 0 of {study}" in messages
+        assert f"helper 1 of {study}" in messages
@@ -0,0 +1,87 @@
+import json
+import os
+
+import numpy as np
+import pydicom
+import pytest
+
+from components.simulation_runners import SimulationRunners
+from utils.dose_files import read_3ddose
+from utils.grids import VoxelGrid
+from utils.tg43 import TG43Kernel, TG43SourceModel, read_seeds, superpose_tg43_dose
+
+HALF_LIFE = 59.4
+# point source of dose rate constant 1 cGy h-1 U-1, without radial dose and anisotropy variations
+CONSENSUS_DATA = {"dose_rate_constant": 1.0, "active_length": 0.0, "radial_dose_function": [[0.1, 1.0], [10.0, 1.0]],
+                  "anisotropy_function": {"distances": [0.1, 10.0], "angles": [0.0, 180.0],
+                                          "values": [[1.0, 1.0], [1.0, 1.0]]}}
+
+
+def _dose_at_1_cm(air_kerma_strength: float) -> float:
+    # initial dose rate times the mean life, in Gy
+    return air_kerma_strength * HALF_LIFE * 24 / np.log(2) / 100
+
+
+def test_single_seed_point_dose():
+    source_model = TG43SourceModel(CONSENSUS_DATA["dose_rate_constant"], CONSENSUS_DATA["active_length"],
+                                   [0.1, 10.0], [1.0, 1.0], [0.1, 10.0], [0.0, 180.0], np.ones((2, 2)))
+    grid = VoxelGrid.regular([-20.0, -20.0, -20.0], [10.0, 10.0], 10.0, (5, 5, 5))
+
+    dose = superpose_tg43_dose(TG43Kernel.from_source_model(source_model), grid, np.zeros((1, 3)),
+                               np.asarray([[0.0, 0.0, 1.0]]), np.asarray([2.0]), np.asarray([HALF_LIFE]))
+
+    assert dose[2, 2, 3] == pytest.approx(_dose_at_1_cm(2.0), rel=1e-3)
+    assert dose[2, 3, 2] == pytest.approx(_dose_at_1_cm(2.0), rel=1e-3)
+    assert dose[2, 2, 4] == pytest.approx(_dose_at_1_cm(2.0) / 4, rel=1e-3)
+
+
+def test_superposition_on_an_oblique_grid(tmp_path):
+    kernel_path = str(tmp_path / "consensus_data.json")
+    with open(kernel_path, "w") as file:
+        json.dump(CONSENSUS_DATA, file)
+    # rows along -x and columns along y, so that the voxel (slice, row, column) is at (20 - 10 row, 10 column - 20,
+    # 10 slice - 20)
+    tg43_input = {"kernel_path": kernel_path, "air_kerma_strength_per_history": None,
+                  "grid": {"origin": [20.0, -20.0, -20.0], "pixel_spacing": [10.0, 10.0], "slice_thickness": 10.0,
+                           "shape": [5, 5, 5], "image_orientation_patient": [0, 1, 0, -1, 0, 0]},
+                  "seeds": {"positions": [[10.0, 0.0, 0.0]], "directions": [[0.0, 0.0, 1.0]],
+                            "air_kerma_strengths": [2.0], "half_lives": [HALF_LIFE]}}
+    for folder in ["input", "output"]:
+        os.mkdir(tmp_path / folder)
+    with open(tmp_path / "input" / "tg43_patient_study.json", "w") as file:
+        json.dump(tg43_input, file)
+
+    SimulationRunners()._launch_tg43(str(tmp_path / "input"), str(tmp_path / "output"))
+
+    dose = read_3ddose(str(tmp_path / "output" / "tg43_patient_study.3ddose")).dose
+    # the seed is in the voxel (2, 1, 2)
+    assert dose[2, 2, 2] == pytest.approx(_dose_at_1_cm(2.0), rel=1e-3)
+    assert dose[2, 0, 2] == pytest.approx(_dose_at_1_cm(2.0), rel=1e-3)
+    assert dose[2, 1, 4] == pytest.approx(_dose_at_1_cm(2.0) / 4, rel=1e-3)
+
+
+def test_air_kerma_strengths_are_decayed_to_the_plan_date():
+    source = pydicom.Dataset()
+    source.SourceNumber = 1
+    source.ReferenceAirKermaRate = 2.0
+    source.SourceIsotopeHalfLife = HALF_LIFE
+    source.SourceStrengthReferenceDate = "20230101"
+    source.SourceStrengthReferenceTime = "120000"
+    control_point = pydicom.Dataset()
+    control_point.ControlPoint3DPosition = [1.0, 2.0, 3.0]
+    channel = pydicom.Dataset()
+    channel.ReferencedSourceNumber = 1
+    channel.BrachyControlPointSequence = pydicom.Sequence([control_point])
+    application_setup = pydicom.Dataset()
+    application_setup.ChannelSequence = pydicom.Sequence([channel])
+    rt_plan = pydicom.Dataset()
+    rt_plan.SourceSequence = pydicom.Sequence([source])
+    rt_plan.ApplicationSetupSequence = pydicom.Sequence([application_setup])
+    rt_plan.RTPlanDate = "20230301"
+    rt_plan.RTPlanTime = "1200"
+
+    seeds = read_seeds(rt_plan)
+
+    # 59 days after the reference date
+    assert seeds["air_kerma_strengths"][0] == pytest.approx(2.0 * np.exp(-np.log(2) * 59 / HALF_LIFE))
+    np.testing.assert_allclose(seeds["positions"], [[1.0, 2.0, 3.0]])
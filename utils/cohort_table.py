@@ -0,0 +1,55 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import csv
+import io
+import os
+import threading
+from typing import Dict, List
+
+COHORT_TABLE_COLUMNS = ["study", "computed_at", "dose_source", "structure", "metric", "value", "unit"]
+
+
+def append_cohort_rows(table_path: str, rows: List[Dict]):
+    """
+    Appends the rows of a study to the CSV table of the cohort, one row per study, dose, structure and metric (long
+    format, so that the columns never change with the metrics asked). The rows of a study are written in a single
+    append, so that studies finishing at the same time in different processes do not interleave. A study recalculated
+    again has new rows, with a later computed_at, the last ones being the valid ones.
+    """
+    if len(rows) == 0:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(table_path)), exist_ok=True)
+    if not os.path.exists(table_path):
+        # the table appears with its header at once, linking fails for all the studies but the first one
+        temporary_path = f"{table_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w", newline="") as file:
+            csv.writer(file).writerow(COHORT_TABLE_COLUMNS)
+        try:
+            os.link(temporary_path, table_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporary_path)
+
+    text = io.StringIO()
+    writer = csv.DictWriter(text, COHORT_TABLE_COLUMNS)
+    writer.writerows(rows)
+    table_file = os.open(table_path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(table_file, text.getvalue().encode())
+    finally:
+        os.close(table_file)
@@ -0,0 +1,123 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import threading
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import numpy as np
+import zarr
+
+from utils.grids import VoxelGrid
+
+DATASET_INDEX_FILE_NAME = "dataset_index.json"
+DATASET_ENTRIES_FOLDER_NAME = "entries"
+STUDY_STORE_EXTENSION = ".zarr"
+
+
+def _grid_attributes(grid: VoxelGrid) -> Dict:
+    return {"origin": grid.origin.tolist(), "row_direction": grid.row_direction.tolist(),
+            "column_direction": grid.column_direction.tolist(), "pixel_spacing": grid.pixel_spacing.tolist(),
+            "slice_offsets": grid.slice_offsets.tolist(), "shape": list(grid.shape)}
+
+
+def _write_array(store_path: str, name: str, array: np.ndarray, chunk_shape, executor: ThreadPoolExecutor):
+    # the leading axes of stacked arrays are chunked one item at a time
+    chunk_shape = (1,) * (array.ndim - len(chunk_shape)) + tuple(chunk_shape)
+    chunk_shape = tuple(min(chunk_size, size) for chunk_size, size in zip(chunk_shape, array.shape))
+    stored = zarr.open_array(store=os.path.join(store_path, name), mode="w", shape=array.shape, chunks=chunk_shape,
+                             dtype=array.dtype, fill_value=0)
+    # the slabs are aligned on the chunks, so that no chunk is written by two threads
+    slab_size = chunk_shape[0]
+    return [executor.submit(stored.__setitem__, slice(start, start + slab_size), array[start:start + slab_size])
+            for start in range(0, array.shape[0], slab_size)]
+
+
+def write_study_store(dataset_folder: str, study_name: str, arrays: Dict[str, Optional[np.ndarray]],
+                      grid: VoxelGrid, attributes: Optional[Dict] = None, chunk_shape=(16, 64, 64),
+                      nb_of_threads: int = 4) -> str:
+    """
+    Writes the co-registered arrays of a study in a chunked and compressed store, <study_name>.zarr in
+    dataset_folder, and adds the study to the index of the dataset.
+
+    :param arrays: arrays of the study on grid, by name. The arrays with one more leading axis (ex. one mask per
+                   structure) are chunked one item at a time. None values are skipped.
+    :param grid: geometry shared by all the arrays, stored in the attributes of the study
+    :param attributes: other attributes of the study (ex. the names of the structures), JSON serializable
+    :param chunk_shape: shape of the chunks along the slices, rows and columns
+    :param nb_of_threads: number of chunks compressed and written at the same time
+    :return: path of the store
+    """
+    store_path = os.path.join(dataset_folder, study_name + STUDY_STORE_EXTENSION)
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    group = zarr.open_group(store_path, mode="w")
+    with ThreadPoolExecutor(max_workers=nb_of_threads) as executor:
+        futures = []
+        for name, array in arrays.items():
+            if array is not None:
+                futures += _write_array(store_path, name, np.ascontiguousarray(array), chunk_shape, executor)
+        for future in futures:
+            future.result()
+
+    entry = {"store": os.path.basename(store_path), "grid": _grid_attributes(grid),
+             "arrays": {name: {"shape": list(array.shape), "dtype": str(array.dtype)}
+                        for name, array in arrays.items() if array is not None}}
+    entry.update(attributes or {})
+    group.attrs.update(entry)
+    entries_folder = os.path.join(dataset_folder, DATASET_ENTRIES_FOLDER_NAME)
+    os.makedirs(entries_folder, exist_ok=True)
+    entry_path = os.path.join(entries_folder, study_name + ".json")
+    with open(entry_path + ".tmp", "w") as file:
+        json.dump(entry, file)
+    os.replace(entry_path + ".tmp", entry_path)
+    update_dataset_index(dataset_folder)
+    return store_path
+
+
+def update_dataset_index(dataset_folder: str) -> str:
+    """
+    Gathers the entries of all the studies of dataset_folder in its index, written atomically. Each study writes its
+    own entry before rebuilding the index, so studies exported concurrently never corrupt it, and calling this again
+    once a cohort is completed guarantees that no study is missing from it.
+
+    :return: path of the index
+    """
+    entries_folder = os.path.join(dataset_folder, DATASET_ENTRIES_FOLDER_NAME)
+    studies = {}
+    if os.path.isdir(entries_folder):
+        for file_name in sorted(os.listdir(entries_folder)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(entries_folder, file_name)) as file:
+                studies[file_name[:-len(".json")]] = json.load(file)
+
+    index_path = os.path.join(dataset_folder, DATASET_INDEX_FILE_NAME)
+    temporary_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "w") as file:
+        json.dump({"studies": studies}, file, indent=2)
+    os.replace(temporary_path, index_path)
+    return index_path
+
+
+def open_study_store(dataset_folder: str, study_name: str):
+    """
+    :return: the zarr group of the study, whose arrays are only read chunk by chunk when sliced
+    """
+    return zarr.open_group(os.path.join(dataset_folder, study_name + STUDY_STORE_EXTENSION), mode="r")
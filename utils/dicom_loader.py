@@ -0,0 +1,173 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from utils.grids import VoxelGrid
+
+HEADER_TAGS = ["Modality", "SeriesInstanceUID", "SOPInstanceUID", "ImagePositionPatient", "ImageOrientationPatient",
+               "PixelSpacing", "Rows", "Columns"]
+# the headers of the last studies read, a study being read by several components in a row
+NB_OF_CACHED_FOLDERS = 8
+_cached_folders = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _list_files(dicom_folder: str) -> List[Tuple[str, int, int]]:
+    files = []
+    for root, _, file_names in os.walk(dicom_folder):
+        for file_name in sorted(file_names):
+            path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime_ns))
+
+    return sorted(files)
+
+
+def _read_header(path: str) -> Optional[pydicom.Dataset]:
+    try:
+        return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+    except (InvalidDicomError, OSError):
+        return None
+
+
+class DicomFolder:
+    def __init__(self, dicom_folder: str, nb_of_threads: int = 8):
+        """
+        Headers of the DICOM files of a study, read in parallel without their pixels, since on network mounted
+        folders the latency of each file dominates. The series are sorted and validated from the headers, before any
+        pixel is decoded.
+
+        :param dicom_folder: folder of the study, searched recursively
+        :param nb_of_threads: number of files read at the same time
+        """
+        self.dicom_folder = dicom_folder
+        self.nb_of_threads = nb_of_threads
+        self.files = _list_files(dicom_folder)
+        with ThreadPoolExecutor(max_workers=nb_of_threads) as executor:
+            headers = list(executor.map(_read_header, [path for path, _, _ in self.files]))
+        self.headers = [(path, header) for (path, _, _), header in zip(self.files, headers) if header is not None]
+        self.headers_by_modality = {}
+        for path, header in self.headers:
+            if "Modality" in header:
+                self.headers_by_modality.setdefault(str(header.Modality), []).append((path, header))
+
+    def sop_instance_uids(self) -> List[str]:
+        return sorted(str(header.SOPInstanceUID) for _, header in self.headers if "SOPInstanceUID" in header)
+
+    def paths(self, modality: str) -> List[str]:
+        return [path for path, _ in self.headers_by_modality.get(modality, [])]
+
+    def image_series(self, modality: str = "CT") -> List[Tuple[str, pydicom.Dataset]]:
+        """
+        :return: paths and headers of the slices of the largest series of modality, ordered as in its grid
+        :raises ValueError: when the slices do not share their geometry or two of them are at the same position
+        """
+        series = {}
+        for path, header in self.headers_by_modality.get(modality, []):
+            if "ImagePositionPatient" in header:
+                series.setdefault(str(header.get("SeriesInstanceUID", "")), []).append((path, header))
+        if len(series) == 0:
+            raise FileNotFoundError(f"No {modality} slice found in {self.dicom_folder}")
+        if len(series) > 1:
+            logging.warning(f"{len(series)} {modality} series in {self.dicom_folder}, the largest one is used")
+        slices = max(series.values(), key=len)
+
+        first = slices[0][1]
+        for path, header in slices:
+            for keyword in ["ImageOrientationPatient", "PixelSpacing", "Rows", "Columns"]:
+                if not np.allclose(np.asarray(header.get(keyword), dtype=np.float64),
+                                   np.asarray(first.get(keyword), dtype=np.float64)):
+                    raise ValueError(f"{path} does not share the {keyword} of its {modality} series")
+        grid = VoxelGrid.from_image_slices([header for _, header in slices])
+        offsets = [np.asarray([float(value) for value in header.ImagePositionPatient]) @ grid.normal
+                   for _, header in slices]
+        slices = [slices[index] for index in np.argsort(offsets)]
+        spacings = np.diff(grid.slice_offsets)
+        if np.any(spacings < 1e-3):
+            raise ValueError(f"Two {modality} slices of {self.dicom_folder} are at the same position")
+        if spacings.size > 0 and not np.allclose(spacings, spacings[0], atol=1e-2):
+            logging.warning(f"The {modality} slices of {self.dicom_folder} are not evenly spaced")
+
+        return slices
+
+    def image_grid(self, modality: str = "CT") -> VoxelGrid:
+        return VoxelGrid.from_image_slices([header for _, header in self.image_series(modality)])
+
+    def load_image_volume(self, modality: str = "CT", dtype=np.float32) -> Tuple[np.ndarray, VoxelGrid]:
+        """
+        Decodes the slices of the series with a thread pool, each one straight into its place in a preallocated
+        volume, rescaled (Hounsfield units for a CT).
+        """
+        slices = self.image_series(modality)
+        grid = VoxelGrid.from_image_slices([header for _, header in slices])
+        volume = np.empty(grid.shape, dtype=dtype)
+
+        def decode(slice_index: int):
+            image_slice = pydicom.dcmread(slices[slice_index][0])
+            volume[slice_index] = image_slice.pixel_array * float(image_slice.get("RescaleSlope", 1)) + \
+                float(image_slice.get("RescaleIntercept", 0))
+
+        with ThreadPoolExecutor(max_workers=self.nb_of_threads) as executor:
+            list(executor.map(decode, range(len(slices))))
+
+        return volume, grid
+
+
+def open_dicom_folder(dicom_folder: str, nb_of_threads: int = 8) -> DicomFolder:
+    """
+    :return: the headers of the study, read again only when one of its files was added, removed or modified
+    """
+    files = _list_files(dicom_folder)
+    key = os.path.abspath(dicom_folder)
+    with _cache_lock:
+        cached = _cached_folders.get(key)
+        if cached is not None and cached.files == files:
+            _cached_folders.move_to_end(key)
+            return cached
+    dicom_folder_headers = DicomFolder(dicom_folder, nb_of_threads)
+    with _cache_lock:
+        _cached_folders[key] = dicom_folder_headers
+        while len(_cached_folders) > NB_OF_CACHED_FOLDERS:
+            _cached_folders.popitem(last=False)
+
+    return dicom_folder_headers
+
+
+def read_image_series_grid(dicom_folder: str, modality: str = "CT") -> VoxelGrid:
+    """
+    Reads the geometry of the image series of a study from the headers of its slices, without their pixels.
+    """
+    return open_dicom_folder(dicom_folder).image_grid(modality)
+
+
+def read_image_series(dicom_folder: str, modality: str = "CT") -> Tuple[np.ndarray, VoxelGrid]:
+    """
+    Reads the image series of a study, rescaled (Hounsfield units for a CT), with the slices ordered as in its grid.
+    """
+    return open_dicom_folder(dicom_folder).load_image_volume(modality)
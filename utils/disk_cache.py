@@ -0,0 +1,182 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import hashlib
+import logging
+import os
+import shutil
+import uuid
+from importlib import metadata as importlib_metadata
+from typing import Callable, Optional
+
+
+def _update_key_hash(key_hash, part):
+    if isinstance(part, dict):
+        key_hash.update(b"{")
+        for key in sorted(part.keys(), key=repr):
+            _update_key_hash(key_hash, key)
+            _update_key_hash(key_hash, part[key])
+        key_hash.update(b"}")
+    elif isinstance(part, (list, tuple)):
+        key_hash.update(b"[")
+        for item in part:
+            _update_key_hash(key_hash, item)
+        key_hash.update(b"]")
+    elif hasattr(part, "tobytes") and hasattr(part, "shape") and hasattr(part, "dtype"):
+        # numpy arrays, whose repr is truncated when they are large
+        key_hash.update(f"array{part.shape}{part.dtype}".encode("utf-8"))
+        key_hash.update(part.tobytes())
+    else:
+        key_hash.update(repr(part).encode("utf-8"))
+    key_hash.update(b"\0")
+
+
+def make_cache_key(*parts) -> str:
+    """
+    Content address of a cache entry, built from everything the cached content depends on. Dictionaries, lists,
+    tuples and numpy arrays are hashed by content, anything else by its repr.
+    """
+    key_hash = hashlib.sha256()
+    for part in parts:
+        _update_key_hash(key_hash, part)
+
+    return key_hash.hexdigest()
+
+
+def file_checksum(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+
+def library_version(library: str) -> Optional[str]:
+    """
+    Version of an installed library, to be part of the keys of the entries it produces.
+    """
+    for distribution_name in [library, library.replace("_", "-")]:
+        try:
+            return importlib_metadata.version(distribution_name)
+        except importlib_metadata.PackageNotFoundError:
+            pass
+
+    return None
+
+
+def link_or_copy(source_path: str, destination_path: str):
+    """
+    Hard links the file when possible (same file system), to avoid duplicating large files, and copies it otherwise.
+    """
+    if os.path.exists(destination_path):
+        os.remove(destination_path)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copy(source_path, destination_path)
+
+
+def folder_size(folder: str) -> int:
+    size = 0
+    for root, _, file_names in os.walk(folder):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(root, file_name))
+            except OSError:
+                pass
+
+    return size
+
+
+class DiskCache:
+    def __init__(self, cache_folder: str, max_size: Optional[float] = None):
+        """
+        Content addressed cache where each entry is a folder of files. Entries are written in a temporary folder and
+        renamed once complete, so concurrent processes never read a partial entry. When max_size is given, the least
+        recently used entries are evicted until the cache fits in it.
+
+        :param cache_folder: folder holding the entries
+        :param max_size: maximum size of the cache in bytes, None for no limit
+        """
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def _entry_folder(self, key: str) -> str:
+        return os.path.join(self.cache_folder, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        :return: the folder of the entry, or None when the key is not cached
+        """
+        entry_folder = self._entry_folder(key)
+        if not os.path.isdir(entry_folder):
+            return None
+        try:
+            os.utime(entry_folder)
+        except OSError:
+            return None
+
+        return entry_folder
+
+    def put(self, key: str, populate: Callable[[str], None]) -> str:
+        """
+        Creates the entry of key by calling populate with an empty folder to fill.
+
+        :return: the folder of the entry
+        """
+        entry_folder = self._entry_folder(key)
+        temporary_folder = os.path.join(self.cache_folder, f".tmp_{uuid.uuid4().hex}")
+        os.makedirs(temporary_folder)
+        try:
+            populate(temporary_folder)
+            os.rename(temporary_folder, entry_folder)
+        except OSError:
+            if not os.path.isdir(entry_folder):
+                raise
+            # another process stored the same entry in the meantime
+        finally:
+            if os.path.exists(temporary_folder):
+                shutil.rmtree(temporary_folder, ignore_errors=True)
+        self.evict()
+        return entry_folder
+
+    def remove(self, key: str):
+        """
+        Removes the entry of key, so that it can be stored again.
+        """
+        shutil.rmtree(self._entry_folder(key), ignore_errors=True)
+
+    def evict(self):
+        if self.max_size is None:
+            return
+        entries = []
+        for key in os.listdir(self.cache_folder):
+            entry_folder = self._entry_folder(key)
+            if key.startswith(".tmp_") or not os.path.isdir(entry_folder):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry_folder), folder_size(entry_folder), entry_folder))
+            except OSError:
+                pass
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_folder in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logging.info(f"Evicting {entry_folder} from the cache")
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            total_size -= size
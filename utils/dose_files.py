@@ -0,0 +1,272 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import re
+from collections import namedtuple
+from typing import List
+
+import numpy as np
+
+
+TopasDimension = namedtuple("TopasDimension", ["name", "n_bins", "bin_width"])
+
+
+class Dose3D:
+    def __init__(self, positions: List[np.ndarray], dose: np.ndarray, uncertainty: np.ndarray):
+        """
+        Content of a .3ddose file, with the same conventions as py3ddose.DoseFile.
+
+        :param positions: voxel boundaries in cm, ordered z, y, x
+        :param dose: dose per history, shape (nz, ny, nx)
+        :param uncertainty: relative uncertainty on the dose, shape (nz, ny, nx)
+        """
+        self.positions = positions
+        self.dose = dose
+        self.uncertainty = uncertainty
+
+    @property
+    def shape(self):
+        return self.dose.shape
+
+    @property
+    def spacing(self) -> List[np.ndarray]:
+        return [np.diff(position) for position in self.positions]
+
+
+THREEDDOSE_SIDECAR_EXTENSION = ".npy"
+
+
+def _split_3ddose_values(values: np.ndarray) -> Dose3D:
+    # nx ny nz, the x, y and z boundaries, the dose and the relative uncertainties, x being the fastest index
+    nx, ny, nz = values[:3].astype(int)
+    nb_of_voxels = nx * ny * nz
+    start = 3
+    bounds = []
+    for nb_of_bins in [nx, ny, nz]:
+        bounds.append(values[start:start + nb_of_bins + 1])
+        start += nb_of_bins + 1
+    dose = values[start:start + nb_of_voxels].reshape((nz, ny, nx))
+    start += nb_of_voxels
+    if values.size >= start + nb_of_voxels:
+        uncertainty = values[start:start + nb_of_voxels].reshape((nz, ny, nx))
+    else:
+        uncertainty = np.full((nz, ny, nx), np.nan)
+
+    return Dose3D([bounds[2], bounds[1], bounds[0]], dose, uncertainty)
+
+
+def _write_3ddose_sidecar(sidecar_path: str, values: np.ndarray):
+    temporary_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary_path, "wb") as file:
+            np.save(file, values)
+        os.replace(temporary_path, sidecar_path)
+    except OSError as e:
+        logging.warning(f"Could not write the binary copy of the 3ddose {sidecar_path}: {e}")
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def read_3ddose(file_path: str, use_sidecar: bool = False) -> Dose3D:
+    """
+    Parses a .3ddose file in a single vectorized pass, since the whole file is a whitespace separated list of numbers.
+
+    :param file_path: path to the .3ddose file
+    :param use_sidecar: keeps the parsed values in a binary .npy file next to the .3ddose. The following reads memory
+                        map it instead of parsing the text, as long as it is more recent than the .3ddose.
+    :return: the dose, whose arrays are read-only views of the sidecar when it is used
+    """
+    sidecar_path = file_path + THREEDDOSE_SIDECAR_EXTENSION
+    if use_sidecar and os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(file_path):
+        try:
+            return _split_3ddose_values(np.load(sidecar_path, mmap_mode="r"))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Unreadable binary copy of the 3ddose {sidecar_path}, parsing the text again: {e}")
+
+    values = np.fromfile(file_path, sep=" ")
+    if use_sidecar:
+        _write_3ddose_sidecar(sidecar_path, values)
+
+    return _split_3ddose_values(values)
+
+
+def write_3ddose(file_path: str, dose_3d: Dose3D):
+    nz, ny, nx = dose_3d.shape
+    with open(file_path, "w") as file:
+        file.write(f"{nx} {ny} {nz}\n")
+        for position in [dose_3d.positions[2], dose_3d.positions[1], dose_3d.positions[0]]:
+            np.savetxt(file, position[np.newaxis], fmt="%.6f")
+        np.savetxt(file, dose_3d.dose.reshape(1, -1), fmt="%.6e")
+        np.savetxt(file, dose_3d.uncertainty.reshape(1, -1), fmt="%.6e")
+
+
+def combine_3ddose_files(file_paths: List[str], output_path: str) -> Dose3D:
+    """
+    Combines .3ddose files of independent runs having simulated the same number of histories. The dose is the mean of
+    the runs and its variance is the sum of the variances of the runs divided by the square of the number of runs.
+
+    :param file_paths: paths to the .3ddose files of each run
+    :param output_path: path where to save the combined .3ddose file
+    :return: the combined dose
+    """
+    dose_sum = None
+    variance_sum = None
+    positions = None
+    for file_path in file_paths:
+        dose_3d = read_3ddose(file_path)
+        if dose_sum is None:
+            positions = dose_3d.positions
+            dose_sum = np.zeros(dose_3d.shape)
+            variance_sum = np.zeros(dose_3d.shape)
+        dose_sum += dose_3d.dose
+        variance_sum += (dose_3d.uncertainty * dose_3d.dose) ** 2
+
+    nb_of_runs = len(file_paths)
+    dose = dose_sum / nb_of_runs
+    standard_deviation = np.sqrt(variance_sum) / nb_of_runs
+    uncertainty = np.divide(standard_deviation, dose, out=np.ones_like(dose), where=dose > 0)
+    combined = Dose3D(positions, dose, uncertainty)
+    write_3ddose(output_path, combined)
+    return combined
+
+
+def read_topas_binheader(header_path: str) -> dict:
+    """
+    Reads the binning and the statistics of a TOPAS binary output from its .binheader file.
+
+    :return: dictionary with "dimensions", a list of (name, nb_of_bins, bin_width in cm) ordered x, y, z, and
+             "statistics", the names of the statistics stored for each bin
+    """
+    binning_pattern = re.compile(r"^# (X|Y|Z|R|Phi|Theta) in (\d+) bins? +of ([-+]?[\d.]+(?:[eE][-+]?\d+)?) (cm|deg)")
+    statistics_pattern = re.compile(r"^# .+ : (.+)$")
+    dimensions = []
+    statistics = None
+    with open(header_path) as file:
+        header = file.read()
+    for line in header.splitlines():
+        binning = binning_pattern.match(line)
+        if binning is not None:
+            dimensions.append((binning.group(1), int(binning.group(2)), float(binning.group(3))))
+        elif statistics is None and statistics_pattern.match(line) is not None:
+            statistics = statistics_pattern.match(line).group(1).split()
+
+    return {"header": header, "dimensions": dimensions, "statistics": statistics}
+
+
+def merge_topas_binary_files(bin_paths: List[str], nb_of_histories: List[int], output_bin_path: str):
+    """
+    Merges the binary outputs of independent TOPAS runs of the same scorer, each with its own seed and number of
+    histories. Sums and counts are added. The per-history standard deviations are pooled from the first and second
+    moments of each run, so the result is the one a single run with all the histories would have given.
+
+    :param bin_paths: paths to the .bin file of each run, with their .binheader next to them
+    :param nb_of_histories: number of histories simulated by each run
+    :param output_bin_path: path of the merged .bin file, its .binheader is written next to it
+    :return: the merged statistics, as flat arrays ordered like the .bin file (x being the fastest index)
+    """
+    binheader = read_topas_binheader(bin_paths[0] + "header")
+    statistics = binheader["statistics"]
+    unsupported_statistics = set(statistics) - {"Sum", "Mean", "Standard_Deviation", "Variance", "Count_in_Bin",
+                                                "Histories_with_Scorer_Active", "Min", "Max"}
+    if len(unsupported_statistics) > 0:
+        raise ValueError(f"Can not merge TOPAS statistics {unsupported_statistics}")
+    if "Sum" not in statistics and "Mean" not in statistics:
+        raise ValueError("Merging TOPAS outputs needs the Sum or the Mean to be scored")
+
+    total_nb_of_histories = sum(nb_of_histories)
+    merged = {}
+    sum_of_squares = None
+    for bin_path, run_nb_of_histories in zip(bin_paths, nb_of_histories):
+        data = np.fromfile(bin_path).reshape((-1, len(statistics)))
+        run = {statistic: data[:, index] for index, statistic in enumerate(statistics)}
+        run_sum = run["Sum"] if "Sum" in run else run["Mean"] * run_nb_of_histories
+        merged["Sum"] = merged.get("Sum", 0) + run_sum
+        for statistic in ["Count_in_Bin", "Histories_with_Scorer_Active"]:
+            if statistic in run:
+                merged[statistic] = merged.get(statistic, 0) + run[statistic]
+        if "Min" in run:
+            merged["Min"] = np.minimum(merged["Min"], run["Min"]) if "Min" in merged else run["Min"]
+        if "Max" in run:
+            merged["Max"] = np.maximum(merged["Max"], run["Max"]) if "Max" in merged else run["Max"]
+        run_variance = None
+        if "Variance" in run:
+            run_variance = run["Variance"]
+        elif "Standard_Deviation" in run:
+            run_variance = run["Standard_Deviation"] ** 2
+        if run_variance is not None:
+            # sum of the squared per-history values of the run
+            run_sum_of_squares = (run_nb_of_histories - 1) * run_variance + run_sum ** 2 / run_nb_of_histories
+            sum_of_squares = run_sum_of_squares if sum_of_squares is None else sum_of_squares + run_sum_of_squares
+
+    merged["Mean"] = merged["Sum"] / total_nb_of_histories
+    if sum_of_squares is not None:
+        variance = (sum_of_squares - merged["Sum"] ** 2 / total_nb_of_histories) / (total_nb_of_histories - 1)
+        merged["Variance"] = np.clip(variance, 0, None)
+        merged["Standard_Deviation"] = np.sqrt(merged["Variance"])
+
+    np.stack([merged[statistic] for statistic in statistics], axis=1).astype(np.float64).tofile(output_bin_path)
+    with open(output_bin_path + "header", "w") as file:
+        file.write(binheader["header"])
+    return merged
+
+
+class TopasBinaryResult:
+    def __init__(self, bin_path: str):
+        """
+        Reader of a TOPAS binary output that memory maps the .bin file instead of loading it. The statistics are
+        interleaved for each bin, so each of them is a strided view of the file and only the pages actually read are
+        brought in memory. The arrays have the same shape and ordering as topas2numpy.BinnedResult.data, that is
+        indexed x, y, z.
+
+        :param bin_path: path to the .bin file, its .binheader being next to it
+        """
+        binheader = read_topas_binheader(bin_path + "header")
+        self.path = bin_path
+        self.statistics = binheader["statistics"]
+        self.dimensions = [TopasDimension(*dimension) for dimension in binheader["dimensions"]]
+        self.shape = tuple(dimension.n_bins for dimension in self.dimensions)
+        nb_of_values = int(np.prod(self.shape)) * len(self.statistics)
+        self._data = np.memmap(bin_path, dtype=np.float64, mode="r")
+        if self._data.size != nb_of_values:
+            raise ValueError(f"{bin_path} holds {self._data.size} values, {nb_of_values} expected from its header")
+        self._data = self._data.reshape((-1, len(self.statistics)))
+
+    def statistic(self, name: str, flipped: bool = False) -> np.ndarray:
+        """
+        :param name: name of the statistic, as in the .binheader (ex. Sum, Standard_Deviation)
+        :param flipped: whether to flip the first axis, as a view
+        :return: read-only view of the statistic in the memory mapped file
+        """
+        if name not in self.statistics:
+            raise KeyError(f"{name} is not scored in {self.path}, only {self.statistics}")
+        view = self._data[:, self.statistics.index(name)].reshape(self.shape, order="F")
+        if flipped:
+            return view[::-1]
+
+        return view
+
+
+def contains_nan(array: np.ndarray, nb_of_slices_per_chunk: int = 16) -> bool:
+    """
+    Looks for NaN by chunks of slices along the first axis, so that no full size boolean array is allocated.
+    """
+    for start in range(0, array.shape[0], nb_of_slices_per_chunk):
+        if np.isnan(array[start:start + nb_of_slices_per_chunk]).any():
+            return True
+
+    return False
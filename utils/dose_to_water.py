@@ -0,0 +1,191 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from root import ROOT
+
+MUEN_PATH = os.path.join(ROOT, "simulation_files", "Muen.dat")
+MATERIAL_FILE_PATH = os.path.join(ROOT, "egs_brachy_swapping_files", "material.dat")
+WATER_COMPOSITION = {1: 0.111894, 8: 0.888106}
+
+# atomic number and standard atomic weight of the elements of material.dat
+ELEMENTS = {"H": (1, 1.008), "B": (5, 10.81), "C": (6, 12.011), "N": (7, 14.007), "O": (8, 15.999),
+            "NA": (11, 22.990), "MG": (12, 24.305), "AL": (13, 26.982), "SI": (14, 28.085), "P": (15, 30.974),
+            "S": (16, 32.06), "CL": (17, 35.45), "AR": (18, 39.948), "K": (19, 39.098), "CA": (20, 40.078),
+            "TI": (22, 47.867), "CR": (24, 51.996), "MN": (25, 54.938), "FE": (26, 55.845), "CO": (27, 58.933),
+            "NI": (28, 58.693), "CU": (29, 63.546), "ZN": (30, 65.38), "BR": (35, 79.904), "Y": (39, 88.906),
+            "MO": (42, 95.95), "RH": (45, 102.906), "PD": (46, 106.42), "AG": (47, 107.868), "IN": (49, 114.818),
+            "TE": (52, 127.60), "I": (53, 126.904), "XE": (54, 131.293), "CS": (55, 132.905), "TA": (73, 180.948),
+            "W": (74, 183.84), "IR": (77, 192.217), "PT": (78, 195.084), "AU": (79, 196.967), "PB": (82, 207.2)}
+
+# photon lines (energy in MeV, photons per decay) of the radionuclides of the seeds, as in the TG-43U1 report
+SOURCE_SPECTRA = {"I-125": ((0.027202, 0.406), (0.027472, 0.757), (0.030980, 0.202), (0.031710, 0.0439),
+                            (0.035492, 0.0668)),
+                  "PD-103": ((0.020074, 0.224), (0.020216, 0.423), (0.022720, 0.104), (0.023180, 0.0194),
+                             (0.039750, 0.000683), (0.357500, 0.000221))}
+
+
+def normalize_radionuclide(name: str) -> str:
+    """
+    :return: name as in SOURCE_SPECTRA (ex. I-125 for I125, I-125 or I 125)
+    """
+    match = re.match(r"^([A-Za-z]+)[\s-]*(\d+)$", name.strip())
+    return f"{match.group(1)}-{match.group(2)}".upper() if match else name.strip().upper()
+
+
+@lru_cache(maxsize=None)
+def read_muen_table(muen_path: str = MUEN_PATH) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Reads the Muen.dat given to TOPAS: for each atomic number, a block of energies (MeV), mu/rho and mu_en/rho
+    (cm2/g).
+
+    :return: energies and mu_en/rho of each atomic number
+    """
+    with open(muen_path) as file:
+        rows = [line.split() for line in file if line.strip()]
+    table = {}
+    row_index = 0
+    while row_index < len(rows):
+        atomic_number, nb_of_energies = int(rows[row_index][0]), int(rows[row_index][1])
+        block = np.asarray(rows[row_index + 1:row_index + 1 + nb_of_energies], dtype=np.float64).reshape((-1, 3))
+        if nb_of_energies > 0:
+            table[atomic_number] = (block[:, 0], block[:, 2])
+        row_index += 1 + nb_of_energies
+
+    return table
+
+
+@lru_cache(maxsize=None)
+def read_material_compositions(material_file_path: str = MATERIAL_FILE_PATH) -> Dict[str, Dict[int, float]]:
+    """
+    Reads the elemental compositions of the media of an egs_brachy material.dat. The media only defined through a
+    density correction file are left out.
+
+    :return: mass fraction of each atomic number, by medium
+    """
+    media = {}
+    medium = {}
+
+    def add_medium():
+        if "name" not in medium or "elements" not in medium:
+            return
+        elements = [element.strip().upper() for element in medium["elements"].split(",")]
+        if "mass fractions" in medium:
+            weights = [float(value) for value in medium["mass fractions"].split(",")]
+        elif "number of atoms" in medium:
+            weights = [float(value) * ELEMENTS[element][1] for value, element in
+                       zip(medium["number of atoms"].split(","), elements)]
+        else:
+            return
+        if any(element not in ELEMENTS for element in elements):
+            return
+        total = sum(weights)
+        media[medium["name"]] = {ELEMENTS[element][0]: weight / total for element, weight in zip(elements, weights)}
+
+    with open(material_file_path) as file:
+        for line in file:
+            line = line.split("#")[0].strip()
+            if "=" not in line:
+                continue
+            key, value = [part.strip() for part in line.split("=", 1)]
+            if key == "medium":
+                add_medium()
+                medium = {"name": value}
+            else:
+                medium[key] = value
+        add_medium()
+
+    return media
+
+
+def mass_energy_absorption_coefficients(composition: Dict[int, float], energies: np.ndarray,
+                                        muen_path: str = MUEN_PATH) -> np.ndarray:
+    """
+    :return: mu_en/rho of a composition at energies (MeV), in cm2/g, log-log interpolated in Muen.dat
+    """
+    table = read_muen_table(muen_path)
+    log_energies = np.log(np.asarray(energies, dtype=np.float64))
+    coefficients = np.zeros(log_energies.shape)
+    for atomic_number, mass_fraction in composition.items():
+        if atomic_number not in table:
+            raise KeyError(f"No mu_en/rho of the element Z={atomic_number} in {muen_path}")
+        element_energies, element_coefficients = table[atomic_number]
+        coefficients += mass_fraction * np.exp(np.interp(log_energies, np.log(element_energies),
+                                                         np.log(element_coefficients)))
+
+    return coefficients
+
+
+def medium_composition(medium: str, material_file_path: str = MATERIAL_FILE_PATH,
+                       compositions: Optional[Dict[str, Dict[int, float]]] = None) -> Dict[int, float]:
+    """
+    :param compositions: mass fraction of each atomic number of the media that are not in material.dat (ex. the TOPAS
+                         media), by medium
+    :return: mass fraction of each atomic number of medium
+    """
+    if compositions is not None and medium in compositions:
+        return compositions[medium]
+    material_compositions = read_material_compositions(material_file_path)
+    if medium not in material_compositions:
+        raise KeyError(f"No elemental composition of {medium} in {material_file_path}")
+    return material_compositions[medium]
+
+
+@lru_cache(maxsize=None)
+def _water_to_composition_ratio(spectrum: Tuple[Tuple[float, float], ...], composition: Tuple[Tuple[int, float], ...],
+                                muen_path: str) -> float:
+    energies = np.asarray([line[0] for line in spectrum], dtype=np.float64)
+    energy_fluence = energies * np.asarray([line[1] for line in spectrum], dtype=np.float64)
+    water = mass_energy_absorption_coefficients(WATER_COMPOSITION, energies, muen_path)
+    medium_coefficients = mass_energy_absorption_coefficients(dict(composition), energies, muen_path)
+    return float(np.sum(energy_fluence * water) / np.sum(energy_fluence * medium_coefficients))
+
+
+def water_to_medium_ratio(spectrum: Tuple[Tuple[float, float], ...], medium: str,
+                          material_file_path: str = MATERIAL_FILE_PATH, muen_path: str = MUEN_PATH,
+                          compositions: Optional[Dict[str, Dict[int, float]]] = None) -> float:
+    """
+    Energy fluence weighted (mu_en/rho)w/m of a medium, cached by spectrum, that is by seed model, and composition.
+
+    :param spectrum: photon lines of the source, (energy in MeV, photons per decay)
+    :param medium: medium of material.dat or of compositions
+    :raise KeyError: when the composition of the medium, or the mu_en/rho of one of its elements, is unknown
+    """
+    composition = medium_composition(medium, material_file_path, compositions)
+    return _water_to_composition_ratio(spectrum, tuple(sorted(composition.items())), muen_path)
+
+
+def convert_to_dose_to_water(dose: np.ndarray, material_map: np.ndarray, media: List[str],
+                             spectrum: Tuple[Tuple[float, float], ...],
+                             material_file_path: str = MATERIAL_FILE_PATH, muen_path: str = MUEN_PATH,
+                             compositions: Optional[Dict[str, Dict[int, float]]] = None) -> np.ndarray:
+    """
+    Converts a dose to medium in medium (Dm,m) to a dose to water in medium (Dw,m), in one pass over the grid.
+
+    :param material_map: index in media of the medium of each voxel, on the grid of dose
+    :param media: media of material.dat or of compositions
+    :param spectrum: photon lines of the source, (energy in MeV, photons per decay)
+    :param compositions: mass fraction of each atomic number of the media that are not in material.dat, by medium
+    """
+    ratios = np.asarray([water_to_medium_ratio(spectrum, medium, material_file_path, muen_path, compositions)
+                         for medium in media])
+    return dose * ratios[material_map]
@@ -0,0 +1,170 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# dicompyler-core bins its DVHs by 1 cGy
+DVH_BIN_WIDTH = 0.01
+# D90 (Gy to 90% of the volume), D2cc (Gy to the hottest 2 cm3), V150 (% of the volume receiving 150% of the
+# prescription), Dmean, Dmin and Dmax
+DVH_METRIC_PATTERN = re.compile(r"^(?P<kind>[DV])(?P<value>\d+(\.\d+)?)(?P<cc>cc)?$")
+
+
+class CumulativeDVH:
+    def __init__(self, differential_volumes: np.ndarray, bin_width: float, mean: float):
+        """
+        Cumulative DVH with the same attributes as dicompyler-core's DVH, which is what utils.rt_dicom writes.
+
+        :param differential_volumes: volume in each dose bin, in cm3
+        :param bin_width: width of the dose bins, in Gy
+        :param mean: mean dose of the structure, in Gy
+        """
+        non_zero_bins = np.flatnonzero(differential_volumes)
+        nb_of_bins = non_zero_bins[-1] + 1 if non_zero_bins.size > 0 else 1
+        differential_volumes = differential_volumes[:nb_of_bins]
+        self.bins = np.arange(nb_of_bins + 1) * bin_width
+        self.counts = np.cumsum(differential_volumes[::-1])[::-1]
+        self.volume = float(self.counts[0])
+        self.mean = mean
+        self.min = float(self.bins[non_zero_bins[0]]) if non_zero_bins.size > 0 else 0.0
+        self.max = float(self.bins[nb_of_bins]) if non_zero_bins.size > 0 else 0.0
+
+
+def _layer_masks(masks: Dict[int, np.ndarray]) -> List[List[int]]:
+    """
+    Groups the structures in layers of structures that do not overlap, so that each layer is a single label map.
+    """
+    layers = []
+    layer_unions = []
+    for roi_number, mask in masks.items():
+        for layer, union in zip(layers, layer_unions):
+            if not np.any(union & mask):
+                layer.append(roi_number)
+                union |= mask
+                break
+        else:
+            layers.append([roi_number])
+            layer_unions.append(mask.copy())
+
+    return layers
+
+
+def _histogram_chunk(dose: np.ndarray, label_maps: List[np.ndarray], nb_of_labels: List[int], nb_of_bins: int,
+                     bin_width: float) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    # the bin of each voxel is shared by all the structures, and each layer of structures is one bincount
+    dose = dose.ravel()
+    bin_indices = np.clip((dose / bin_width).astype(np.int64), 0, nb_of_bins - 1)
+    histograms = []
+    dose_sums = []
+    for label_map, layer_nb_of_labels in zip(label_maps, nb_of_labels):
+        labels = label_map.ravel().astype(np.int64) - 1
+        inside = labels >= 0
+        histograms.append(np.bincount(labels[inside] * nb_of_bins + bin_indices[inside],
+                                      minlength=layer_nb_of_labels * nb_of_bins).reshape((layer_nb_of_labels,
+                                                                                           nb_of_bins)))
+        dose_sums.append(np.bincount(labels[inside], weights=dose[inside], minlength=layer_nb_of_labels))
+
+    return histograms, dose_sums
+
+
+def compute_cumulative_dvhs(dose: np.ndarray, masks: Dict[int, np.ndarray], voxel_volume: float,
+                            bin_width: float = DVH_BIN_WIDTH, limit: Optional[float] = None,
+                            nb_of_processes: int = 1, nb_of_slices_per_chunk: int = 16) -> Dict[int, CumulativeDVH]:
+    """
+    Computes the cumulative DVHs of all the structures in one pass over the dose grid.
+
+    :param dose: dose grid, in Gy
+    :param masks: mask of each ROI number, on the dose grid
+    :param voxel_volume: volume of a dose voxel, in cm3
+    :param bin_width: width of the dose bins, in Gy
+    :param limit: dose of the last bin, in Gy, the doses above it are counted in it. Defaults to the maximum dose.
+    :param nb_of_processes: number of processes sharing the chunks of slices, for very fine grids
+    :param nb_of_slices_per_chunk: number of slices of the dose grid processed at a time
+    :return: cumulative DVH of each ROI number
+    """
+    if limit is None:
+        limit = float(np.max(dose)) if dose.size > 0 else 0.0
+    nb_of_bins = int(limit / bin_width) + 1
+    layers = _layer_masks(masks)
+    label_maps = []
+    for layer in layers:
+        label_map = np.zeros(dose.shape, dtype=np.min_scalar_type(len(layer)))
+        for label, roi_number in enumerate(layer, start=1):
+            label_map[masks[roi_number]] = label
+        label_maps.append(label_map)
+    nb_of_labels = [len(layer) for layer in layers]
+
+    chunks = [(dose[start:start + nb_of_slices_per_chunk],
+               [label_map[start:start + nb_of_slices_per_chunk] for label_map in label_maps])
+              for start in range(0, dose.shape[0], nb_of_slices_per_chunk)]
+    if nb_of_processes > 1:
+        with ProcessPoolExecutor(max_workers=nb_of_processes) as executor:
+            results = list(executor.map(_histogram_chunk, [chunk[0] for chunk in chunks],
+                                        [chunk[1] for chunk in chunks], [nb_of_labels] * len(chunks),
+                                        [nb_of_bins] * len(chunks), [bin_width] * len(chunks)))
+    else:
+        results = [_histogram_chunk(chunk_dose, chunk_label_maps, nb_of_labels, nb_of_bins, bin_width)
+                   for chunk_dose, chunk_label_maps in chunks]
+
+    dvhs = {}
+    for layer_index, layer in enumerate(layers):
+        histograms = sum(result[0][layer_index] for result in results)
+        dose_sums = sum(result[1][layer_index] for result in results)
+        for label_index, roi_number in enumerate(layer):
+            nb_of_voxels = histograms[label_index].sum()
+            if nb_of_voxels == 0:
+                continue
+            dvhs[roi_number] = CumulativeDVH(histograms[label_index] * voxel_volume, bin_width,
+                                             float(dose_sums[label_index] / nb_of_voxels))
+
+    return dvhs
+
+
+def evaluate_dvh_metric(dvh: CumulativeDVH, metric: str, prescription_dose: float = 0) -> float:
+    """
+    :param metric: Dx (dose received by the hottest x% of the volume), Dxcc (by the hottest x cm3), Vx (% of the
+                   volume receiving at least x% of prescription_dose), Dmean, Dmin or Dmax
+    :param prescription_dose: in Gy, needed by the Vx metrics
+    :return: the metric, in Gy for the doses and in % for the volumes
+    """
+    if metric in ["Dmean", "Dmin", "Dmax"]:
+        return float(getattr(dvh, metric[1:]))
+    match = DVH_METRIC_PATTERN.match(metric)
+    if match is None:
+        raise ValueError(f"Unknown DVH metric {metric}")
+    value = float(match.group("value"))
+    if dvh.volume <= 0:
+        return float("nan")
+
+    if match.group("kind") == "D":
+        volume = value if match.group("cc") else value / 100 * dvh.volume
+        # the last bin still receiving the volume, counts decreasing with the dose
+        nb_of_bins_receiving = int(np.searchsorted(-dvh.counts, -volume, side="right"))
+        return float(dvh.bins[nb_of_bins_receiving - 1]) if nb_of_bins_receiving > 0 else 0.0
+
+    if match.group("cc"):
+        raise ValueError(f"Unknown DVH metric {metric}, the volume metrics are relative to the prescription")
+    if prescription_dose <= 0:
+        raise ValueError(f"{metric} needs a prescription dose")
+    bin_width = float(dvh.bins[1] - dvh.bins[0])
+    dose_bin = int(np.ceil(value / 100 * prescription_dose / bin_width - 1e-9))
+    if dose_bin >= dvh.counts.size:
+        return 0.0
+    return float(100 * dvh.counts[dose_bin] / dvh.volume)
@@ -0,0 +1,108 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from typing import Optional
+
+import numpy as np
+
+from utils.grids import VoxelGrid, interpolate_linear
+
+
+def _search_offsets(distance_criterion: float, max_gamma: float, resolution_factor: int) -> np.ndarray:
+    # points of a cubic lattice inside the search sphere, sorted by distance
+    step = distance_criterion / resolution_factor
+    nb_of_steps = int(np.ceil(max_gamma * resolution_factor))
+    axis = np.arange(-nb_of_steps, nb_of_steps + 1) * step
+    offsets = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape((-1, 3))
+    distances = np.linalg.norm(offsets, axis=1)
+    offsets = offsets[distances <= max_gamma * distance_criterion + 1e-9]
+    return offsets[np.argsort(np.linalg.norm(offsets, axis=1), kind="stable")]
+
+
+def gamma_index(reference: np.ndarray, reference_grid: VoxelGrid, evaluated: np.ndarray, evaluated_grid: VoxelGrid,
+                dose_criterion: float = 0.02, distance_criterion: float = 2.0, local: bool = False,
+                normalization_dose: Optional[float] = None, lower_dose_cutoff: float = 0.1, max_gamma: float = 2.0,
+                resolution_factor: int = 5) -> np.ndarray:
+    """
+    3D gamma index of an evaluated dose against a reference dose, computed at the voxels of the reference.
+
+    The evaluated dose is interpolated at offsets of the reference voxels on a lattice of distance_criterion /
+    resolution_factor, limited to the sphere of max_gamma * distance_criterion. The offsets are visited by increasing
+    distance for all the voxels at once, and a voxel leaves the search as soon as its gamma can not be lowered by
+    farther offsets, so most voxels are resolved after the first shells.
+
+    :param reference: reference dose, on reference_grid
+    :param evaluated: evaluated dose, on evaluated_grid
+    :param dose_criterion: dose difference criterion, as a fraction (0.02 for 2%)
+    :param distance_criterion: distance to agreement criterion, in mm
+    :param local: local gamma (dose difference relative to the reference dose of each voxel) instead of global
+    :param normalization_dose: dose of the global criterion and of the cutoff, defaults to the maximum reference dose
+    :param lower_dose_cutoff: fraction of normalization_dose below which the reference voxels are not evaluated
+    :param max_gamma: search radius, in units of distance_criterion. Voxels without agreement get max_gamma.
+    :param resolution_factor: number of search steps per distance_criterion
+    :return: gamma of each reference voxel, NaN for the voxels not evaluated
+    """
+    if normalization_dose is None:
+        normalization_dose = float(np.max(reference))
+    gamma = np.full(reference.shape, np.nan)
+    evaluated_voxels = np.flatnonzero(reference.ravel() >= lower_dose_cutoff * normalization_dose)
+    if evaluated_voxels.size == 0:
+        return gamma
+
+    voxel_indices = np.unravel_index(evaluated_voxels, reference.shape)
+    reference_doses = reference[voxel_indices].astype(np.float64)
+    dose_tolerances = dose_criterion * (reference_doses if local else np.full(reference_doses.shape,
+                                                                              normalization_dose))
+    dose_tolerances = np.maximum(dose_tolerances, np.finfo(np.float64).tiny)
+    # positions of the reference voxels in the evaluated grid, and how one mm along each patient axis moves in it
+    positions = np.stack([reference_grid.voxel_centers(slice_index) for slice_index in
+                          range(reference_grid.shape[0])])[voxel_indices]
+    base_indices = np.stack(evaluated_grid.continuous_indices(positions), axis=-1)
+    index_steps = np.stack(evaluated_grid.continuous_indices(evaluated_grid.origin + np.eye(3)), axis=-1) - \
+        np.stack(evaluated_grid.continuous_indices(evaluated_grid.origin), axis=-1)
+
+    squared_gamma = np.full(evaluated_voxels.size, max_gamma ** 2)
+    # the voxels outside of the evaluated grid are not evaluated
+    active = np.flatnonzero(~np.isnan(interpolate_linear(evaluated, base_indices[:, 0], base_indices[:, 1],
+                                                         base_indices[:, 2])))
+    squared_gamma[np.setdiff1d(np.arange(evaluated_voxels.size), active)] = np.nan
+    for offset in _search_offsets(distance_criterion, max_gamma, resolution_factor):
+        squared_distance = float(offset @ offset) / distance_criterion ** 2
+        # the offsets are sorted, no farther offset can lower the gamma of the voxels already below this distance
+        active = active[squared_gamma[active] > squared_distance]
+        if active.size == 0:
+            break
+        indices = base_indices[active] + offset @ index_steps
+        evaluated_doses = interpolate_linear(evaluated, indices[:, 0], indices[:, 1], indices[:, 2])
+        candidate = squared_distance + ((evaluated_doses - reference_doses[active]) / dose_tolerances[active]) ** 2
+        improved = candidate < squared_gamma[active]
+        squared_gamma[active[improved]] = candidate[improved]
+
+    gamma[voxel_indices] = np.sqrt(squared_gamma)
+    return gamma
+
+
+def pass_rate(gamma: np.ndarray, mask: Optional[np.ndarray] = None) -> Optional[float]:
+    """
+    :return: fraction of the evaluated voxels (in mask when given) with a gamma of at most 1, None when no voxel was
+             evaluated
+    """
+    values = gamma if mask is None else gamma[mask]
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return None
+
+    return float(np.mean(values <= 1))
@@ -0,0 +1,123 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pydicom
+
+from utils.dose_to_water import normalize_radionuclide
+from utils.grids import VoxelGrid
+
+# distance from the seeds, in mm, beyond which the dose of a permanent implant is a few % of its prescription
+DOSE_FALLOFF_MARGINS = {"I-125": 20.0, "PD-103": 15.0, "CS-131": 20.0}
+
+
+def read_seed_positions(rt_plan: pydicom.Dataset) -> np.ndarray:
+    """
+    :return: patient positions of the seeds of the plan, shape (nb_of_seeds, 3), in mm
+    """
+    positions = []
+    for application_setup in rt_plan.get("ApplicationSetupSequence", []):
+        for channel in application_setup.get("ChannelSequence", []):
+            for control_point in channel.get("BrachyControlPointSequence", []):
+                if "ControlPoint3DPosition" in control_point:
+                    positions.append([float(value) for value in control_point.ControlPoint3DPosition])
+    if len(positions) == 0:
+        return np.zeros((0, 3))
+
+    # the control points of a channel usually share the position of its seed
+    return np.unique(np.asarray(positions), axis=0)
+
+
+def read_source_radionuclide(rt_plan: pydicom.Dataset) -> Optional[str]:
+    sources = rt_plan.get("SourceSequence", [])
+    if len(sources) == 0 or "SourceIsotopeName" not in sources[0]:
+        return None
+    return normalize_radionuclide(str(sources[0].SourceIsotopeName))
+
+
+def _index_box_extent(grid: VoxelGrid, bounding_box: Tuple[slice, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    # the centers of the corner voxels of the box, in patient coordinates
+    corners = []
+    for slice_index in [bounding_box[0].start, bounding_box[0].stop - 1]:
+        for row in [bounding_box[1].start, bounding_box[1].stop - 1]:
+            for column in [bounding_box[2].start, bounding_box[2].stop - 1]:
+                corners.append(grid.origin + grid.slice_offsets[slice_index] * grid.normal +
+                               row * grid.pixel_spacing[0] * grid.column_direction +
+                               column * grid.pixel_spacing[1] * grid.row_direction)
+    corners = np.asarray(corners)
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def structures_extent(structure_masks, roi_names: List[str],
+                      grid: VoxelGrid) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    :param structure_masks: StructureMasks of the study, on grid
+    :return: lower and upper patient positions (x, y, z) of the union of the ROIs, in mm, None when none has a mask
+    """
+    extents = []
+    for roi_name in roi_names:
+        bounding_box = structure_masks.bounding_box(roi_name)
+        if bounding_box is not None and all(axis_box.stop > axis_box.start for axis_box in bounding_box):
+            extents.append(_index_box_extent(grid, bounding_box))
+    if len(extents) == 0:
+        return None
+
+    return np.min([lower for lower, _ in extents], axis=0), np.max([upper for _, upper in extents], axis=0)
+
+
+def minimal_extent(structures: Optional[Tuple[np.ndarray, np.ndarray]], seed_positions: np.ndarray,
+                   margin: float, grid: VoxelGrid) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Smallest box holding the structures and the seeds, extended by the dose falloff margin and kept inside the CT.
+
+    :param structures: extent of the structures, from structures_extent
+    :param seed_positions: positions of the seeds, in mm
+    :param margin: dose falloff margin, in mm
+    :param grid: CT grid
+    :return: lower and upper patient positions (x, y, z), in mm
+    """
+    points = [np.asarray(seed_positions, dtype=np.float64).reshape((-1, 3))]
+    if structures is not None:
+        points.append(np.asarray(structures))
+    points = np.concatenate(points)
+    if points.shape[0] == 0:
+        raise ValueError("Neither structure nor seed to fit the extent to")
+    ct_lower, ct_upper = _index_box_extent(grid, tuple(slice(0, size) for size in grid.shape))
+
+    return np.maximum(points.min(axis=0) - margin, ct_lower), np.minimum(points.max(axis=0) + margin, ct_upper)
+
+
+def custom_grid_from_extent(extent: Tuple[np.ndarray, np.ndarray], pixel_spacing) -> Dict[str, np.ndarray]:
+    """
+    :param pixel_spacing: spacing of the scoring grid along z, y and x, in mm
+    :return: custom_dose_grid of InputFileGenerators covering extent, centered on it
+    """
+    lower, upper = extent
+    pixel_spacing = np.asarray(pixel_spacing, dtype=np.float64)
+    shape = np.maximum(np.ceil((upper - lower)[::-1] / pixel_spacing).astype(int), 1)
+    return {"scorer_origin": (lower + upper) / 2, "pixel_spacing": pixel_spacing, "shape": shape}
+
+
+def crop_margin_from_extent(structures: Optional[Tuple[np.ndarray, np.ndarray]],
+                            extent: Tuple[np.ndarray, np.ndarray]) -> float:
+    """
+    :return: crop_to_contour_margin, in mm, for which the phantom cropped to the structures covers extent
+    """
+    if structures is None:
+        return 0.0
+    return float(max(0.0, np.max(structures[0] - extent[0]), np.max(extent[1] - structures[1])))
@@ -0,0 +1,206 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+from typing import List, Tuple
+
+import numpy as np
+import pydicom
+
+
+class VoxelGrid:
+    def __init__(self, origin, row_direction, column_direction, pixel_spacing, slice_offsets, nb_of_rows: int,
+                 nb_of_columns: int):
+        """
+        Geometry of a DICOM volume, whose arrays are indexed (slice, row, column), that is z, y, x for an axial
+        volume. The slices are ordered by increasing offset along the normal of the rows and columns, except for the
+        RT Doses whose frames go the other way, which have decreasing offsets.
+
+        :param origin: patient position of the center of the first voxel, in mm
+        :param row_direction: direction cosines of the rows (first three values of ImageOrientationPatient)
+        :param column_direction: direction cosines of the columns (last three values of ImageOrientationPatient)
+        :param pixel_spacing: spacing between the rows and between the columns, in mm, as in PixelSpacing
+        :param slice_offsets: position of each slice along the normal, relative to the origin, in mm
+        """
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.row_direction = np.asarray(row_direction, dtype=np.float64)
+        self.column_direction = np.asarray(column_direction, dtype=np.float64)
+        self.normal = np.cross(self.row_direction, self.column_direction)
+        self.pixel_spacing = np.asarray(pixel_spacing, dtype=np.float64)
+        self.slice_offsets = np.asarray(slice_offsets, dtype=np.float64)
+        self.shape = (len(self.slice_offsets), int(nb_of_rows), int(nb_of_columns))
+
+    @property
+    def slice_thickness(self) -> float:
+        if len(self.slice_offsets) < 2:
+            return 1.0
+        return float(np.mean(np.diff(self.slice_offsets)))
+
+    @property
+    def voxel_volume(self) -> float:
+        """
+        Volume of a voxel, in mm3.
+        """
+        return float(self.pixel_spacing[0] * self.pixel_spacing[1] * abs(self.slice_thickness))
+
+    @classmethod
+    def from_rt_dose(cls, rt_dose: pydicom.Dataset) -> "VoxelGrid":
+        orientation = [float(value) for value in rt_dose.ImageOrientationPatient]
+        slice_offsets = [0.0]
+        if "GridFrameOffsetVector" in rt_dose and rt_dose.GridFrameOffsetVector is not None:
+            slice_offsets = [float(offset) for offset in np.atleast_1d(rt_dose.GridFrameOffsetVector)]
+            # offsets can be absolute (first one equal to the z of the image position) or relative
+            slice_offsets = list(np.asarray(slice_offsets) - slice_offsets[0])
+            steps = np.diff(slice_offsets)
+            if not (np.all(steps > 0) or np.all(steps < 0)):
+                raise ValueError("The GridFrameOffsetVector of the RT Dose is not strictly monotonic")
+        return cls(rt_dose.ImagePositionPatient, orientation[:3], orientation[3:],
+                   [float(value) for value in rt_dose.PixelSpacing], slice_offsets, rt_dose.Rows, rt_dose.Columns)
+
+    @classmethod
+    def from_image_slices(cls, slices: List[pydicom.Dataset]) -> "VoxelGrid":
+        """
+        :param slices: headers of the slices of a series (ImagePositionPatient, ImageOrientationPatient, PixelSpacing,
+                       Rows and Columns are needed), in any order
+        """
+        orientation = np.asarray([float(value) for value in slices[0].ImageOrientationPatient])
+        normal = np.cross(orientation[:3], orientation[3:])
+        positions = np.asarray([[float(value) for value in image_slice.ImagePositionPatient]
+                                for image_slice in slices])
+        offsets = positions @ normal
+        order = np.argsort(offsets)
+        return cls(positions[order[0]], orientation[:3], orientation[3:],
+                   [float(value) for value in slices[0].PixelSpacing], offsets[order] - offsets[order[0]],
+                   slices[0].Rows, slices[0].Columns)
+
+    @classmethod
+    def regular(cls, origin, pixel_spacing, slice_thickness: float, shape,
+                image_orientation_patient=(1, 0, 0, 0, 1, 0)) -> "VoxelGrid":
+        """
+        :param shape: number of slices, rows and columns
+        """
+        return cls(origin, image_orientation_patient[:3], image_orientation_patient[3:], pixel_spacing,
+                   np.arange(shape[0]) * float(slice_thickness), shape[1], shape[2])
+
+    def voxel_centers(self, slice_index: int) -> np.ndarray:
+        """
+        :return: patient positions of the centers of the voxels of one slice, shape (rows, columns, 3), in mm
+        """
+        rows = np.arange(self.shape[1]) * self.pixel_spacing[0]
+        columns = np.arange(self.shape[2]) * self.pixel_spacing[1]
+        return (self.origin + self.slice_offsets[slice_index] * self.normal
+                + rows[:, np.newaxis, np.newaxis] * self.column_direction
+                + columns[np.newaxis, :, np.newaxis] * self.row_direction)
+
+    def continuous_indices(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param points: patient positions in mm, shape (..., 3)
+        :return: fractional (slice, row, column) indices of the points in this grid
+        """
+        relative = points - self.origin
+        rows = relative @ self.column_direction / self.pixel_spacing[0]
+        columns = relative @ self.row_direction / self.pixel_spacing[1]
+        offsets = relative @ self.normal
+        if len(self.slice_offsets) > 1:
+            slice_offsets = self.slice_offsets
+            if slice_offsets[-1] < slice_offsets[0]:
+                # np.interp needs increasing offsets, the index of a point is the same along the opposite normal
+                slice_offsets = -slice_offsets
+                offsets = -offsets
+            slices = np.interp(offsets, slice_offsets, np.arange(len(slice_offsets)))
+            # np.interp clamps outside of the offsets, extrapolated with the first and last slice spacing instead
+            first_spacing = slice_offsets[1] - slice_offsets[0]
+            last_spacing = slice_offsets[-1] - slice_offsets[-2]
+            slices = np.where(offsets < slice_offsets[0], (offsets - slice_offsets[0]) / first_spacing, slices)
+            slices = np.where(offsets > slice_offsets[-1],
+                              len(slice_offsets) - 1 + (offsets - slice_offsets[-1]) / last_spacing, slices)
+        else:
+            slices = offsets / self.slice_thickness
+        return slices, rows, columns
+
+
+def resample_nearest(volume: np.ndarray, source_grid: VoxelGrid, target_grid: VoxelGrid, fill_value=0) -> np.ndarray:
+    """
+    Nearest neighbour resampling of a volume from its grid onto another one, slice by slice so that only the
+    coordinates of one target slice are held in memory at a time.
+    """
+    resampled = np.full(target_grid.shape, fill_value, dtype=volume.dtype)
+    for slice_index in range(target_grid.shape[0]):
+        indices = [np.rint(index).astype(np.int64) for index in
+                   source_grid.continuous_indices(target_grid.voxel_centers(slice_index))]
+        inside = np.ones(indices[0].shape, dtype=bool)
+        for index, size in zip(indices, source_grid.shape):
+            inside &= (index >= 0) & (index < size)
+        resampled[slice_index][inside] = volume[indices[0][inside], indices[1][inside], indices[2][inside]]
+
+    return resampled
+
+
+def interpolate_linear(volume: np.ndarray, slices: np.ndarray, rows: np.ndarray, columns: np.ndarray,
+                       fill_value=np.nan) -> np.ndarray:
+    """
+    Trilinear interpolation of a volume at fractional (slice, row, column) indices, fill_value being returned
+    outside of the volume. A volume with a single slice is interpolated in 2D.
+    """
+    indices = [np.asarray(slices, dtype=np.float64), np.asarray(rows, dtype=np.float64),
+               np.asarray(columns, dtype=np.float64)]
+    inside = np.ones(indices[0].shape, dtype=bool)
+    lower_indices = []
+    weights = []
+    for index, size in zip(indices, volume.shape):
+        if size == 1:
+            inside &= np.abs(index) <= 0.5
+            lower_indices.append(np.zeros(index.shape, dtype=np.int64))
+            weights.append(np.zeros(index.shape))
+            continue
+        inside &= (index >= 0) & (index <= size - 1)
+        lower_index = np.clip(np.floor(index).astype(np.int64), 0, size - 2)
+        lower_indices.append(lower_index)
+        weights.append(np.clip(index - lower_index, 0, 1))
+
+    interpolated = np.zeros(indices[0].shape, dtype=np.float64)
+    for corner in range(8):
+        corner_weight = np.ones(indices[0].shape, dtype=np.float64)
+        corner_indices = []
+        for axis in range(3):
+            upper = (corner >> axis) & 1
+            if volume.shape[axis] == 1:
+                if upper:
+                    corner_weight = np.zeros(indices[0].shape)
+                corner_indices.append(lower_indices[axis])
+                continue
+            corner_weight = corner_weight * (weights[axis] if upper else 1 - weights[axis])
+            corner_indices.append(lower_indices[axis] + upper)
+        if not np.any(corner_weight):
+            continue
+        interpolated += corner_weight * volume[corner_indices[0], corner_indices[1], corner_indices[2]]
+
+    return np.where(inside, interpolated, fill_value)
+
+
+def resample_linear(volume: np.ndarray, source_grid: VoxelGrid, target_grid: VoxelGrid, fill_value=0,
+                    nb_of_slices_per_chunk: int = 8) -> np.ndarray:
+    """
+    Trilinear resampling of a volume from its grid onto another one, by chunks of target slices so that only the
+    coordinates of nb_of_slices_per_chunk slices are held in memory at a time.
+    """
+    resampled = np.empty(target_grid.shape, dtype=np.result_type(volume.dtype, np.float32))
+    for start in range(0, target_grid.shape[0], nb_of_slices_per_chunk):
+        stop = min(start + nb_of_slices_per_chunk, target_grid.shape[0])
+        points = np.stack([target_grid.voxel_centers(slice_index) for slice_index in range(start, stop)])
+        resampled[start:stop] = interpolate_linear(volume, *source_grid.continuous_indices(points),
+                                                   fill_value=fill_value)
+
+    return resampled
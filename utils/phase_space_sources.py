@@ -0,0 +1,281 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from typing import Dict, Optional, Tuple
+
+from utils.disk_cache import DiskCache, make_cache_key
+
+PHASE_SPACE_CACHE_VERSION = 1
+SOURCE_MODEL_FILE_NAME = "source_model.json"
+SEED_GEOMETRY_PATTERN = re.compile(r"include file\s*=\s*(\S*lib/geometry/sources/\S+/([^/\s]+)_wrapped\.geom)")
+SOURCE_BLOCK_PATTERN = re.compile(r"([ \t]*):start source:\n(.*?)\n[ \t]*:stop source:", re.DOTALL)
+TRANSFORMATIONS_BLOCK_PATTERN = re.compile(r"[ \t]*:start transformations:.*?:stop transformations:", re.DOTALL)
+
+
+def _replace_block(text: str, block_name: str, replacement: str) -> str:
+    pattern = re.compile(rf"[ \t]*:start {block_name}:.*?:stop {block_name}:", re.DOTALL)
+    if pattern.search(text) is None:
+        return text.rstrip("\n") + "\n" + replacement + "\n"
+    return pattern.sub(lambda _: replacement, text, count=1)
+
+
+def find_seed_model(egsinp: str) -> Tuple[str, str]:
+    """
+    :return: name of the seed model of an egs_brachy input file (ex. Advantage_IAI_125A) and path of its geometry
+    """
+    match = SEED_GEOMETRY_PATTERN.search(egsinp)
+    if match is None:
+        raise ValueError("No seed geometry of the egs_brachy library found in the input file")
+    return match.group(2), match.group(1).replace("_wrapped.geom", ".geom")
+
+
+def read_iaea_header(header_path: str) -> Dict[str, int]:
+    """
+    :return: number of original histories (decays) and of particles of an IAEA phase space
+    """
+    with open(header_path) as file:
+        lines = [line.strip() for line in file]
+    counts = {}
+    for keyword, name in [("$ORIG_HISTORIES:", "orig_histories"), ("$PARTICLES:", "particles")]:
+        if keyword not in lines:
+            raise ValueError(f"No {keyword} in {header_path}")
+        counts[name] = int(float(lines[lines.index(keyword) + 1].split()[0]))
+    return counts
+
+
+def write_phase_space_generation_input(egsinp: str, nb_of_histories: int) -> str:
+    """
+    Reduces the egs_brachy input file of a study to a single seed of its model at the origin, in vacuum, whose
+    photons are scored in an IAEA phase space as they leave the capsule. The run control, media, transport and
+    source spectrum of the study are kept, so the phase space is what the full seed geometry would emit.
+    """
+    seed_model, seed_geometry = find_seed_model(egsinp)
+    geometry = f""":start geometry definition:
+    :start geometry:
+        name = vacuum
+        library = egs_spheres
+        type = EGS_cSpheres
+        midpoint = 0 0 0
+        radii = 1
+    :stop geometry:
+    :start geometry:
+        name = seed
+        library = egs_glib
+        include file = {seed_geometry}
+    :stop geometry:
+    :start geometry:
+        name = seed_in_vacuum
+        library = egs_genvelope
+        base geometry = vacuum
+        inscribed geometries = seed
+    :stop geometry:
+    simulation geometry = seed_in_vacuum
+    source geometries = seed
+    phantom geometries = vacuum
+:stop geometry definition:"""
+    transformations = """    :start transformations:
+        :start transformation:
+            translation = 0 0 0
+        :stop transformation:
+    :stop transformations:"""
+    scoring = """:start scoring options:
+    score tracklength dose = no
+    score energy deposition = no
+    :start phsp scoring:
+        output format = IAEA
+        particle type = photons
+        kill after scoring = yes
+    :stop phsp scoring:
+:stop scoring options:"""
+
+    generation_input = _replace_block(egsinp, "geometry definition", geometry)
+    generation_input = TRANSFORMATIONS_BLOCK_PATTERN.sub(lambda _: transformations, generation_input, count=1)
+    generation_input = _replace_block(generation_input, "scoring options", scoring)
+    generation_input = re.sub(r"[ \t]*:start variance reduction:.*?:stop variance reduction:\n?", "",
+                              generation_input, flags=re.DOTALL)
+    generation_input = re.sub(r"(?m)^(\s*ncase\s*=\s*)\S+", lambda match: f"{match.group(1)}{int(nb_of_histories)}",
+                              generation_input)
+    logging.info(f"Phase space generation input of {seed_model} written for {int(nb_of_histories)} histories")
+    return generation_input
+
+
+class SourceModelLibrary:
+    def __init__(self, library_folder: str, code_version: Optional[str] = None, nb_of_histories: int = int(1e8)):
+        """
+        Phase spaces of the seed models, each one generated once with egs_brachy and reused by every study, by
+        egs_brachy and TOPAS alike since both read the IAEA format. An entry, <model>_<key> in library_folder, holds
+        <model>.IAEAheader, <model>.IAEAphsp and source_model.json.
+
+        :param code_version: version of egs_brachy generating the phase spaces, part of their key
+        :param nb_of_histories: number of decays of each generation run
+        """
+        self.library_folder = library_folder
+        self.code_version = code_version
+        self.nb_of_histories = int(nb_of_histories)
+        self.cache = DiskCache(library_folder)
+
+    def _key(self, seed_model: str) -> str:
+        return f"{seed_model}_" + make_cache_key("phase_space", PHASE_SPACE_CACHE_VERSION, seed_model,
+                                                 self.code_version, self.nb_of_histories)
+
+    def _read_entry(self, seed_model: str, entry_folder: str) -> Dict:
+        with open(os.path.join(entry_folder, SOURCE_MODEL_FILE_NAME)) as file:
+            source_model = json.load(file)
+        source_model["phase_space"] = os.path.join(entry_folder, seed_model)
+        return source_model
+
+    def get(self, seed_model: str) -> Optional[Dict]:
+        """
+        :return: the phase space of the model (path without extension, numbers of decays and particles), None when
+                 it was never generated
+        """
+        entry_folder = self.cache.get(self._key(seed_model))
+        return None if entry_folder is None else self._read_entry(seed_model, entry_folder)
+
+    def get_or_generate(self, egsinp: str, egs_brachy_home: str) -> Dict:
+        """
+        :param egsinp: egs_brachy input file of a study, whose seed model and source are used
+        :return: the phase space of the seed model of egsinp, generated when not in the library yet
+        """
+        seed_model, _ = find_seed_model(egsinp)
+        source_model = self.get(seed_model)
+        if source_model is not None:
+            return source_model
+
+        def populate(folder: str):
+            self._generate(seed_model, egsinp, egs_brachy_home, folder)
+
+        logging.info(f"Generating the phase space of {seed_model}, once for every study")
+        return self._read_entry(seed_model, self.cache.put(self._key(seed_model), populate))
+
+    def _generate(self, seed_model: str, egsinp: str, egs_brachy_home: str, folder: str):
+        # private EGS_HOME sharing the libraries of egs_brachy_home, as for the simulations
+        egs_brachy_home = os.path.normpath(egs_brachy_home)
+        run_egs_home = tempfile.mkdtemp(prefix=f"phsp_{seed_model}_", dir=folder)
+        run_directory = os.path.join(run_egs_home, os.path.basename(egs_brachy_home))
+        os.makedirs(run_directory)
+        os.symlink(os.path.join(egs_brachy_home, "lib"), os.path.join(run_directory, "lib"))
+        input_name = f"phsp_{seed_model}"
+        with open(os.path.join(run_directory, input_name + ".egsinp"), "w") as file:
+            file.write(write_phase_space_generation_input(egsinp, self.nb_of_histories))
+        simulation = subprocess.run(["egs_brachy", "-i", input_name], capture_output=True, cwd=run_directory,
+                                    env=dict(os.environ, EGS_HOME=os.path.join(run_egs_home, "")))
+        if simulation.returncode != 0:
+            raise RuntimeError(f"The phase space generation of {seed_model} failed: "
+                               f"{simulation.stderr.decode(errors='replace')[-2000:]}")
+
+        header_file_names = [file_name for file_name in os.listdir(run_directory) if file_name.endswith(".IAEAheader")]
+        if len(header_file_names) == 0:
+            raise FileNotFoundError(f"egs_brachy did not write the phase space of {seed_model}")
+        phase_space = os.path.join(run_directory, header_file_names[0][:-len(".IAEAheader")])
+        for extension in [".IAEAheader", ".IAEAphsp"]:
+            shutil.move(phase_space + extension, os.path.join(folder, seed_model + extension))
+        shutil.rmtree(run_egs_home)
+        source_model = {"seed_model": seed_model, "code": "egs_brachy", "code_version": self.code_version}
+        source_model.update(read_iaea_header(os.path.join(folder, seed_model + ".IAEAheader")))
+        with open(os.path.join(folder, SOURCE_MODEL_FILE_NAME), "w") as file:
+            json.dump(source_model, file, indent=2)
+
+
+def use_phase_space_in_egsinp(egsinp: str, source_model: Dict) -> Tuple[str, float]:
+    """
+    Replaces the source of an egs_brachy input file by the phase space of its seed model, placed at every seed by
+    the transformations of the study. Each phase space particle being a history, ncase is scaled so that as many
+    decays are simulated, and the dose per history is converted to a dose per decay by the returned factor.
+
+    :return: the input file and the factor of its dose per history
+    """
+    particles_per_decay = source_model["particles"] / source_model["orig_histories"]
+
+    def replace_source(match: re.Match) -> str:
+        indent = match.group(1)
+        name = re.search(r"(?m)^\s*name\s*=\s*(\S+)", match.group(2))
+        lines = [f"{indent}:start source:"]
+        if name is not None:
+            lines.append(f"{indent}    name = {name.group(1)}")
+        lines += [f"{indent}    library = iaea_phsp_source",
+                  f"{indent}    iaea phase space file = {source_model['phase_space']}",
+                  f"{indent}    particle type = photons",
+                  f"{indent}:stop source:"]
+        return "\n".join(lines)
+
+    if SOURCE_BLOCK_PATTERN.search(egsinp) is None:
+        raise ValueError("No source found in the egs_brachy input file")
+    egsinp = SOURCE_BLOCK_PATTERN.sub(replace_source, egsinp, count=1)
+    egsinp = re.sub(r"(?m)^(\s*ncase\s*=\s*)(\S+)",
+                    lambda match: f"{match.group(1)}{int(math.ceil(float(match.group(2)) * particles_per_decay))}",
+                    egsinp)
+    return egsinp, particles_per_decay
+
+
+def use_phase_space_in_topas(topas_input: str, source_model: Dict) -> Tuple[str, float]:
+    """
+    Replaces every source of a TOPAS input file by the phase space of the seed model, in the frame of the
+    Component of the source. The empty histories are included so that a TOPAS history stays a decay. A source
+    requesting fewer decays than the phase space holds reads only that many histories of it (PhaseSpaceMultipleUse of
+    0, NumberOfHistoriesInRun being kept), otherwise the whole phase space is reused as many times as the decays of the
+    source require.
+
+    :return: the input file and the factor of its dose, the requested decays over the simulated ones
+    """
+    source_pattern = re.compile(r'^\s*\w+:So/([^/=\s]+)/(\w+)\s*=\s*(.*)$')
+    lines = topas_input.split("\n")
+    sources = {}
+    for line in lines:
+        match = source_pattern.match(line)
+        if match is not None:
+            sources.setdefault(match.group(1), {})[match.group(2)] = match.group(3).strip()
+    if len(sources) == 0:
+        raise ValueError("No source found in the TOPAS input file")
+
+    orig_histories = source_model["orig_histories"]
+    requested_decays = 0
+    simulated_decays = 0
+    rewritten_sources = {}
+    for name, parameters in sources.items():
+        decays = int(parameters.get("NumberOfHistoriesInRun", orig_histories).split()[0])
+        requested_decays += decays
+        if decays < orig_histories:
+            multiple_use = 0
+            simulated_decays += decays
+        else:
+            multiple_use = int(round(decays / orig_histories))
+            simulated_decays += multiple_use * orig_histories
+        rewritten_sources[name] = [f's:So/{name}/Type = "PhaseSpace"',
+                                   f's:So/{name}/PhaseSpaceFileName = "{source_model["phase_space"]}"',
+                                   f'i:So/{name}/PhaseSpaceMultipleUse = {multiple_use}',
+                                   f'b:So/{name}/PhaseSpaceIncludeEmptyHistories = "True"']
+        if multiple_use == 0:
+            rewritten_sources[name].append(f"i:So/{name}/NumberOfHistoriesInRun = {decays}")
+        if "Component" in parameters:
+            rewritten_sources[name].insert(1, f"s:So/{name}/Component = {parameters['Component']}")
+
+    rewritten_lines = []
+    for line in lines:
+        match = source_pattern.match(line)
+        if match is None:
+            rewritten_lines.append(line)
+        elif match.group(1) in rewritten_sources:
+            rewritten_lines += rewritten_sources.pop(match.group(1))
+    return "\n".join(rewritten_lines), requested_decays / simulated_decays
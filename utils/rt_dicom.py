@@ -0,0 +1,192 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import copy
+from typing import Dict, List, Optional
+
+import numpy as np
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+
+from utils.grids import VoxelGrid
+
+# attributes of the patient, study and frame of reference the RT Doses share with the plan they are computed from
+SHARED_PLAN_ATTRIBUTES = ["PatientName", "PatientID", "PatientBirthDate", "PatientSex", "StudyInstanceUID",
+                          "StudyDate", "StudyTime", "StudyID", "StudyDescription", "ReferringPhysicianName",
+                          "AccessionNumber", "FrameOfReferenceUID", "PositionReferenceIndicator"]
+
+
+def _reference_to(dataset: Dataset) -> Dataset:
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = dataset.SOPClassUID
+    reference.ReferencedSOPInstanceUID = dataset.SOPInstanceUID
+    return reference
+
+
+def adapt_rt_dose_to_rt_plan(rt_dose: Dataset, rt_plan: Dataset):
+    """
+    In memory counterpart of mcdose2dicom's adapt_rt_dose_to_existing_rt_plan: the RT Dose gets the patient, study
+    and frame of reference of the plan, and a reference to it.
+    """
+    for attribute in SHARED_PLAN_ATTRIBUTES:
+        if attribute in rt_plan:
+            setattr(rt_dose, attribute, rt_plan.data_element(attribute).value)
+    rt_dose.ReferencedRTPlanSequence = Sequence([_reference_to(rt_plan)])
+
+
+def add_rt_dose_reference_to_rt_plan(rt_plan: Dataset, rt_dose: Dataset):
+    """
+    In memory counterpart of mcdose2dicom's add_reference_in_rt_plan.
+    """
+    if "ReferencedDoseSequence" not in rt_plan:
+        rt_plan.ReferencedDoseSequence = Sequence()
+    rt_plan.ReferencedDoseSequence.append(_reference_to(rt_dose))
+
+
+def get_dose_array(rt_dose: Dataset) -> np.ndarray:
+    """
+    :return: dose grid of the RT Dose, indexed (frame, row, column), in the units of the RT Dose
+    """
+    return rt_dose.pixel_array.reshape((int(rt_dose.get("NumberOfFrames", 1)), int(rt_dose.Rows),
+                                        int(rt_dose.Columns))) * float(rt_dose.DoseGridScaling)
+
+
+def resampled_rt_dose(rt_dose: Dataset, dose: np.ndarray, grid: VoxelGrid) -> Dataset:
+    """
+    New instance of the RT Dose holding dose, on grid. The DVHs of the RT Dose are not kept, they belong to its grid.
+    """
+    resampled = copy.deepcopy(rt_dose)
+    for keyword in ["DVHSequence", "DVHNormalizationPoint", "DVHNormalizationDoseValue"]:
+        if keyword in resampled:
+            delattr(resampled, keyword)
+    resampled.SOPInstanceUID = generate_uid()
+    if hasattr(resampled, "file_meta"):
+        resampled.file_meta.MediaStorageSOPInstanceUID = resampled.SOPInstanceUID
+    resampled.ImagePositionPatient = [float(value) for value in grid.origin]
+    resampled.ImageOrientationPatient = [float(value) for value in np.concatenate([grid.row_direction,
+                                                                                   grid.column_direction])]
+    resampled.PixelSpacing = [float(value) for value in grid.pixel_spacing]
+    resampled.NumberOfFrames, resampled.Rows, resampled.Columns = grid.shape
+    resampled.GridFrameOffsetVector = [float(offset) for offset in grid.slice_offsets]
+    if "SliceThickness" in resampled:
+        resampled.SliceThickness = abs(grid.slice_thickness)
+
+    dose = np.clip(np.nan_to_num(np.asarray(dose, dtype=np.float64)), 0, None)
+    pixel_type = np.uint32 if int(resampled.BitsAllocated) == 32 else np.uint16
+    maximum_pixel_value = np.iinfo(pixel_type).max
+    dose_grid_scaling = float(np.max(dose)) / maximum_pixel_value if dose.size > 0 and np.max(dose) > 0 else 1.0
+    resampled.DoseGridScaling = dose_grid_scaling
+    resampled.PixelData = np.rint(dose / dose_grid_scaling).astype(pixel_type).tobytes()
+    return resampled
+
+
+def dose_frames(dose: np.ndarray, start: int, stop: int, zyx_ordered: bool = True) -> np.ndarray:
+    """
+    :param dose: dose grid indexed (frame, row, column) when zyx_ordered, (column, row, frame) otherwise (TOPAS)
+    :return: view of the frames start to stop, indexed (frame, row, column)
+    """
+    if zyx_ordered:
+        return dose[start:stop]
+    return dose[:, :, start:stop].transpose(2, 1, 0)
+
+
+def set_dose_grid_pixels(rt_dose: Dataset, dose: np.ndarray, dose_factor: float = 1.0, zyx_ordered: bool = True,
+                         weights: Optional[np.ndarray] = None, nb_of_slices_per_chunk: int = 16):
+    """
+    Writes dose * dose_factor (* weights) as the frames of the RT Dose, converted and scaled slab by slab into the pixel
+    data, so that a memory mapped dose is read a few frames at a time and never converted to floats as a whole. The
+    slabs are read twice, the first pass finding the DoseGridScaling. Rows and Columns are expected to already match
+    the dose.
+
+    :param dose: dose grid indexed (frame, row, column) when zyx_ordered, (column, row, frame) otherwise (TOPAS)
+    :param weights: multiplies the dose voxel by voxel, ex. the dose of a relative uncertainty
+    """
+    nb_of_frames = dose.shape[0] if zyx_ordered else dose.shape[2]
+    chunks = [(start, min(start + nb_of_slices_per_chunk, nb_of_frames))
+              for start in range(0, nb_of_frames, nb_of_slices_per_chunk)]
+
+    def chunk_of(start: int, stop: int, out: np.ndarray) -> np.ndarray:
+        np.multiply(dose_frames(dose, start, stop, zyx_ordered), dose_factor, out=out)
+        if weights is not None:
+            np.multiply(out, dose_frames(weights, start, stop, zyx_ordered), out=out)
+        np.nan_to_num(out, copy=False)
+        return np.clip(out, 0, None, out=out)
+
+    frame_shape = dose_frames(dose, 0, 1, zyx_ordered).shape[1:]
+    buffer = np.empty((min(nb_of_slices_per_chunk, nb_of_frames),) + frame_shape, dtype=np.float64)
+    maximum = 0.0
+    for start, stop in chunks:
+        chunk = chunk_of(start, stop, buffer[:stop - start])
+        maximum = max(maximum, float(chunk.max()) if chunk.size > 0 else 0.0)
+    pixel_type = np.uint32 if int(rt_dose.BitsAllocated) == 32 else np.uint16
+    dose_grid_scaling = maximum / np.iinfo(pixel_type).max if maximum > 0 else 1.0
+
+    pixels = np.empty((nb_of_frames,) + frame_shape, dtype=pixel_type)
+    for start, stop in chunks:
+        chunk = chunk_of(start, stop, buffer[:stop - start])
+        np.divide(chunk, dose_grid_scaling, out=chunk)
+        pixels[start:stop] = np.rint(chunk, out=chunk)
+    rt_dose.NumberOfFrames = nb_of_frames
+    rt_dose.DoseGridScaling = dose_grid_scaling
+    rt_dose.PixelData = pixels.tobytes()
+
+
+def get_roi_names(rt_struct: Dataset) -> Dict[int, str]:
+    return {int(roi.ROINumber): str(roi.ROIName) for roi in rt_struct.StructureSetROISequence}
+
+
+def add_dvh_sequence(rt_dose: Dataset, rt_struct: Dataset, dvhs: Dict[int, object],
+                     contribution_type: str = "INCLUDED", prescription_dose: float = 0,
+                     normalization_point: List[float] = None):
+    """
+    Adds the RT DVH module to the RT Dose.
+
+    :param rt_dose: RT Dose the DVHs are computed on
+    :param rt_struct: RT Struct holding the ROIs
+    :param dvhs: cumulative DVH of each ROI number, with bins (bin edges in Gy), counts (volume receiving at least
+                 each bin in cm3), min, max and mean (in Gy) attributes, as dicompyler-core's DVH
+    :param contribution_type: DVH ROI Contribution Type of each ROI
+    :param prescription_dose: DVH Normalization Dose Value, in Gy
+    :param normalization_point: DVH Normalization Point, in mm
+    """
+    rt_dose.ReferencedStructureSetSequence = Sequence([_reference_to(rt_struct)])
+    if normalization_point is not None:
+        rt_dose.DVHNormalizationPoint = [float(coordinate) for coordinate in normalization_point]
+    rt_dose.DVHNormalizationDoseValue = float(prescription_dose)
+    dvh_sequence = Sequence()
+    for roi_number in sorted(dvhs.keys()):
+        dvh = dvhs[roi_number]
+        referenced_roi = Dataset()
+        referenced_roi.ReferencedROINumber = roi_number
+        referenced_roi.DVHROIContributionType = contribution_type
+        item = Dataset()
+        item.DVHReferencedROISequence = Sequence([referenced_roi])
+        item.DVHType = "CUMULATIVE"
+        item.DoseUnits = "GY"
+        item.DoseType = rt_dose.get("DoseType", "PHYSICAL")
+        item.DVHDoseScaling = 1.0
+        item.DVHVolumeUnits = "CM3"
+        bin_widths = np.diff(np.asarray(dvh.bins, dtype=np.float64))
+        counts = np.asarray(dvh.counts, dtype=np.float64)
+        item.DVHNumberOfBins = int(counts.size)
+        # pairs of bin width and volume
+        item.DVHData = np.stack([bin_widths[:counts.size], counts], axis=1).ravel().tolist()
+        item.DVHMinimumDose = float(dvh.min)
+        item.DVHMaximumDose = float(dvh.max)
+        item.DVHMeanDose = float(dvh.mean)
+        dvh_sequence.append(item)
+    rt_dose.DVHSequence = dvh_sequence
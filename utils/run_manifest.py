@@ -0,0 +1,195 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+import os
+import pickle
+import time
+from functools import partial
+from typing import Callable, Dict, List, Optional
+
+from utils.disk_cache import file_checksum
+
+RUN_MANIFEST_FILE_NAME = "run_manifest.json"
+RUN_STATE_FOLDER_NAME = "run_state"
+STAGES = ["extracted", "generated", "simulated", "cleaned"]
+
+
+def _list_artifact_files(artifact_paths: List[str], ignored_paths: List[str]) -> List[str]:
+    file_paths = []
+    for artifact_path in artifact_paths:
+        if os.path.isdir(artifact_path):
+            for root, _, file_names in os.walk(artifact_path):
+                file_paths += [os.path.join(root, file_name) for file_name in sorted(file_names)]
+        elif os.path.isfile(artifact_path):
+            file_paths.append(artifact_path)
+
+    return sorted(set(file_paths) - set(ignored_paths))
+
+
+class RunManifest:
+    def __init__(self, study_folder: str, ignored_paths: Optional[List[str]] = None):
+        """
+        Records, in study_folder, which stages of a study are completed together with the checksums of the files
+        they produced and the small values (paths, scalars, meta data) they added to the study context. A stage is only considered completed while
+        all its files are unchanged, so a study interrupted or corrupted in the middle of a batch resumes at its
+        first incomplete stage.
+
+        :param study_folder: folder of the simulation files of the study
+        :param ignored_paths: files never considered as artifacts, such as the log file of the study which keeps
+                              growing
+        """
+        self.study_folder = study_folder
+        self.manifest_path = os.path.join(study_folder, RUN_MANIFEST_FILE_NAME)
+        self.ignored_paths = [self.manifest_path, self.manifest_path + ".tmp"] + list(ignored_paths or [])
+        self.stages = {}
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path) as file:
+                    self.stages = json.load(file)["stages"]
+            except (OSError, ValueError, KeyError):
+                logging.warning(f"Unreadable run manifest {self.manifest_path}, the study is restarted")
+                self.stages = {}
+
+    def save(self):
+        os.makedirs(self.study_folder, exist_ok=True)
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"stages": self.stages}, file, indent=2)
+        os.replace(temporary_path, self.manifest_path)
+
+    def _state_path(self, stage: str) -> str:
+        return os.path.join(self.study_folder, RUN_STATE_FOLDER_NAME, f"{stage}.pkl")
+
+    def _checksum_artifacts(self, artifact_paths: List[str], previous_artifacts: Optional[Dict] = None) -> Dict:
+        """
+        The size and modification time of each file are kept next to its checksum, so that unchanged files are not
+        read again when the manifest is refreshed or verified.
+        """
+        previous_artifacts = previous_artifacts or {}
+        artifacts = {}
+        for file_path in _list_artifact_files(artifact_paths, self.ignored_paths):
+            stat = os.stat(file_path)
+            previous = previous_artifacts.get(file_path)
+            if previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+                checksum = previous["sha256"]
+            else:
+                checksum = file_checksum(file_path)
+            artifacts[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": checksum}
+
+        return artifacts
+
+    @staticmethod
+    def _artifacts_are_unchanged(artifacts: Dict) -> bool:
+        for file_path, artifact in artifacts.items():
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                return False
+            if stat.st_size != artifact["size"]:
+                return False
+            if stat.st_mtime_ns != artifact["mtime_ns"] and file_checksum(file_path) != artifact["sha256"]:
+                return False
+
+        return True
+
+    def first_incomplete_stage(self) -> int:
+        """
+        :return: index in STAGES of the first stage to run, len(STAGES) when the study is completed
+        """
+        for stage_index, stage in enumerate(STAGES):
+            if stage not in self.stages or not self._artifacts_are_unchanged(self.stages[stage]["artifacts"]):
+                return stage_index
+
+        return len(STAGES)
+
+    def invalidate_from(self, stage: str):
+        for invalidated_stage in STAGES[STAGES.index(stage):]:
+            self.stages.pop(invalidated_stage, None)
+        self.save()
+
+    def record(self, stage: str, state: Dict, artifact_paths: List[str]):
+        """
+        Marks stage as completed. The checksums of the previous stages are refreshed, since the following stages
+        are allowed to modify their files (ex. the number of threads added to the TOPAS input file).
+
+        :param stage: one of STAGES
+        :param state: values added to the study context by the stage, restored when the stage is skipped. Only
+                      paths and small values are expected, the large ones (ex. the plan) being reloaded instead
+        :param artifact_paths: files and folders produced by the stage
+        """
+        state_path = self._state_path(stage)
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(state_path, "wb") as file:
+            pickle.dump(state, file)
+        for previous_stage in STAGES[:STAGES.index(stage)]:
+            if previous_stage in self.stages:
+                self.stages[previous_stage]["artifacts"] = self._checksum_artifacts(
+                    list(self.stages[previous_stage]["artifacts"].keys()),
+                    self.stages[previous_stage]["artifacts"])
+        self.stages[stage] = {"completed_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                              "artifacts": self._checksum_artifacts([state_path] + artifact_paths)}
+        self.save()
+
+    def load_state(self, stage: str) -> Dict:
+        with open(self._state_path(stage), "rb") as file:
+            return pickle.load(file)
+
+
+def _run_or_resume_stage(study_context: Dict, stage_function: Callable, stage: str, state_keys: List[str],
+                         artifact_keys: List[str], reload_function: Optional[Callable] = None) -> Dict:
+    manifest = RunManifest(study_context["simulation_files_path"], [study_context["log_file"]])
+    stage_index = STAGES.index(stage)
+    if stage_index == 0:
+        study_context["resume_from"] = manifest.first_incomplete_stage()
+        if study_context["resume_from"] == len(STAGES):
+            logging.info(f"{study_context['study_path']} was already recalculated, it is skipped")
+        elif study_context["resume_from"] > 0:
+            logging.info(f"Resuming {study_context['study_path']} after its "
+                         f"{STAGES[study_context['resume_from'] - 1]} stage")
+    resume_from = study_context.get("resume_from", 0)
+    if stage_index < resume_from:
+        # the state is only needed by the stages left to run
+        if resume_from < len(STAGES):
+            study_context.update(manifest.load_state(stage))
+            if reload_function is not None:
+                study_context = reload_function(study_context)
+        return study_context
+
+    manifest.invalidate_from(stage)
+    study_context = stage_function(study_context)
+    manifest.record(stage, {key: study_context[key] for key in state_keys},
+                    [study_context[key] for key in artifact_keys if study_context.get(key) is not None])
+    return study_context
+
+
+def resumable_stage(stage_function: Callable, stage: str, state_keys: List[str], artifact_keys: List[str],
+                    reload_function: Optional[Callable] = None) -> Callable:
+    """
+    Wraps a stage of the workflow so that it is skipped, its outputs being restored in the study context, when the
+    run manifest of the study says it is already completed. The stage of index 0 decides where the study resumes.
+
+    :param stage_function: callable receiving and returning the study context
+    :param stage: name of the stage in STAGES
+    :param state_keys: keys the stage adds to the study context
+    :param artifact_keys: keys of the study context holding the files or folders produced by the stage
+    :param reload_function: callable receiving and returning the study context, restoring the values of the skipped
+                            stage too large to be kept in its state
+    :return: the wrapped stage, picklable so that it can be sent to the process_pool scheduler
+    """
+    return partial(_run_or_resume_stage, stage_function=stage_function, stage=stage, state_keys=state_keys,
+                   artifact_keys=artifact_keys, reload_function=reload_function)
@@ -0,0 +1,106 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import copy
+import re
+from typing import Dict
+
+from pydicom.dataset import Dataset
+
+# parameters rewritten in the input files restored from the cache, with their default
+RUN_PARAMETERS = {"total_particles": None, "batches": 1, "chunk": 1}
+# names under which the generators may keep the batches and chunk parameters in their meta data
+RUN_PARAMETER_KEYS = {"batches": ["batches", "nbatch"], "chunk": ["chunk", "nchunk"]}
+HISTORIES_PATTERN = re.compile(r"(?m)^(\s*(?:ncase|i:So/[^=\s]+/NumberOfHistoriesInRun)\s*=\s*)(\S+)")
+NUMERIC_VRS = ["DS", "IS", "FD", "FL", "UL", "US", "SL", "SS"]
+TEXT_VRS = ["UT", "ST", "LT", "LO", "SH"]
+
+
+def update_run_parameters(input_file: str, cached_run_parameters: Dict, run_parameters: Dict) -> str:
+    """
+    Rewrites the number of histories (ncase of egs_brachy, NumberOfHistoriesInRun of each TOPAS source, scaled to the
+    new total), the print interval, nbatch and nchunk of an input file generated with other run parameters.
+    """
+    cached_total_particles = cached_run_parameters["total_particles"]
+    total_particles = run_parameters["total_particles"]
+    if total_particles != cached_total_particles:
+        if HISTORIES_PATTERN.search(input_file) is None:
+            raise ValueError("No number of histories found in the cached input file, it can not be reused for another "
+                             "total_particles")
+        scale = total_particles / cached_total_particles
+        input_file = HISTORIES_PATTERN.sub(lambda match: f"{match.group(1)}{int(round(float(match.group(2)) * scale))}",
+                                           input_file)
+        input_file = re.sub(r"(?m)^(\s*i:Ts/ShowHistoryCountAtInterval\s*=\s*)\d+",
+                            lambda match: f"{match.group(1)}{int(total_particles // 100)}", input_file)
+    for name, keyword in [("batches", "nbatch"), ("chunk", "nchunk")]:
+        if run_parameters[name] != cached_run_parameters[name]:
+            input_file = re.sub(rf"(?m)^(\s*{keyword}\s*=\s*)\S+",
+                                lambda match: f"{match.group(1)}{int(run_parameters[name])}", input_file)
+    return input_file
+
+
+def update_run_metadata(value, cached_run_parameters: Dict, run_parameters: Dict):
+    """
+    Copy of the meta data or of the SR content items of a generation (dictionaries, lists, tuples and pydicom
+    datasets) made with cached_run_parameters, with the run parameters they hold replaced by those of
+    run_parameters: every number equal to the cached total_particles, in a value, a numeric element or a text, and
+    the values of the batches and chunk keys.
+    """
+    cached_total_particles = cached_run_parameters["total_particles"]
+    total_particles = run_parameters["total_particles"]
+    total_particles_changed = cached_total_particles is not None and total_particles is not None and \
+        total_particles != cached_total_particles
+    cached_total_pattern = None
+    if total_particles_changed:
+        cached_total_pattern = re.compile(rf"(?<![\d.]){int(cached_total_particles)}(?![\d.])")
+
+    def update_number(number):
+        if total_particles_changed and not isinstance(number, bool) and number == cached_total_particles:
+            return type(number)(total_particles)
+        return number
+
+    def update_text(text: str) -> str:
+        if total_particles_changed:
+            return cached_total_pattern.sub(str(int(total_particles)), text)
+        return text
+
+    def update(item, key=None):
+        for name, keys in RUN_PARAMETER_KEYS.items():
+            if key in keys and run_parameters[name] != cached_run_parameters[name]:
+                return run_parameters[name]
+        if isinstance(item, dict):
+            return {item_key: update(item_value, item_key) for item_key, item_value in item.items()}
+        if isinstance(item, list):
+            return [update(element) for element in item]
+        if isinstance(item, tuple):
+            return tuple(update(element) for element in item)
+        if isinstance(item, Dataset):
+            dataset = copy.deepcopy(item)
+            for element in dataset.iterall():
+                if element.VM != 1:
+                    continue
+                if element.VR in NUMERIC_VRS:
+                    element.value = update_number(element.value)
+                elif element.VR in TEXT_VRS:
+                    element.value = update_text(element.value)
+            return dataset
+        if isinstance(item, str):
+            return update_text(item)
+        if isinstance(item, (int, float)):
+            return update_number(item)
+        return item
+
+    return update(value)
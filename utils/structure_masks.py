@@ -0,0 +1,298 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pydicom
+
+from utils.dicom_loader import open_dicom_folder
+from utils.grids import VoxelGrid, resample_nearest
+
+
+class PackedMask:
+    def __init__(self, mask: np.ndarray, shape: Optional[Tuple[int, ...]] = None,
+                 box_start: Optional[Tuple[int, ...]] = None):
+        """
+        Boolean mask kept as the bits of its bounding box, 1/8 of a byte per voxel of the box instead of a byte per
+        voxel of the whole grid.
+
+        :param mask: the mask, or only a box of it starting at box_start in a volume of shape
+        """
+        self.shape = tuple(mask.shape) if shape is None else tuple(shape)
+        box_start = (0,) * mask.ndim if box_start is None else box_start
+        non_empty_axes = [np.flatnonzero(np.any(mask, axis=tuple(other for other in range(mask.ndim)
+                                                                   if other != axis)))
+                          for axis in range(mask.ndim)]
+        if non_empty_axes[0].size == 0:
+            local_box = tuple(slice(0, 0) for _ in range(mask.ndim))
+        else:
+            local_box = tuple(slice(int(indices[0]), int(indices[-1]) + 1) for indices in non_empty_axes)
+        self.bounding_box = tuple(slice(axis_box.start + int(start), axis_box.stop + int(start))
+                                  for axis_box, start in zip(local_box, box_start))
+        crop = mask[local_box]
+        self.crop_shape = crop.shape
+        self.bits = np.packbits(crop, axis=None)
+
+    @property
+    def is_empty(self) -> bool:
+        return int(np.prod(self.crop_shape)) == 0
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.bits.nbytes)
+
+    def crop(self) -> np.ndarray:
+        """
+        :return: the mask inside its bounding_box
+        """
+        size = int(np.prod(self.crop_shape))
+        return np.unpackbits(self.bits, count=size).reshape(self.crop_shape).astype(bool)
+
+    def unpack(self) -> np.ndarray:
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[self.bounding_box] = self.crop()
+        return mask
+
+    def voxel_center(self) -> np.ndarray:
+        """
+        :return: mean (slice, row, column) index of the voxels of the mask
+        """
+        indices = np.nonzero(self.crop())
+        return np.asarray([np.mean(axis_indices) + axis_box.start for axis_indices, axis_box in
+                           zip(indices, self.bounding_box)])
+
+
+def _grid_key(grid: VoxelGrid) -> Tuple:
+    return tuple(np.round(np.concatenate([grid.origin, grid.row_direction, grid.column_direction, grid.pixel_spacing,
+                                          grid.slice_offsets]), 4).tolist()) + grid.shape
+
+
+def rasterize_contours_packed(contours: List[np.ndarray], grid: VoxelGrid) -> PackedMask:
+    """
+    Fills the planar contours of a ROI on the grid, all the edges of a slice at once: for each row, the crossings of
+    its voxel centers with the edges are toggled in a difference array, whose cumulated parity is the even-odd rule,
+    so that the holes drawn as inner contours are left empty. Only the box of the grid around the contours is filled,
+    so that the mask is never held at the size of the grid.
+
+    :param contours: patient positions of the points of each closed contour, shape (nb_of_points, 3), in mm
+    :return: mask of the ROI on grid, bit-packed in its bounding box
+    """
+    nb_of_slices, nb_of_rows, nb_of_columns = grid.shape
+    planar_contours = []
+    for contour in contours:
+        if len(contour) < 3:
+            continue
+        slices, rows, columns = grid.continuous_indices(np.asarray(contour, dtype=np.float64))
+        slice_index = int(np.rint(np.mean(slices)))
+        if 0 <= slice_index < nb_of_slices:
+            planar_contours.append((slice_index, rows, columns))
+    if len(planar_contours) == 0:
+        return PackedMask(np.zeros((0, 0, 0), dtype=bool), grid.shape)
+
+    all_rows = np.concatenate([rows for _, rows, _ in planar_contours])
+    all_columns = np.concatenate([columns for _, _, columns in planar_contours])
+    box_start = (min(slice_index for slice_index, _, _ in planar_contours),
+                 int(np.clip(np.floor(all_rows.min()), 0, nb_of_rows)),
+                 int(np.clip(np.floor(all_columns.min()), 0, nb_of_columns)))
+    box_stop = (max(slice_index for slice_index, _, _ in planar_contours) + 1,
+                int(np.clip(np.ceil(all_rows.max()) + 1, 0, nb_of_rows)),
+                int(np.clip(np.ceil(all_columns.max()) + 1, 0, nb_of_columns)))
+    box_shape = tuple(stop - start for start, stop in zip(box_start, box_stop))
+    crossings = np.zeros((box_shape[0], box_shape[1], box_shape[2] + 1), dtype=np.uint8)
+    row_indices = (np.arange(box_shape[1]) + box_start[1])[:, np.newaxis]
+    for slice_index, rows, columns in planar_contours:
+        start_rows, end_rows = rows, np.roll(rows, -1)
+        start_columns, end_columns = columns, np.roll(columns, -1)
+        # half-open in the rows, so that a vertex shared by two edges is crossed once
+        crossed = (np.minimum(start_rows, end_rows) <= row_indices) & (row_indices < np.maximum(start_rows, end_rows))
+        crossing_rows, edges = np.nonzero(crossed)
+        if crossing_rows.size == 0:
+            continue
+        fractions = (crossing_rows + box_start[1] - start_rows[edges]) / (end_rows[edges] - start_rows[edges])
+        crossing_columns = start_columns[edges] + fractions * (end_columns[edges] - start_columns[edges])
+        # the voxels of the row from the first column center at or after the crossing
+        first_columns = np.clip(np.ceil(crossing_columns).astype(np.int64) - box_start[2], 0, box_shape[2])
+        np.add.at(crossings[slice_index - box_start[0]], (crossing_rows, first_columns), 1)
+    crop = (np.cumsum(crossings, axis=2, dtype=np.uint32)[:, :, :box_shape[2]] % 2).astype(bool)
+
+    return PackedMask(crop, grid.shape, box_start)
+
+
+def rasterize_contours(contours: List[np.ndarray], grid: VoxelGrid) -> np.ndarray:
+    """
+    :return: mask of the ROI on grid, see rasterize_contours_packed
+    """
+    return rasterize_contours_packed(contours, grid).unpack()
+
+
+def read_roi_contours(rt_struct: pydicom.Dataset, roi_name: str) -> List[np.ndarray]:
+    """
+    :return: patient positions of the points of each closed planar contour of the ROI, in mm
+    """
+    roi_numbers = [int(roi.ROINumber) for roi in rt_struct.StructureSetROISequence if str(roi.ROIName) == roi_name]
+    if len(roi_numbers) == 0:
+        return []
+    contours = []
+    for roi_contour in rt_struct.get("ROIContourSequence", []):
+        if int(roi_contour.ReferencedROINumber) != roi_numbers[0]:
+            continue
+        for contour in roi_contour.get("ContourSequence", []):
+            if contour.get("ContourGeometricType", "CLOSED_PLANAR") == "CLOSED_PLANAR":
+                contours.append(np.asarray(contour.ContourData, dtype=np.float64).reshape((-1, 3)))
+    return contours
+
+
+class StructureMasks:
+    def __init__(self, rt_struct_path: Optional[str] = None, grid: Optional[VoxelGrid] = None):
+        """
+        Masks of the structures of a study, each one rasterized once from the contours of the RT Struct and kept
+        bit-packed in its bounding box, never at the size of the CT. The masks resampled on another grid (ex. a dose
+        grid) are kept the same way.
+
+        :param rt_struct_path: RT Struct of the study, None when the RT Struct is given to each call
+        :param grid: CT grid of the masks, needed to rasterize contours and to resample the masks
+        """
+        self.rt_struct_path = rt_struct_path
+        self.grid = grid
+        self.masks = {}
+        self.resampled_masks = {}
+        self._rt_struct = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_rt_struct"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return sum(mask.nbytes for mask in list(self.masks.values()) + list(self.resampled_masks.values())
+                   if mask is not None)
+
+    def _study_rt_struct(self) -> Optional[pydicom.Dataset]:
+        if self.rt_struct_path is None:
+            return None
+        with self._lock:
+            if self._rt_struct is None:
+                self._rt_struct = pydicom.dcmread(self.rt_struct_path)
+            return self._rt_struct
+
+    def _packed_mask(self, roi_name: str, rt_struct: Optional[pydicom.Dataset] = None) -> Optional[PackedMask]:
+        with self._lock:
+            if roi_name in self.masks and (self.masks[roi_name] is not None or rt_struct is None):
+                return self.masks[roi_name]
+        if rt_struct is None:
+            rt_struct = self._study_rt_struct()
+        packed_mask = None
+        if rt_struct is not None and self.grid is not None:
+            contours = read_roi_contours(rt_struct, roi_name)
+            if len(contours) > 0:
+                packed_mask = rasterize_contours_packed(contours, self.grid)
+        with self._lock:
+            self.masks[roi_name] = packed_mask
+        return packed_mask
+
+    def mask(self, roi_name: str, rt_struct: Optional[pydicom.Dataset] = None) -> Optional[np.ndarray]:
+        """
+        :param rt_struct: RT Struct whose contours are rasterized instead of the one of the study
+        :return: the mask of the ROI on the CT grid, None when it has none
+        """
+        packed_mask = self._packed_mask(roi_name, rt_struct)
+        return None if packed_mask is None else packed_mask.unpack()
+
+    def bounding_box(self, roi_name: str) -> Optional[Tuple[slice, ...]]:
+        packed_mask = self._packed_mask(roi_name)
+        return None if packed_mask is None else packed_mask.bounding_box
+
+    def shape(self, roi_name: str) -> Optional[Tuple[int, ...]]:
+        packed_mask = self._packed_mask(roi_name)
+        return None if packed_mask is None else packed_mask.shape
+
+    def center(self, roi_name: str) -> Optional[np.ndarray]:
+        """
+        :return: patient position (x, y, z) of the mean of the voxels of the ROI, in mm, None when it has none
+        """
+        packed_mask = self._packed_mask(roi_name)
+        if packed_mask is None or packed_mask.is_empty:
+            return None
+        slice_index, row, column = packed_mask.voxel_center()
+        slice_offset = np.interp(slice_index, np.arange(len(self.grid.slice_offsets)), self.grid.slice_offsets)
+        return self.grid.origin + slice_offset * self.grid.normal + \
+            row * self.grid.pixel_spacing[0] * self.grid.column_direction + \
+            column * self.grid.pixel_spacing[1] * self.grid.row_direction
+
+    def on_grid(self, roi_name: str, grid: VoxelGrid,
+                rt_struct: Optional[pydicom.Dataset] = None) -> Optional[np.ndarray]:
+        """
+        :return: the mask of the ROI resampled on grid, None when it has none
+        """
+        key = (roi_name, _grid_key(grid))
+        with self._lock:
+            if key in self.resampled_masks:
+                packed_mask = self.resampled_masks[key]
+                return None if packed_mask is None else packed_mask.unpack()
+        packed_mask = self._packed_mask(roi_name, rt_struct)
+        if packed_mask is None:
+            return None
+        if self.grid is None:
+            raise ValueError("The CT grid of the masks is needed to resample them")
+        mask = packed_mask.unpack() if _grid_key(grid) == _grid_key(self.grid) else \
+            resample_nearest(packed_mask.unpack(), self.grid, grid, False)
+        with self._lock:
+            self.resampled_masks[key] = PackedMask(mask)
+        return mask
+
+    def label_map(self, roi_names: List[str], grid: Optional[VoxelGrid] = None) -> np.ndarray:
+        """
+        :return: index + 1 in roi_names of the ROI of each voxel, on grid or the CT grid, the last ROI winning where
+                 they overlap
+        """
+        grid = grid or self.grid
+        label_map = np.zeros(grid.shape, dtype=np.min_scalar_type(len(roi_names)))
+        for label, roi_name in enumerate(roi_names, start=1):
+            mask = self.on_grid(roi_name, grid)
+            if mask is not None:
+                label_map[mask] = label
+        return label_map
+
+
+def get_structure_masks(plan, grid: Optional[VoxelGrid] = None) -> StructureMasks:
+    """
+    :return: the structure masks of the plan, created on first use from the RT Struct and the CT of its study, so that
+             every stage of the study shares them
+    """
+    structure_masks = getattr(plan, "structure_masks", None)
+    if structure_masks is None:
+        rt_struct_path = None
+        study_path = getattr(plan, "study_path", None)
+        if study_path is not None:
+            dicom_folder = open_dicom_folder(study_path)
+            rt_struct_paths = dicom_folder.paths("RTSTRUCT")
+            rt_struct_path = rt_struct_paths[0] if len(rt_struct_paths) > 0 else None
+            if grid is None:
+                grid = dicom_folder.image_grid("CT")
+        structure_masks = StructureMasks(rt_struct_path, grid)
+        plan.structure_masks = structure_masks
+    elif structure_masks.grid is None and grid is not None:
+        structure_masks.grid = grid
+    return structure_masks
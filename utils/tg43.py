@@ -0,0 +1,288 @@
+# Copyright (C) 2023 Samuel Ouellet and Luc Beaulieu
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+
+import json
+import logging
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Optional
+
+import numpy as np
+import pydicom
+
+from utils.dose_files import read_3ddose
+from utils.grids import VoxelGrid, interpolate_linear
+
+TG43_ENGINE_VERSION = 1
+# the distances and polar angles of the tabulated kernels, in cm and degrees
+KERNEL_DISTANCE_STEP = 0.01
+KERNEL_MAX_DISTANCE = 15.0
+KERNEL_ANGLE_STEP = 1.0
+
+
+class TG43SourceModel:
+    def __init__(self, dose_rate_constant: float, active_length: float, radial_distances, radial_dose_function,
+                 anisotropy_distances, anisotropy_angles, anisotropy_function):
+        """
+        Consensus data of a seed model for the 2D formalism of TG-43U1, with a line source geometry function.
+
+        :param dose_rate_constant: in cGy h-1 U-1
+        :param active_length: in cm, 0 for a point source
+        :param radial_distances: distances of radial_dose_function, in cm
+        :param anisotropy_distances: distances of the columns of anisotropy_function, in cm
+        :param anisotropy_angles: polar angles of the rows of anisotropy_function, in degrees
+        """
+        self.dose_rate_constant = float(dose_rate_constant)
+        self.active_length = float(active_length)
+        self.radial_distances = np.asarray(radial_distances, dtype=np.float64)
+        self.radial_dose_function = np.asarray(radial_dose_function, dtype=np.float64)
+        self.anisotropy_distances = np.asarray(anisotropy_distances, dtype=np.float64)
+        self.anisotropy_angles = np.asarray(anisotropy_angles, dtype=np.float64)
+        self.anisotropy_function = np.asarray(anisotropy_function, dtype=np.float64)
+
+    @classmethod
+    def from_json(cls, path: str) -> "TG43SourceModel":
+        """
+        Reads consensus data written as {"dose_rate_constant", "active_length", "radial_dose_function":
+        [[r, g_L(r)], ...], "anisotropy_function": {"distances": [...], "angles": [...], "values": [[...], ...]}},
+        a row of values by angle.
+        """
+        with open(path) as file:
+            data = json.load(file)
+        radial_dose_function = np.asarray(data["radial_dose_function"], dtype=np.float64)
+        anisotropy_function = data["anisotropy_function"]
+        return cls(data["dose_rate_constant"], data["active_length"], radial_dose_function[:, 0],
+                   radial_dose_function[:, 1], anisotropy_function["distances"], anisotropy_function["angles"],
+                   anisotropy_function["values"])
+
+    def geometry_function(self, distances: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        """
+        :param angles: polar angles, in radians
+        """
+        if self.active_length == 0:
+            return 1 / distances ** 2
+        half_length = self.active_length / 2
+        along = distances * np.cos(angles)
+        across = distances * np.sin(angles)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            subtended_angles = np.arctan2(along + half_length, across) - np.arctan2(along - half_length, across)
+            geometry = np.where(across > 1e-6, subtended_angles / (self.active_length * across),
+                                1 / np.maximum(distances ** 2 - half_length ** 2, 1e-6))
+        return geometry
+
+    def radial_dose(self, distances: np.ndarray) -> np.ndarray:
+        # nearest value below the table and exponential extrapolation beyond it, as recommended by TG-43U1
+        radial_dose = np.interp(distances, self.radial_distances, self.radial_dose_function)
+        last_distances = self.radial_distances[-2:]
+        last_values = self.radial_dose_function[-2:]
+        attenuation = np.log(last_values[1] / last_values[0]) / (last_distances[1] - last_distances[0])
+        beyond = distances > last_distances[1]
+        radial_dose[beyond] = last_values[1] * np.exp(attenuation * (distances[beyond] - last_distances[1]))
+        return radial_dose
+
+    def anisotropy(self, distances: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        """
+        :param angles: polar angles, in radians
+        """
+        rows = np.interp(np.degrees(angles), self.anisotropy_angles, np.arange(self.anisotropy_angles.size))
+        columns = np.interp(distances, self.anisotropy_distances, np.arange(self.anisotropy_distances.size))
+        return interpolate_linear(self.anisotropy_function[np.newaxis], np.zeros(rows.shape), rows, columns)
+
+    def dose_rate(self, distances: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        """
+        :return: dose rate per unit of air kerma strength, in cGy h-1 U-1
+        """
+        reference_geometry = self.geometry_function(np.asarray([1.0]), np.asarray([np.pi / 2]))[0]
+        return self.dose_rate_constant * self.geometry_function(distances, angles) / reference_geometry * \
+            self.radial_dose(distances) * self.anisotropy(distances, angles)
+
+
+class TG43Kernel:
+    def __init__(self, values: np.ndarray, distance_step: float = KERNEL_DISTANCE_STEP,
+                 angle_step: float = KERNEL_ANGLE_STEP):
+        """
+        Dose rate of a seed per unit of air kerma strength (cGy h-1 U-1), tabulated on regular distances (from 0)
+        and polar angles (from 0 to 180 degrees), the seed being along its axis. The voxels beyond the table get no
+        dose.
+        """
+        self.values = values
+        self.distance_step = distance_step
+        self.angle_step = angle_step
+
+    @classmethod
+    def from_source_model(cls, source_model: TG43SourceModel, max_distance: float = KERNEL_MAX_DISTANCE,
+                          distance_step: float = KERNEL_DISTANCE_STEP,
+                          angle_step: float = KERNEL_ANGLE_STEP) -> "TG43Kernel":
+        # inside the capsule, the dose of the closest tabulated distance
+        distances = np.maximum(np.arange(0, max_distance + distance_step / 2, distance_step),
+                               max(source_model.radial_distances[0], source_model.active_length / 2 + distance_step))
+        angles = np.radians(np.arange(0, 180 + angle_step / 2, angle_step))
+        distance_grid, angle_grid = np.meshgrid(distances, angles)
+        return cls(source_model.dose_rate(distance_grid, angle_grid), distance_step, angle_step)
+
+    @classmethod
+    def from_3ddose(cls, path: str, air_kerma_strength_per_history: float, max_distance: float = KERNEL_MAX_DISTANCE,
+                    distance_step: float = KERNEL_DISTANCE_STEP,
+                    angle_step: float = KERNEL_ANGLE_STEP) -> "TG43Kernel":
+        """
+        Tabulates the dose of a single seed simulated once in water, at the origin of the .3ddose and along z.
+
+        :param air_kerma_strength_per_history: air kerma strength of the seed model per history, in Gy cm2 (the air
+                                               kerma in the header of the egs_brachy seed geometries), so that the
+                                               dose per history divided by it is in cGy h-1 U-1
+        """
+        dose_3d = read_3ddose(path)
+        centers = [(position[1:] + position[:-1]) / 2 for position in dose_3d.positions]
+        distances = np.arange(0, max_distance + distance_step / 2, distance_step)
+        angles = np.radians(np.arange(0, 180 + angle_step / 2, angle_step))
+        distance_grid, angle_grid = np.meshgrid(distances, angles)
+        # the x-z plane through the seed
+        indices = [np.interp(coordinate, axis_centers, np.arange(axis_centers.size), left=np.nan, right=np.nan)
+                   for coordinate, axis_centers in zip([distance_grid * np.cos(angle_grid), np.zeros(distance_grid.shape),
+                                                        distance_grid * np.sin(angle_grid)], centers)]
+        outside = np.any([np.isnan(axis_indices) for axis_indices in indices], axis=0)
+        values = interpolate_linear(np.asarray(dose_3d.dose, dtype=np.float64),
+                                    *[np.nan_to_num(axis_indices) for axis_indices in indices])
+        values[outside] = 0
+        return cls(values / air_kerma_strength_per_history, distance_step, angle_step)
+
+    def __call__(self, distances: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        """
+        Bilinear lookup in the table, written out since it runs once per seed on every voxel.
+
+        :param angles: polar angles, in radians
+        """
+        nb_of_angles, nb_of_distances = self.values.shape
+        rows = np.minimum(np.degrees(angles) / self.angle_step, nb_of_angles - 1)
+        columns = distances / self.distance_step
+        beyond = columns > nb_of_distances - 1
+        columns = np.minimum(columns, nb_of_distances - 1)
+        lower_rows = np.minimum(rows.astype(np.int64), nb_of_angles - 2)
+        lower_columns = np.minimum(columns.astype(np.int64), nb_of_distances - 2)
+        row_weights = rows - lower_rows
+        column_weights = columns - lower_columns
+        flat_values = self.values.ravel()
+        indices = lower_rows * nb_of_distances + lower_columns
+        values = (1 - row_weights) * ((1 - column_weights) * flat_values[indices] +
+                                      column_weights * flat_values[indices + 1]) + \
+            row_weights * ((1 - column_weights) * flat_values[indices + nb_of_distances] +
+                           column_weights * flat_values[indices + nb_of_distances + 1])
+        values[beyond] = 0
+        return values
+
+
+@lru_cache(maxsize=None)
+def get_tg43_kernel(kernel_path: str, air_kerma_strength_per_history: Optional[float] = None) -> TG43Kernel:
+    """
+    :param kernel_path: consensus data (.json) or single seed dose (.3ddose) of the seed model
+    :return: the kernel of the seed model, tabulated once by process
+    """
+    if kernel_path.endswith(".3ddose"):
+        if air_kerma_strength_per_history is None:
+            raise ValueError(f"The air kerma strength per history of {kernel_path} is needed to normalize it")
+        return TG43Kernel.from_3ddose(kernel_path, air_kerma_strength_per_history)
+    return TG43Kernel.from_source_model(TG43SourceModel.from_json(kernel_path))
+
+
+def _read_datetime(dataset: pydicom.Dataset, date_keyword: str, time_keyword: str) -> Optional[datetime]:
+    date = str(dataset.get(date_keyword, "") or "")
+    if len(date) < 8:
+        return None
+    # HHMMSS.FFFFFF, the minutes and seconds being optional
+    time = str(dataset.get(time_keyword, "") or "").split(".")[0].ljust(6, "0")[:6]
+    return datetime.strptime(date[:8] + time, "%Y%m%d%H%M%S")
+
+
+def decayed_air_kerma_strength(source: pydicom.Dataset, treatment_datetime: Optional[datetime]) -> float:
+    """
+    :return: the ReferenceAirKermaRate of the source, in U, decayed from its SourceStrengthReferenceDate and Time to
+             treatment_datetime, as it is when neither is known
+    """
+    air_kerma_strength = float(source.ReferenceAirKermaRate)
+    reference_datetime = _read_datetime(source, "SourceStrengthReferenceDate", "SourceStrengthReferenceTime")
+    if treatment_datetime is None or reference_datetime is None:
+        return air_kerma_strength
+    elapsed_days = (treatment_datetime - reference_datetime).total_seconds() / 86400
+    return air_kerma_strength * np.exp(-np.log(2) * elapsed_days / float(source.SourceIsotopeHalfLife))
+
+
+def read_seeds(rt_plan: pydicom.Dataset, default_direction=(0, 0, 1),
+               treatment_datetime: Optional[datetime] = None) -> Dict[str, np.ndarray]:
+    """
+    Reads the seeds of a permanent implant, a channel each. The orientation of a seed is the direction between the
+    first and last positions of its channel, or default_direction when they are the same.
+
+    :param treatment_datetime: date of the implant, to which the air kerma strengths are decayed. By default, the
+                               RTPlanDate and RTPlanTime of the plan, the seeds being implanted as planned.
+    :return: positions (mm), directions, air kerma strengths (U) and half-lives (days) of the seeds
+    """
+    if treatment_datetime is None:
+        treatment_datetime = _read_datetime(rt_plan, "RTPlanDate", "RTPlanTime")
+        if treatment_datetime is None:
+            logging.warning("The RT Plan has no RTPlanDate, the air kerma strengths of the seeds are not decayed")
+    sources = {int(source.SourceNumber): source for source in rt_plan.get("SourceSequence", [])}
+    seeds = {"positions": [], "directions": [], "air_kerma_strengths": [], "half_lives": []}
+    for application_setup in rt_plan.get("ApplicationSetupSequence", []):
+        for channel in application_setup.get("ChannelSequence", []):
+            positions = [np.asarray([float(value) for value in control_point.ControlPoint3DPosition])
+                         for control_point in channel.get("BrachyControlPointSequence", [])
+                         if "ControlPoint3DPosition" in control_point]
+            if len(positions) == 0:
+                continue
+            direction = positions[-1] - positions[0]
+            if np.linalg.norm(direction) < 1e-3:
+                direction = np.asarray(default_direction, dtype=np.float64)
+            source = sources[int(channel.ReferencedSourceNumber)]
+            seeds["positions"].append(np.mean(positions, axis=0))
+            seeds["directions"].append(direction / np.linalg.norm(direction))
+            seeds["air_kerma_strengths"].append(decayed_air_kerma_strength(source, treatment_datetime))
+            seeds["half_lives"].append(float(source.SourceIsotopeHalfLife))
+
+    return {key: np.asarray(values, dtype=np.float64).reshape((-1, 3) if key in ["positions", "directions"] else (-1,))
+            for key, values in seeds.items()}
+
+
+def superpose_tg43_dose(kernel: TG43Kernel, grid: VoxelGrid, positions: np.ndarray, directions: np.ndarray,
+                        air_kerma_strengths: np.ndarray, half_lives: np.ndarray,
+                        nb_of_slices_per_chunk: int = 8) -> np.ndarray:
+    """
+    Superposes the kernel at every seed, a few slices at a time, each seed evaluated on all their voxels at once. The
+    dose of a permanent implant is its initial dose rate times the mean life of the radionuclide.
+
+    :param grid: dose grid, in mm, in any orientation
+    :param positions: positions of the seeds, in mm
+    :param air_kerma_strengths: in U
+    :param half_lives: in days
+    :return: the total dose of the implant, in Gy
+    """
+    mean_lives = np.asarray(half_lives) * 24 / np.log(2)
+    # cGy h-1 U-1 times U times h, in Gy
+    weights = np.asarray(air_kerma_strengths) * mean_lives / 100
+    dose = np.zeros(grid.shape, dtype=np.float64)
+    for first_slice in range(0, grid.shape[0], nb_of_slices_per_chunk):
+        slice_indices = range(first_slice, min(first_slice + nb_of_slices_per_chunk, grid.shape[0]))
+        # in cm, as the kernels
+        centers = np.stack([grid.voxel_centers(slice_index) for slice_index in slice_indices]) / 10
+        chunk_dose = np.zeros(centers.shape[:-1], dtype=np.float64)
+        for position, direction, weight in zip(np.asarray(positions) / 10, directions, weights):
+            offsets = centers - position
+            distances = np.linalg.norm(offsets, axis=-1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                cosines = np.clip(np.nan_to_num((offsets @ direction) / distances, nan=0.0), -1, 1)
+            chunk_dose += weight * kernel(distances, np.arccos(cosines))
+        dose[first_slice:first_slice + len(slice_indices)] = chunk_dose
+
+    return dose